@@ -0,0 +1,25 @@
+# shared helpers for the benchmark scripts in this folder
+# (the app modules use flat imports, so the app folder is put on sys.path)
+import sys
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "mqtt_led_controller_ui"
+if str(APP_DIR) not in sys.path:
+    sys.path.insert(0, str(APP_DIR))
+
+
+def time_per_call(function, repeat: int) -> float:
+    """Return the mean wall time of ``function()`` in seconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def print_table(header: list, rows: list) -> None:
+    widths = [
+        max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))
+    ]
+    for row in [header] + rows:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
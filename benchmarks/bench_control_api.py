@@ -0,0 +1,142 @@
+# Frames per second (on one core) of the binary frame stream of the control
+# API (control_api.py). In process, FrameStream.feed() is measured without
+# publishing (decode and copy into the devices' frame buffers) and with
+# publishing (JSON encoding and client.publish), with one device per message
+# and all devices in one message. "peak bytes" is the memory allocated while
+# applying one message without publishing; it does not grow with the LED
+# count because the frames are copied straight from the message.
+#
+# With --url the stream of a running UI (python main.py) is measured end to
+# end over a WebSocket: frames are sent for `--seconds` to the devices the
+# UI knows, and the commands it published are read from /metrics.
+#
+# usage: python benchmarks/bench_control_api.py [--devices 100] [--leds 60 300 1000]
+#        python benchmarks/bench_control_api.py --url http://localhost:8080
+import argparse
+import asyncio
+import random
+import re
+import struct
+import time
+import tracemalloc
+
+from _common import print_table, time_per_call
+
+from control_api import FrameStream
+from device_manager import Device
+from mqtt_controller import MQTTController
+
+
+class CountingClient:
+    def __init__(self):
+        self.messages = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+
+
+def record(device_id: str, frame: bytes) -> bytes:
+    return bytes([len(device_id)]) + device_id.encode() + struct.pack(">H", len(frame) // 3) + frame
+
+
+def run(devices: int, leds: int, repeat: int) -> list:
+    rng = random.Random(0)
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.client = CountingClient()
+    controller.delta_encoder = None
+    frames = {}
+    for i in range(devices):
+        device = Device(f"esp32-{i:05d}")
+        device.led_count = leds
+        controller.device_manager.add_device(device)
+        frames[device.device_id] = bytes(rng.randrange(256) for _ in range(3 * leds))
+    single = [record(device_id, frame) for device_id, frame in frames.items()]
+    batched = b"".join(single)
+
+    stream = FrameStream(controller)
+    publish_batch = controller.publish_batch
+    rows = []
+    for name, messages in (("1 device per message", single), ("all in one message", [batched])):
+        controller.publish_batch = lambda batch: None
+        apply_only = time_per_call(lambda: [stream.feed(message) for message in messages], repeat)
+        controller.publish_batch = publish_batch
+        published = time_per_call(lambda: [stream.feed(message) for message in messages], repeat)
+
+        controller.publish_batch = lambda batch: None
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        stream.feed(messages[0])
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        controller.publish_batch = publish_batch
+        rows.append([
+            leds,
+            name,
+            f"{devices / apply_only:,.0f}",
+            f"{devices / published:,.0f}",
+            peak,
+        ])
+    return rows
+
+
+def published_commands(url: str) -> int:
+    import httpx
+
+    text = httpx.get(url + "/metrics").text
+    match = re.search(r'mqtt_led_messages_published_total\{type="cmd"\} (\d+)', text)
+    return int(match.group(1))
+
+
+async def run_remote(url: str, seconds: float) -> None:
+    import httpx
+    import websockets
+
+    devices = httpx.get(url + "/api/devices").json()
+    rng = random.Random(0)
+    messages = [
+        b"".join(
+            record(device["id"], bytes(rng.randrange(256) for _ in range(3 * device["led_count"])))
+            for device in devices
+        )
+        for _ in range(4)
+    ]
+    before = published_commands(url)
+    sent = 0
+    start = time.perf_counter()
+    async with websockets.connect(url.replace("http", "ws", 1) + "/api/stream") as websocket:
+        while time.perf_counter() - start < seconds:
+            await websocket.send(messages[sent % len(messages)])
+            sent += 1
+            if sent % 10 == 0:
+                await (await websocket.ping())  # the server read everything sent so far
+    elapsed = time.perf_counter() - start
+    published = published_commands(url) - before
+    print(f"{len(devices)} devices, {sent} messages in {elapsed:.1f} s\n")
+    print_table(
+        ["messages/s", "frames/s sent", "commands/s published"],
+        [[f"{sent / elapsed:,.0f}", f"{sent * len(devices) / elapsed:,.0f}", f"{published / elapsed:,.0f}"]],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--leds", type=int, nargs="+", default=[60, 300, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--url", help="measure the stream of a running UI instead")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.url:
+        asyncio.run(run_remote(args.url.rstrip("/"), args.seconds))
+        return
+    rows = []
+    for leds in args.leds:
+        rows += run(args.devices, leds, args.repeat)
+    print(f"{args.devices} devices, frames/s on one core\n")
+    print_table(["LEDs", "", "applied", "applied + published", "peak bytes"], rows)
+
+
+if __name__ == "__main__":
+    main()
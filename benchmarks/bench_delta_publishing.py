@@ -0,0 +1,53 @@
+# Bytes published for single-LED changes (e.g. a color picker on one LED)
+# with full frames compared to delta encoding with periodic keyframes.
+#
+# usage: python benchmarks/bench_delta_publishing.py [--leds 300] [--changes 1000]
+import argparse
+import random
+
+from _common import print_table
+
+from led_codec import DeltaEncoder, encode_command, encode_lights
+from settings import DELTA_KEYFRAME_INTERVAL
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--leds", type=int, default=300)
+    parser.add_argument("--changes", type=int, default=1_000)
+    parser.add_argument("--keyframe-interval", type=int, default=DELTA_KEYFRAME_INTERVAL)
+    args = parser.parse_args()
+
+    frame = bytearray(random.randbytes(3 * args.leds))
+    encoder = DeltaEncoder(args.keyframe_interval)
+    full_bytes = delta_bytes = keyframes = 0
+
+    for _ in range(args.changes):
+        offset = 3 * random.randrange(args.leds)
+        frame[offset : offset + 3] = random.randbytes(3)
+
+        full_bytes += len(encode_command("esp32-00001", encode_lights(frame)))
+        payload, keyframe = encoder.encode("esp32-00001", frame)
+        delta_bytes += len(payload)
+        keyframes += keyframe
+        # the device reports its new state back on sts
+        encoder.acknowledge("esp32-00001", frame)
+
+    print(f"{args.changes} single LED changes on a {args.leds} LED strip\n")
+    print_table(
+        ["", "full frames", "delta"],
+        [
+            ["total KiB", f"{full_bytes / 1024:.0f}", f"{delta_bytes / 1024:.0f}"],
+            [
+                "bytes/command",
+                f"{full_bytes / args.changes:.0f}",
+                f"{delta_bytes / args.changes:.0f}",
+            ],
+            ["keyframes", args.changes, keyframes],
+        ],
+    )
+    print(f"\nreduction: {full_bytes / delta_bytes:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
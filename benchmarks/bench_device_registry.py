@@ -0,0 +1,71 @@
+# Lookup cost of the DeviceManager registry from 10 to 10,000 devices.
+#
+# usage: python benchmarks/bench_device_registry.py
+#
+# "scan" is the old enumerate() loop over every device that _on_message used,
+# "registry" is DeviceManager.get_device(). The registry column should stay
+# flat while the scan column grows linearly with the fleet size.
+import random
+
+from _common import print_table, time_per_call
+
+from device_manager import Device, DeviceManager
+
+FLEET_SIZES = [10, 100, 1_000, 10_000]
+LOOKUPS = 20_000
+
+
+def build_fleet(size: int) -> DeviceManager:
+    manager = DeviceManager()
+    for i in range(size):
+        device = Device(f"esp32-{i:05d}")
+        manager.add_device(device)
+        manager.add_to_group(device.device_id, f"group-{i % 10}")
+        device.online = i % 2 == 0
+    return manager
+
+
+def linear_scan(devices, device_id):
+    for device in devices:
+        if device.device_id == device_id:
+            return device
+
+
+def main():
+    rows = []
+    for size in FLEET_SIZES:
+        manager = build_fleet(size)
+        device_list = list(manager.devices)
+        ids = [random.choice(device_list).device_id for _ in range(LOOKUPS)]
+        lookup_ids = iter(ids * 1_000)
+
+        registry = time_per_call(lambda: manager.get_device(next(lookup_ids)), LOOKUPS)
+        scan = time_per_call(
+            lambda: linear_scan(device_list, next(lookup_ids)), min(LOOKUPS, 200_000 // size)
+        )
+        toggle_ids = iter(ids * 1_000)
+
+        def toggle():
+            device = manager.get_device(next(toggle_ids))
+            device.online = not device.online
+
+        online = time_per_call(toggle, LOOKUPS)
+        group = time_per_call(lambda: manager.get_online_devices("group-3"), 200)
+        rows.append(
+            [
+                size,
+                f"{registry * 1e9:.0f}",
+                f"{scan * 1e9:.0f}",
+                f"{online * 1e9:.0f}",
+                f"{group * 1e6:.1f}",
+            ]
+        )
+
+    print_table(
+        ["devices", "registry ns", "scan ns", "online toggle ns", "group online us"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Sustained frame rate of the effect engine driving many devices from one
+# clock, including encoding every frame into an MQTT command.
+#
+# usage: python benchmarks/bench_effect_engine.py [--devices 100] [--leds 300] [--fps 60]
+import argparse
+import asyncio
+import time
+
+from _common import print_table
+
+import effects
+from device_manager import Device
+from mqtt_controller import MQTTController
+
+
+class CountingClient:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        self.bytes += len(payload)
+
+
+async def sustained(args, effect: str) -> list:
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.client = client = CountingClient()
+    engine = controller.effect_engine
+    engine.fps = args.fps
+
+    devices = []
+    for i in range(args.devices):
+        device = Device(f"esp32-{i:05d}")
+        device.led_count = args.leds
+        devices.append(device)
+
+    tick_time = 0.0
+    render_tick = engine.render_tick
+
+    def timed_render_tick(tick):
+        nonlocal tick_time
+        start = time.perf_counter()
+        render_tick(tick)
+        tick_time += time.perf_counter() - start
+
+    engine.render_tick = timed_render_tick
+    for device in devices:
+        engine.play(device, effect)
+    start = time.perf_counter()
+    await asyncio.sleep(args.seconds)
+    elapsed = time.perf_counter() - start
+    engine.stop_all()
+
+    return [
+        effect,
+        f"{engine.ticks / elapsed:.1f}",
+        engine.ticks_skipped,
+        f"{client.messages / elapsed:.0f}",
+        f"{client.bytes / elapsed / 2**20:.1f}",
+        f"{tick_time / max(engine.ticks, 1) * 1e3:.2f}",
+        f"{tick_time / elapsed * 100:.0f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--leds", type=int, default=300)
+    parser.add_argument("--fps", type=float, default=60.0)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    print(f"NumPy: {'yes' if effects.np is not None else 'no'}\n")
+    rows = []
+    for name in ("chase", "rainbow", "wipe", "fade"):
+        start = time.perf_counter()
+        frames = effects.render_effect(name, args.leds)
+        rows.append([name, len(frames), f"{(time.perf_counter() - start) * 1e3:.1f}"])
+    print_table(["effect", "frames", f"precompute ms ({args.leds} LEDs)"], rows)
+
+    print(f"\n{args.devices} devices x {args.leds} LEDs at {args.fps:.0f} fps\n")
+    rows = [asyncio.run(sustained(args, effect)) for effect in ("rainbow", "chase")]
+    print_table(
+        ["effect", "ticks/s", "skipped", "msg/s", "MiB/s", "ms/tick", "cpu %"], rows
+    )
+
+
+if __name__ == "__main__":
+    main()
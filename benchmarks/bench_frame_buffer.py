@@ -0,0 +1,147 @@
+# Memory and throughput of the packed RGB frame buffer in Device compared to
+# the previous list of "#rrggbb" strings.
+#
+# usage: python benchmarks/bench_frame_buffer.py [--devices 10000] [--leds 300]
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from _common import print_table, time_per_call
+
+from device_manager import Device
+from mqtt_controller import MQTTController
+
+
+# the LED button lookup the old decoder did per LED (no buttons exist here)
+LEGACY_LED_BUTTONS = {}
+
+
+class LegacyDevice:
+    # state layout of Device before the frame buffer was introduced
+    def __init__(self, device_id: str, led_count: int):
+        self.device_id = device_id
+        self._online = False
+        self._online_str = ""
+        self._led_count = led_count
+        self.lights = ["#%06x" % random.randrange(2**24) for _ in range(led_count)]
+        self._online_change_event = None
+        self.retain = True
+
+
+def legacy_encode(device: LegacyDevice) -> str:
+    payload = {"device-id": device.device_id, "lights": {}}
+    for led_index, color in enumerate(device.lights):
+        red, green, blue = (
+            int(color[1:3], 16),
+            int(color[3:5], 16),
+            int(color[5:7], 16),
+        )
+        payload["lights"][str(led_index)] = {"red": red, "green": green, "blue": blue}
+    return json.dumps(payload)
+
+
+def legacy_decode(json_message: bytes, device: LegacyDevice) -> None:
+    data = json.loads(json_message)
+    for led_index, color_data in data.get("lights", {}).items():
+        red = color_data.get("red", 0)
+        green = color_data.get("green", 0)
+        blue = color_data.get("blue", 0)
+        color_hex = "#{:02x}{:02x}{:02x}".format(red, green, blue)
+        device.lights[int(led_index)] = color_hex
+        try:
+            LEGACY_LED_BUTTONS[device][int(led_index)].style(
+                f"color:{color_hex}!important"
+            )
+        except (IndexError, KeyError):
+            pass
+
+
+class CapturingClient:
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.last_payload = payload
+
+
+def random_status_payload(led_count: int) -> bytes:
+    lights = {
+        str(i): {
+            "red": random.randrange(256),
+            "green": random.randrange(256),
+            "blue": random.randrange(256),
+        }
+        for i in range(led_count)
+    }
+    return json.dumps({"lights": lights}).encode()
+
+
+def fleet_memory(factory, devices: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    fleet = [factory(i) for i in range(devices)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del fleet
+    return size
+
+
+def new_device(i: int, led_count: int) -> Device:
+    device = Device(f"esp32-{i:05d}")
+    device.set_frame(random.randbytes(3 * led_count))
+    return device
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=10_000)
+    parser.add_argument("--leds", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    legacy_bytes = fleet_memory(
+        lambda i: LegacyDevice(f"esp32-{i:05d}", args.leds), args.devices
+    )
+    buffer_bytes = fleet_memory(lambda i: new_device(i, args.leds), args.devices)
+
+    # throughput of one status message (decode) and one command (encode)
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.client = CapturingClient()
+    payloads = [random_status_payload(args.leds) for _ in range(8)]
+    next_payload = iter(payloads * args.repeat * 2).__next__
+
+    legacy_device = LegacyDevice("legacy", args.leds)
+    device = new_device(0, args.leds)
+    legacy_decode_time = time_per_call(
+        lambda: legacy_decode(next_payload(), legacy_device), args.repeat
+    )
+    decode_time = time_per_call(
+        lambda: controller.parse_json_message(next_payload(), device), args.repeat
+    )
+    legacy_encode_time = time_per_call(lambda: legacy_encode(legacy_device), args.repeat)
+    encode_time = time_per_call(lambda: controller.send_color(device), args.repeat)
+
+    print(f"{args.devices} devices x {args.leds} LEDs\n")
+    print_table(
+        ["", "list of hex", "frame buffer"],
+        [
+            [
+                "fleet memory MiB",
+                f"{legacy_bytes / 2**20:.1f}",
+                f"{buffer_bytes / 2**20:.1f}",
+            ],
+            [
+                "decode msg/s",
+                f"{1 / legacy_decode_time:.0f}",
+                f"{1 / decode_time:.0f}",
+            ],
+            [
+                "encode msg/s",
+                f"{1 / legacy_encode_time:.0f}",
+                f"{1 / encode_time:.0f}",
+            ],
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
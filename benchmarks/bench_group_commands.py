@@ -0,0 +1,74 @@
+# Cost of setting one color on a whole fleet: a send_color per device, the
+# pooled fan-out (one lights map per LED count) and a single broadcast.
+#
+# usage: python benchmarks/bench_group_commands.py [--devices 1000] [--leds 60]
+import argparse
+
+from _common import print_table, time_per_call
+
+from device_manager import Device
+from mqtt_controller import MQTTController
+
+
+class CountingClient:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        self.bytes += len(payload)
+
+
+def make_controller(devices: int, leds: int, capabilities: set) -> MQTTController:
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.client = CountingClient()
+    controller.delta_encoder = None
+    for i in range(devices):
+        device = Device(f"esp32-{i:05d}")
+        device.led_count = leds
+        device.capabilities = set(capabilities)
+        controller.device_manager.add_device(device)
+    return controller
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=1_000)
+    parser.add_argument("--leds", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    def per_device(controller):
+        def run():
+            color = "#ff8000"
+            for device in controller.device_manager.devices:
+                for i in range(device.led_count):
+                    device.update_lights(i, color)
+                controller.publish_color(device)
+
+        return run
+
+    cases = [
+        ("send_color per device", set(), per_device),
+        ("pooled fan-out", set(), lambda c: lambda: c.set_group_color("#ff8000")),
+        ("broadcast", {"broadcast"}, lambda c: lambda: c.set_group_color("#ff8000")),
+    ]
+    rows = []
+    for name, capabilities, make_run in cases:
+        controller = make_controller(args.devices, args.leds, capabilities)
+        seconds = time_per_call(make_run(controller), args.repeat)
+        client = controller.client
+        rows.append([
+            name,
+            f"{seconds * 1e3:.1f}",
+            client.messages // args.repeat,
+            f"{client.bytes / args.repeat / 1024:.0f}",
+        ])
+
+    print(f"one color on {args.devices} devices x {args.leds} LEDs\n")
+    print_table(["", "ms", "messages", "KiB"], rows)
+
+
+if __name__ == "__main__":
+    main()
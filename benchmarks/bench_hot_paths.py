@@ -0,0 +1,318 @@
+# Micro-benchmarks of the per-message hot paths of MQTTController with a fake
+# paho client and synthetic payloads: decoding sts (parse_json_message, with
+# changing payloads and with a device repeating its last sts),
+# encoding commands (send_color) and dispatching received messages
+# (_on_message, direct and through the ingest pipeline).
+#
+# usage: python benchmarks/bench_hot_paths.py [--quick] [--save-baseline] [--tolerance 0.3]
+#
+# The results are compared with baseline_hot_paths.json and the script exits
+# with status 1 if a case got slower (messages/s, p99) or allocates more per
+# message than the baseline allows. Speeds are compared relative to a
+# calibration loop (decoding a 12 LED sts payload with the same decoder as
+# parse_json_message, orjson when installed) that runs between the rounds of
+# every case, so a slower machine or a busy CPU does not count as a
+# regression. The relative figures are what a failure reports. Record a new
+# baseline with --save-baseline.
+#
+# Two rounds are too few for stable speeds, so --quick only checks the
+# allocations; use the full run as the gate.
+import argparse
+import asyncio
+import gc
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from _common import print_table
+
+from led_codec import loads
+from mqtt_controller import MQTTController
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline_hot_paths.json"
+LED_COUNTS = [1, 12, 300, 1_000]
+DEVICE_COUNTS = [10, 100, 1_000, 10_000]
+_CALIBRATION_PAYLOAD = json.dumps(
+    {"lights": {str(i): {"red": i, "green": 2 * i, "blue": 3 * i} for i in range(12)}}
+).encode()
+
+
+class FakeClient:
+    # stands in for paho.mqtt.client.Client, publish() only counts
+    def __init__(self):
+        self.published = 0
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class FakeMessage:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+def make_controller() -> MQTTController:
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.client = FakeClient()
+    return controller
+
+
+def status_payload(led_count: int, rng: random.Random) -> bytes:
+    lights = {
+        str(i): {"red": rng.randrange(256), "green": rng.randrange(256), "blue": rng.randrange(256)}
+        for i in range(led_count)
+    }
+    return json.dumps({"lights": lights}).encode()
+
+
+def _calibration_round(count: int = 2_000) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        loads(_CALIBRATION_PAYLOAD)
+    return count / (time.perf_counter() - start)
+
+
+def measure(function, messages: int, rounds: int) -> dict:
+    # function(i) handles message i. Each round times every call and is
+    # framed by calibration rounds; the best round is reported (like
+    # timeit) and the median ratio to the calibration is what the baseline
+    # is compared with. Allocations are measured in a separate run under
+    # tracemalloc.
+    for i in range(min(messages, 100)):
+        function(i)
+    best_rate = 0.0
+    best_p99 = float("inf")
+    relative_speeds = []
+    relative_p99s = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            calibration_before = _calibration_round()
+            timings = []
+            start = time.perf_counter()
+            for i in range(messages):
+                call_start = time.perf_counter_ns()
+                function(i)
+                timings.append(time.perf_counter_ns() - call_start)
+            rate = messages / (time.perf_counter() - start)
+            calibration = (calibration_before + _calibration_round()) / 2
+            timings.sort()
+            p99 = timings[int(0.99 * (messages - 1))] / 1e3
+            best_rate = max(best_rate, rate)
+            best_p99 = min(best_p99, p99)
+            relative_speeds.append(rate / calibration)
+            relative_p99s.append(p99 * calibration)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        alloc_samples = min(messages, 200)
+        for i in range(alloc_samples):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            function(i)
+            _, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - before
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "messages_per_second": best_rate,
+        "p99_us": best_p99,
+        "relative_speed": statistics.median(relative_speeds),
+        "relative_p99": statistics.median(relative_p99s),
+        "alloc_bytes_per_message": peak_total / alloc_samples,
+    }
+
+
+def bench_parse(led_count: int, rounds: int, unchanged: bool = False) -> dict:
+    # alternating payloads so every message changes LEDs like real traffic,
+    # or the same sts over and over (a fresh bytes object like paho delivers)
+    rng = random.Random(led_count)
+    controller = make_controller()
+    device, _ = controller.device_manager.get_or_add_device("esp32-00001")
+    if unchanged:
+        payload = bytearray(status_payload(led_count, rng))
+        return measure(
+            lambda i: controller.parse_json_message(bytes(payload), device), 1_000, rounds
+        )
+    payloads = [status_payload(led_count, rng) for _ in range(8)]
+    return measure(
+        lambda i: controller.parse_json_message(payloads[i % 8], device), 1_000, rounds
+    )
+
+
+def bench_send_color(led_count: int, rounds: int) -> dict:
+    rng = random.Random(led_count)
+    controller = make_controller()
+    device, _ = controller.device_manager.get_or_add_device("esp32-00001")
+    device.led_count = led_count
+
+    def send(i):
+        device.set_rgb(i % led_count, rng.randrange(256), 0, 0)
+        controller.send_color(device)
+
+    return measure(send, 1_000, rounds)
+
+
+def bench_dispatch(device_count: int, rounds: int, pipeline: bool) -> dict:
+    rng = random.Random(device_count)
+    controller = make_controller()
+    payloads = [status_payload(12, rng) for _ in range(8)]
+    messages = [
+        FakeMessage(f"lightstrips/esp32-{i:05d}/sts", payloads[i % 8]) for i in range(device_count)
+    ]
+    for message in messages:  # the devices are known before measuring
+        controller.handle_message(message.topic, message.payload)
+    messages = [
+        FakeMessage(message.topic, payloads[(i + 1) % 8]) for i, message in enumerate(messages)
+    ]
+    client = controller.client
+    on_message = controller._on_message
+    ingest_pipeline = controller.ingest_pipeline
+    # at least 1,000 messages per round
+    messages = messages * max(1, 1_000 // device_count)
+
+    if not pipeline:
+        return measure(lambda i: on_message(client, None, messages[i]), len(messages), rounds)
+
+    def dispatch(i):
+        on_message(client, None, messages[i])
+        if ingest_pipeline.queue_depth >= 50:  # one render tick per 50 messages, p99 is the tick
+            ingest_pipeline.drain()
+
+    async def run():
+        # the pipeline only queues while it is running, its own task never
+        # gets to run because the measurement does not await
+        ingest_pipeline.start()
+        try:
+            return measure(dispatch, len(messages), rounds)
+        finally:
+            ingest_pipeline.stop()
+
+    return asyncio.run(run())
+
+
+def run_suite(rounds: int) -> dict:
+    results = {}
+    for led_count in LED_COUNTS:
+        results[f"parse_json_message leds={led_count}"] = bench_parse(led_count, rounds)
+    for led_count in LED_COUNTS:
+        results[f"parse_json_message unchanged leds={led_count}"] = bench_parse(
+            led_count, rounds, unchanged=True
+        )
+    for led_count in LED_COUNTS:
+        results[f"send_color leds={led_count}"] = bench_send_color(led_count, rounds)
+    for device_count in DEVICE_COUNTS:
+        results[f"_on_message direct devices={device_count}"] = bench_dispatch(
+            device_count, rounds, pipeline=False
+        )
+    for device_count in DEVICE_COUNTS:
+        results[f"_on_message pipeline devices={device_count}"] = bench_dispatch(
+            device_count, rounds, pipeline=True
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float, speeds: bool = True) -> list:
+    # returns the regressions as (case, metric, baseline, current, limit),
+    # for speeds the values compared: relative to the calibration loop
+    regressions = []
+    for case, result in results.items():
+        reference = baseline.get(case)
+        if reference is None:
+            continue
+        if speeds:
+            limit = reference["relative_speed"] * (1 - tolerance)
+            if result["relative_speed"] < limit:
+                regressions.append(
+                    (case, "relative speed", reference["relative_speed"], result["relative_speed"], limit)
+                )
+            # tail latencies are noisy, only a much longer tail counts
+            limit = reference["relative_p99"] * (1 + 4 * tolerance)
+            if result["relative_p99"] > limit:
+                regressions.append(
+                    (case, "relative p99", reference["relative_p99"], result["relative_p99"], limit)
+                )
+        # allocations hardly vary between runs, allow a fixed slack for small cases
+        limit = reference["alloc_bytes_per_message"] * 1.1 + 256
+        if result["alloc_bytes_per_message"] > limit:
+            regressions.append(
+                (case, "alloc B/msg", reference["alloc_bytes_per_message"], result["alloc_bytes_per_message"], limit)
+            )
+    return regressions
+
+
+def _number(value: float) -> str:
+    return f"{value:.3g}" if value < 1000 else f"{value:,.0f}"
+
+
+def _change(result: dict, reference: dict, metric: str) -> str:
+    if not reference:
+        return "-"
+    return f"{result[metric] / reference[metric] - 1:+.0%}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="fewer rounds, only allocations are checked")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed slowdown, 0.3 = 30%%")
+    args = parser.parse_args()
+
+    results = run_suite(rounds=2 if args.quick else 7)
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+
+    rows = []
+    for case, result in results.items():
+        reference = baseline.get(case)
+        rows.append(
+            [
+                case,
+                f"{result['messages_per_second']:.0f}",
+                _change(result, reference, "relative_speed"),
+                f"{result['p99_us']:.1f}",
+                _change(result, reference, "relative_p99"),
+                f"{result['alloc_bytes_per_message']:.0f}",
+            ]
+        )
+    # "vs baseline" compares the values relative to the calibration loop
+    print_table(["case", "msg/s", "vs baseline", "p99 us", "vs baseline", "alloc B/msg"], rows)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"\nbaseline saved to {args.baseline}")
+        return
+
+    if args.quick:
+        print("\n--quick: speeds are not stable enough to compare, only allocations are checked")
+    regressions = compare(results, baseline, args.tolerance, speeds=not args.quick)
+    if regressions:
+        print("\nREGRESSIONS (baseline -> now, limit):")
+        for case, metric, reference, current, limit in regressions:
+            print(
+                f"  {case}: {metric} {_number(reference)} -> {_number(current)}"
+                f" ({current / reference - 1:+.0%}), limit {_number(limit)}"
+            )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
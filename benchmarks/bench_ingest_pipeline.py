@@ -0,0 +1,79 @@
+# Cost of a burst of 5,000 status messages per second with and without the
+# batched ingest pipeline, for a growing number of distinct devices.
+#
+# usage: python benchmarks/bench_ingest_pipeline.py [--messages 5000] [--leds 12]
+#
+# "direct" handles every message as it arrives (the old _on_message path),
+# "pipeline" queues them and drains one batch as a render tick would. The
+# pipeline cost should follow the number of devices, not of messages.
+import argparse
+import json
+import random
+import time
+
+from _common import print_table
+
+from mqtt_controller import MQTTController
+
+DEVICE_COUNTS = [10, 100, 1_000, 5_000]
+
+
+def status_payload(led_count: int) -> bytes:
+    lights = {
+        str(i): {
+            "red": random.randrange(256),
+            "green": random.randrange(256),
+            "blue": random.randrange(256),
+        }
+        for i in range(led_count)
+    }
+    return json.dumps({"lights": lights}).encode()
+
+
+def burst(device_count: int, messages: int, led_count: int) -> list:
+    payloads = [status_payload(led_count) for _ in range(16)]
+    return [
+        (f"lightstrips/esp32-{i % device_count:05d}/sts", random.choice(payloads))
+        for i in range(messages)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5_000)
+    parser.add_argument("--leds", type=int, default=12)
+    args = parser.parse_args()
+
+    rows = []
+    for device_count in DEVICE_COUNTS:
+        messages = burst(device_count, args.messages, args.leds)
+
+        controller = MQTTController("localhost", 1883, "", "")
+        start = time.perf_counter()
+        for topic, payload in messages:
+            controller.handle_message(topic, payload)
+        direct = time.perf_counter() - start
+
+        controller = MQTTController("localhost", 1883, "", "")
+        pipeline = controller.ingest_pipeline
+        start = time.perf_counter()
+        for topic, payload in messages:
+            pipeline.put(topic, payload)
+        pipeline.drain()
+        batched = time.perf_counter() - start
+
+        rows.append(
+            [
+                device_count,
+                f"{direct * 1e3:.1f}",
+                f"{batched * 1e3:.1f}",
+                pipeline.messages_deduplicated,
+            ]
+        )
+
+    print(f"{args.messages} sts messages with {args.leds} LEDs\n")
+    print_table(["devices", "direct ms", "pipeline ms", "deduplicated"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# What the LED view of one device costs with one button per LED compared to
+# the canvas renderer (led_renderer.py): elements on the page, bytes sent to
+# the browser when one LED or the whole frame changes, and the time to find
+# the LED under a click by scanning all positions vs. the grid index.
+#
+# usage: python benchmarks/bench_led_renderer.py
+import json
+import os
+import random
+
+from _common import APP_DIR, print_table, time_per_call
+
+from nicegui import Client, ui
+from nicegui.page import page
+
+from device_manager import Device
+from led_renderer import LedCanvas, LedLayout
+
+
+def run_method_size(element, name: str, *args) -> int:
+    # the message Element.run_method() sends
+    return len(f'return runMethod({element.id}, "{name}", {json.dumps(args)})')
+
+
+def scan(layout: LedLayout, x: float, y: float):
+    # hit test without index: every LED is checked
+    for index, (led_x, led_y) in enumerate(layout.positions):
+        if (x - led_x) ** 2 + (y - led_y) ** 2 <= layout.hit_radius**2:
+            return index
+    return None
+
+
+def run(name: str, layout: LedLayout) -> list:
+    rng = random.Random(0)
+    led_count = len(layout.positions)
+    device = Device("esp32-00001")
+    device.set_frame(bytes(rng.randrange(256) for _ in range(3 * led_count)))
+
+    with Client(page(""), shared=True) as client:
+        before = len(client.elements)
+        buttons = []
+        with ui.grid(columns=3):
+            for i in range(led_count):
+                buttons.append(
+                    ui.button(icon="lightbulb").style(f"color:{device.color_hex(i)}!important")
+                )
+                buttons[-1].text = "Light " + str(i)
+        button_elements = len(client.elements) - before
+        button_change = len(json.dumps({buttons[0].id: buttons[0]._to_dict()}))
+
+        before = len(client.elements)
+        canvas = LedCanvas(layout, device.frame)
+        canvas_elements = len(client.elements) - before
+        canvas_page = len(json.dumps(canvas._to_dict()))
+        canvas_change = run_method_size(canvas, "patch", [0, device.frame[:3].hex()])
+        canvas_frame = run_method_size(canvas, "set_colors", device.frame.hex())
+
+    clicks = [
+        (rng.uniform(0, layout.width), rng.uniform(0, layout.height)) for _ in range(200)
+    ]
+    scan_time = time_per_call(lambda: [scan(layout, x, y) for x, y in clicks], 5) / len(clicks)
+    index_time = time_per_call(lambda: [layout.hit(x, y) for x, y in clicks], 5) / len(clicks)
+    return [
+        name,
+        led_count,
+        f"{button_elements} / {canvas_elements}",
+        f"{button_change} / {canvas_change}",
+        f"{button_change * led_count} / {canvas_frame}",
+        canvas_page,
+        f"{scan_time * 1e6:.1f} / {index_time * 1e6:.1f}",
+    ]
+
+
+def main():
+    os.chdir(APP_DIR)
+    rows = [
+        run("ring 12", LedLayout.ring_12()),
+        run("strip 300", LedLayout.strip(300, 30)),
+        run("matrix 32x32", LedLayout.matrix(32, 32, serpentine=True)),
+        run("strip 4096", LedLayout.strip(4096, 64)),
+    ]
+    print("buttons / canvas\n")
+    print_table(
+        [
+            "layout",
+            "LEDs",
+            "elements",
+            "bytes per LED change",
+            "bytes per frame change",
+            "canvas bytes on page load",
+            "hit test us",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
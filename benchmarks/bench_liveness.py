@@ -0,0 +1,181 @@
+# Cost of detecting devices that stopped sending (liveness.py) from 1,000 to
+# 100,000 devices, on a simulated clock: every device sends a heartbeat
+# every timeout / 3 seconds, spread evenly, and the checks run once per
+# precision (1 s). Compared are
+#   timer wheel  LivenessMonitor: seen() only stores the time, each device is
+#                looked at about once per timeout
+#   full scan    every check loops over all online devices
+#   heap timers  one timer per device, cancelled and rescheduled on every
+#                message (what loop.call_later per device does)
+# "housekeeping" is the time the checks take per simulated second, "CPU" the
+# share of one core that seen() plus the checks need. "memory" is the traced
+# memory of the structure (with the online index every strategy shares).
+# Then 10% of the devices hang at once: all of them have to go offline within
+# timeout + precision, one online_changed event per check at most.
+#
+# usage: python benchmarks/bench_liveness.py [--devices 1000 10000 100000] [--timeout 30]
+import argparse
+import heapq
+import random
+import time
+import tracemalloc
+
+from _common import print_table
+
+from device_manager import Device, DeviceManager
+from liveness import LivenessMonitor
+
+
+class FullScan:
+    def __init__(self, device_manager, timeout: float):
+        self.device_manager = device_manager
+        self.timeout = timeout
+
+    def seen(self, device) -> None:
+        pass
+
+    def advance(self, now: float) -> None:
+        expired = [
+            device
+            for device in self.device_manager.get_online_devices()
+            if device.last_seen is not None and now - device.last_seen >= self.timeout
+        ]
+        self.device_manager.set_online(expired, False)
+
+
+class HeapTimers:
+    def __init__(self, device_manager, timeout: float):
+        self.device_manager = device_manager
+        self.timeout = timeout
+        self._heap = []
+        self._deadlines = {}  # the latest deadline per device, older heap entries are cancelled
+
+    def seen(self, device) -> None:
+        deadline = device.last_seen + self.timeout
+        self._deadlines[device.device_id] = deadline
+        heapq.heappush(self._heap, (deadline, device.device_id))
+
+    def advance(self, now: float) -> None:
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, device_id = heapq.heappop(heap)
+            if self._deadlines.get(device_id) == deadline:
+                del self._deadlines[device_id]
+                expired.append(self.device_manager.get_device(device_id))
+        self.device_manager.set_online(expired, False)
+
+
+def build(count: int, strategy: str, timeout: float, precision: float, start: float):
+    device_manager = DeviceManager()
+    devices = []
+    for i in range(count):
+        device = Device(f"esp32-{i:06d}")
+        device.last_seen = start
+        device_manager.add_device(device)
+        devices.append(device)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    if strategy == "timer wheel":
+        monitor = LivenessMonitor(device_manager, timeout, precision)
+    elif strategy == "full scan":
+        monitor = FullScan(device_manager, timeout)
+    else:
+        monitor = HeapTimers(device_manager, timeout)
+    device_manager.set_online(devices, True)
+    for device in devices:
+        monitor.seen(device)
+    memory = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return device_manager, devices, monitor, memory
+
+
+def simulate(devices, monitor, clock: list, ticks: int, interval: float, precision: float, hung=()):
+    # advances clock[0] by `ticks` checks, returns the wall time spent in
+    # seen() and in the checks
+    seen_time = check_time = 0.0
+    per_tick = round(interval / precision)  # a device sends every per_tick checks
+    for _ in range(ticks):
+        clock[0] += precision
+        phase = round(clock[0] / precision) % per_tick
+        begin = time.perf_counter()
+        for device in devices[phase::per_tick]:
+            if device.device_id not in hung:
+                device.last_seen = clock[0]
+                monitor.seen(device)
+        middle = time.perf_counter()
+        monitor.advance(clock[0])
+        seen_time += middle - begin
+        check_time += time.perf_counter() - middle
+    return seen_time, check_time
+
+
+def run(count: int, strategy: str, args) -> tuple:
+    clock = [time.monotonic()]
+    interval = args.timeout / 3
+    ticks = round(args.timeout / args.precision)
+    device_manager, devices, monitor, memory = build(
+        count, strategy, args.timeout, args.precision, clock[0]
+    )
+    # one timeout to settle, then the measured steady state
+    simulate(devices, monitor, clock, ticks, interval, args.precision)
+    seen_time, check_time = simulate(devices, monitor, clock, 2 * ticks, interval, args.precision)
+    seconds = 2 * args.timeout
+    messages = count * seconds / interval
+    row = [
+        count,
+        strategy,
+        f"{seen_time / messages * 1e6:.2f}",
+        f"{check_time / seconds * 1000:.2f}",
+        f"{(seen_time + check_time) / seconds * 100:.2f}%",
+        memory,
+    ]
+
+    # 10% of the devices hang, their last heartbeats are spread over `interval`
+    hung = {device.device_id for device in random.Random(0).sample(devices, count // 10)}
+    events = []
+    offline_at = {}
+
+    def on_online_changed(changed):
+        events.append(len(changed))
+        for device in changed:
+            offline_at.setdefault(device.device_id, clock[0])
+
+    device_manager.online_changed.subscribe(on_online_changed)
+    simulate(devices, monitor, clock, 2 * ticks, interval, args.precision, hung)
+    delays = [
+        offline_at[device.device_id] - device.last_seen for device in devices if device.device_id in offline_at
+    ]
+    hang_row = [
+        count,
+        strategy,
+        len(hung),
+        len(offline_at),
+        f"{max(delays):.1f}" if delays else "-",
+        len(events),
+    ]
+    return row, hang_row
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--precision", type=float, default=1.0)
+    args = parser.parse_args()
+
+    rows = []
+    hang_rows = []
+    for count in args.devices:
+        for strategy in ("timer wheel", "full scan", "heap timers"):
+            row, hang_row = run(count, strategy, args)
+            rows.append(row)
+            hang_rows.append(hang_row)
+    print(f"heartbeat every {args.timeout / 3:.0f} s, timeout {args.timeout:.0f} s, checked every {args.precision} s\n")
+    print_table(["devices", "", "seen() us", "housekeeping ms/s", "CPU", "memory bytes"], rows)
+    print(f"\n10% of the devices hang, detection must take at most {args.timeout + args.precision:.0f} s\n")
+    print_table(["devices", "", "hung", "marked offline", "max s after last heartbeat", "online_changed events"], hang_rows)
+
+
+if __name__ == "__main__":
+    main()
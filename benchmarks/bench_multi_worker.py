@@ -0,0 +1,232 @@
+# How many browser clients the UI serves with 1, 2 and 4 UI worker processes
+# (multi_worker.py). A publisher acts as the devices and changes their LEDs at
+# a fixed rate. The clients are spread round robin over the workers, like a
+# load balancer with sticky sessions does. First every client loads the page
+# again and again (pages/s), then every client loads it once and keeps its
+# socket.io connection open like a browser, counting the UI updates it
+# receives. A client that keeps up receives about one update per change of
+# the device shown on the page; "delivered %" falls once the workers cannot
+# keep up. Needs a running MQTT broker, and more than one core for the
+# workers to scale (they share nothing but the CPU).
+#
+# usage: python benchmarks/bench_multi_worker.py --broker localhost [--workers 1 2 4] [--clients 10 50 100]
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import paho.mqtt.client as mqtt
+import websockets
+from _common import APP_DIR, print_table
+
+from led_codec import encode_lights
+
+CLIENT_ID = re.compile(r"'client_id': '([0-9a-f-]+)'")
+
+
+async def wait_for_page(url: str, timeout: float = 60.0) -> None:
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                if (await http.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"{url} did not answer")
+            await asyncio.sleep(0.5)
+
+
+async def load_pages(urls: list, clients: int, seconds: float) -> tuple:
+    # `clients` concurrent page loads for `seconds`, returns the load times
+    times = []
+    deadline = time.perf_counter() + seconds
+
+    async def client(url: str) -> None:
+        async with httpx.AsyncClient(timeout=30) as http:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                if (await http.get(url)).status_code == 200:
+                    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(urls[i % len(urls)]) for i in range(clients)))
+    return sorted(times), time.perf_counter() - start
+
+
+async def browser_client(url: str, stop: asyncio.Event, result: dict) -> None:
+    # loads the page and keeps its socket.io connection open like a browser
+    async with httpx.AsyncClient(timeout=30) as http:
+        page = await http.get(url)
+    client_id = CLIENT_ID.search(page.text).group(1)
+    ws_url = url.replace("http", "ws", 1).rstrip("/")
+    ws_url += f"/_nicegui_ws/socket.io/?client_id={client_id}&EIO=4&transport=websocket"
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        await ws.recv()  # engine.io open
+        await ws.send("40")
+        await ws.recv()  # socket.io connect
+        await ws.send(f'420["handshake","{client_id}"]')
+        result["updates"] = 0
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(ws.recv(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            if message == "2":
+                await ws.send("3")
+            elif message.startswith('42["update"'):
+                result["updates"] += 1
+
+
+def start_publisher(args) -> mqtt.Client:
+    # the devices: every device changes all of its LEDs `rate` times per second
+    client = mqtt.Client()
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    client.connect(args.broker, args.broker_port)
+    client.loop_start()
+    return client
+
+
+async def publish(client: mqtt.Client, args, stop: asyncio.Event) -> None:
+    frame_index = 0
+    next_time = time.perf_counter()
+    while not stop.is_set():
+        for device in range(args.devices):
+            value = (frame_index * 8 + device) % 256
+            frame = bytes([value, 255 - value, 0]) * args.leds
+            client.publish(
+                f"lightstrips/bench-{device:03d}/sts",
+                '{"lights":%s}' % encode_lights(frame),
+            )
+        frame_index += 1
+        next_time += 1 / args.rate
+        await asyncio.sleep(max(next_time - time.perf_counter(), 0))
+
+
+async def run(workers: int, clients: int, args, publisher) -> list:
+    urls = [f"http://127.0.0.1:{args.port + worker}/" for worker in range(workers)]
+    with tempfile.TemporaryDirectory() as work_dir:  # keeps the device store out of the app folder
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                str(APP_DIR / "multi_worker.py"),
+                f"--workers={workers}",
+                f"--port={args.port}",
+                f"--broker={args.broker}",
+                f"--broker-port={args.broker_port}",
+                f"--username={args.username}",
+                f"--password={args.password}",
+                "--log-level=WARNING",
+            ],
+            cwd=work_dir,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            for url in urls:
+                await wait_for_page(url)
+            stop_publishing = asyncio.Event()
+            publishing = asyncio.create_task(publish(publisher, args, stop_publishing))
+            await asyncio.sleep(2)  # the devices are known before the pages are loaded
+            page_times, pages_elapsed = await load_pages(urls, clients, args.seconds)
+
+            stop = asyncio.Event()
+            results = [{} for _ in range(clients)]
+            tasks = [
+                asyncio.create_task(
+                    browser_client(urls[i % workers], stop, results[i])
+                )
+                for i in range(clients)
+            ]
+            await asyncio.sleep(args.warmup)
+            before = [result.get("updates", 0) for result in results]
+            start = time.perf_counter()
+            await asyncio.sleep(args.seconds)
+            elapsed = time.perf_counter() - start
+            after = [result.get("updates", 0) for result in results]
+            stop.set()
+            stop_publishing.set()
+            await asyncio.gather(*tasks, publishing, return_exceptions=True)
+        finally:
+            process.terminate()
+            process.wait(10)
+
+    # only clients that completed the socket.io handshake count, a client
+    # that never connected received nothing and would read as 0 updates/s
+    rates = [
+        (a - b) / elapsed for a, b, result in zip(after, before, results) if "updates" in result
+    ]
+    return [
+        workers,
+        clients,
+        f"{len(page_times) / pages_elapsed:.1f}",
+        f"{page_times[len(page_times) // 2] * 1000:.0f}" if page_times else "-",
+        f"{page_times[int(len(page_times) * 0.99)] * 1000:.0f}" if page_times else "-",
+        len(rates),
+        f"{statistics.mean(rates):.1f}" if rates else "-",
+        f"{min(statistics.mean(rates) / args.rate * 100, 100):.0f}" if rates else "-",
+        f"{min(rates):.1f}" if rates else "-",
+    ]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--leds", type=int, default=60)
+    parser.add_argument("--rate", type=float, default=10.0, help="changes per second and device")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=8090, help="port of the first worker")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--broker-port", type=int, default=1883)
+    parser.add_argument("--username", default="")
+    parser.add_argument("--password", default="")
+    args = parser.parse_args()
+
+    print(
+        f"{args.devices} devices x {args.leds} LEDs, {args.rate:.0f} changes/s each, "
+        f"{os.cpu_count()} CPUs\n"
+    )
+    if os.cpu_count() <= max(args.workers):
+        # the ingest process, the workers and this script share the cores
+        print(f"only {os.cpu_count()} CPUs: more workers cannot serve more clients here\n")
+    publisher = start_publisher(args)
+    rows = []
+    for workers in args.workers:
+        for clients in args.clients:
+            rows.append(await run(workers, clients, args, publisher))
+    publisher.loop_stop()
+    publisher.disconnect()
+    print_table(
+        [
+            "workers",
+            "clients",
+            "pages/s",
+            "page p50 ms",
+            "page p99 ms",
+            "connected",
+            "updates/s per client",
+            "delivered %",
+            "slowest client/s",
+        ],
+        rows,
+    )
+    if any(row[5] < row[1] for row in rows):
+        # e.g. a socket.io / engine.io / Starlette combination that rejects the connection
+        print(
+            "\nnot every client connected its socket.io session, the live update columns"
+            " only count the connected ones (\"-\": none connected, nothing was measured)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
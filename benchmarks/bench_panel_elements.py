@@ -0,0 +1,55 @@
+# Server side element count and memory of the device panels of one page,
+# with every panel built eagerly compared to lazily built panels.
+#
+# usage: python benchmarks/bench_panel_elements.py [--devices 200] [--leds 60]
+import argparse
+import gc
+import os
+import tracemalloc
+
+from _common import APP_DIR, print_table
+
+from nicegui import Client
+from nicegui.page import page
+
+from device_manager import Device
+from mqtt_controller import MQTTController
+from ui_elements import DevicePanels
+
+
+def build_page(devices: int, leds: int, lazy: bool):
+    controller = MQTTController("localhost", 1883, "", "")
+    for i in range(devices):
+        device = Device(f"esp32-{i:05d}")
+        device.led_count = 12 if i % 4 == 0 else leds
+        controller.device_manager.add_device(device)
+
+    gc.collect()
+    tracemalloc.start()
+    with Client(page(""), shared=True) as client:
+        panels = DevicePanels(controller, lazy=lazy, idle_timeout=0)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(client.elements), size, panels.built_panels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--leds", type=int, default=60)
+    args = parser.parse_args()
+    os.chdir(APP_DIR)
+
+    rows = []
+    for lazy in (False, True):
+        elements, size, built = build_page(args.devices, args.leds, lazy)
+        rows.append(
+            ["lazy" if lazy else "eager", built, elements, f"{size / 2**20:.1f}"]
+        )
+
+    print(f"{args.devices} devices, {args.leds} LEDs (every 4th device a 12-LED ring)\n")
+    print_table(["panels", "built", "elements", "memory MiB"], rows)
+
+
+if __name__ == "__main__":
+    main()
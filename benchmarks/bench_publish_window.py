@@ -0,0 +1,95 @@
+# QoS 1 command throughput and acknowledgement latency for several publish
+# window sizes, on the in-process broker with a simulated round trip time.
+# Every device gets `--frames` new frames as fast as the controller accepts
+# them (like an effect running faster than the broker acknowledges). A small
+# window limits the throughput to window / round trip time; frames that wait
+# for room are replaced by newer ones ("superseded") instead of piling up.
+#
+# usage: python benchmarks/bench_publish_window.py [--devices 500] [--frames 10] [--rtt-ms 20]
+import argparse
+import asyncio
+import random
+import time
+
+from _common import print_table
+
+from device_manager import Device
+from device_simulator import InProcessBroker
+from mqtt_controller import MQTTController
+
+
+async def run(window: int, args) -> list:
+    rng = random.Random(0)
+    loop = asyncio.get_running_loop()
+    broker = InProcessBroker(loop, ack_delay=args.rtt_ms / 1000)
+    controller = MQTTController("localhost", 1883, "", "")
+    broker.connect_controller(controller)
+    publish_window = controller.publish_window
+    publish_window.max_in_flight = window
+    publish_window.start()
+    devices = []
+    for i in range(args.devices):
+        device = Device(f"esp32-{i:05d}")
+        device.qos = 1
+        device.led_count = args.leds
+        controller.device_manager.add_device(device)
+        devices.append(device)
+    frames = [bytes(rng.randrange(256) for _ in range(3 * args.leds)) for _ in range(16)]
+
+    max_queued = 0
+    start = time.perf_counter()
+    for frame_index in range(args.frames):
+        for device in devices:
+            device.set_frame(frames[(frame_index + len(devices)) % 16])
+            controller.publish_color(device)
+        max_queued = max(max_queued, publish_window.queued)
+        await asyncio.sleep(0)
+    while publish_window.in_flight or publish_window.queued:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    publish_window.stop()
+
+    ack_time = publish_window.ack_time
+    return [
+        window,
+        publish_window.published[1],
+        publish_window.acknowledged,
+        publish_window.superseded,
+        max_queued,
+        f"{elapsed:.2f}",
+        f"{publish_window.acknowledged / elapsed:.0f}",
+        f"{ack_time.sum / max(ack_time.count, 1) * 1000:.1f}",
+    ]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--frames", type=int, default=10, help="frames per device")
+    parser.add_argument("--leds", type=int, default=60)
+    parser.add_argument("--rtt-ms", type=float, default=20.0, help="simulated broker round trip")
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    print(
+        f"{args.devices} devices x {args.frames} frames of {args.leds} LEDs at QoS 1, "
+        f"{args.rtt_ms:.0f} ms round trip\n"
+    )
+    rows = [await run(window, args) for window in args.windows]
+    print_table(
+        [
+            "window",
+            "published",
+            "acknowledged",
+            "superseded",
+            "max queued",
+            "seconds",
+            "acks/s",
+            "mean ack ms",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+# Cost of putting a fleet into a stored state: setting every LED and
+# publishing per device (what the UI did), setting whole frames and
+# publishing, and applying a scene (scenes.py) with a cold and a warm cache of
+# compiled commands. "captured" has a different frame on every device,
+# "pattern" one repeated color pattern for all of them.
+#
+# usage: python benchmarks/bench_scenes.py [--devices 500] [--leds 60]
+import argparse
+import os
+import random
+import tempfile
+
+from _common import print_table, time_per_call
+
+from device_manager import Device
+from mqtt_controller import MQTTController
+from scenes import SceneEngine
+
+
+class CountingClient:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        self.bytes += len(payload)
+
+
+def make_controller(devices: int, leds: int, path: str) -> MQTTController:
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.client = CountingClient()
+    controller.delta_encoder = None
+    for i in range(devices):
+        device = Device(f"esp32-{i:05d}")
+        device.led_count = leds
+        controller.device_manager.add_device(device)
+    controller.scenes = SceneEngine(controller, path, cache_size=4 * devices)
+    return controller
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--leds", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    frames = {
+        f"esp32-{i:05d}": bytes(rng.randrange(256) for _ in range(3 * args.leds))
+        for i in range(args.devices)
+    }
+    pattern = ["#ff0000", "#ff8000", "#ffff00", "#000000"]
+    targets = {
+        "captured": [{"device": device_id, "frame": frame.hex()} for device_id, frame in frames.items()],
+        "pattern": [{"colors": pattern}],
+    }
+
+    def device_frame(scene: str, device) -> bytes:
+        if scene == "captured":
+            return frames[device.device_id]
+        return bytes.fromhex("".join(color[1:] for color in pattern) * args.leds)[: 3 * args.leds]
+
+    def per_led(controller, scene):
+        device_colors = {}
+        for device in controller.device_manager.devices:
+            frame = device_frame(scene, device)
+            device_colors[device.device_id] = [
+                "#" + frame[i : i + 3].hex() for i in range(0, len(frame), 3)
+            ]
+
+        def run():
+            for device in controller.device_manager.devices:
+                for index, color in enumerate(device_colors[device.device_id]):
+                    device.update_lights(index, color)
+                controller.publish_color(device)
+
+        return run
+
+    def per_frame(controller, scene):
+        def run():
+            lights_pool = {}
+            for device in controller.device_manager.devices:
+                device.set_frame(device_frame(scene, device))
+                controller.publish_color(device, lights_pool)
+
+        return run
+
+    def scene_cold(controller, scene):
+        def run():
+            controller.scenes.invalidate()
+            controller.scenes.apply(scene)
+
+        return run
+
+    def scene_warm(controller, scene):
+        controller.scenes.apply(scene)
+        return lambda: controller.scenes.apply(scene)
+
+    cases = [
+        ("per LED + publish", per_led),
+        ("set_frame + publish", per_frame),
+        ("scene, cold cache", scene_cold),
+        ("scene, warm cache", scene_warm),
+    ]
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "scenes.json")
+        for scene in targets:
+            for name, make_run in cases:
+                controller = make_controller(args.devices, args.leds, path)
+                for scene_name, scene_targets in targets.items():
+                    controller.scenes.save_scene(scene_name, scene_targets)
+                run = make_run(controller, scene)
+                client = controller.client
+                client.messages = client.bytes = 0
+                seconds = time_per_call(run, args.repeat)
+                rows.append([
+                    scene,
+                    name,
+                    f"{seconds * 1e3:.1f}",
+                    f"{seconds / args.devices * 1e6:.1f}",
+                    client.messages // args.repeat,
+                ])
+
+    print(f"one scene on {args.devices} devices x {args.leds} LEDs\n")
+    print_table(["scene", "", "ms", "us per device", "messages"], rows)
+
+
+if __name__ == "__main__":
+    main()
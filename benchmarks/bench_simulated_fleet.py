@@ -0,0 +1,89 @@
+# How the UI server side scales with the fleet size: simulated devices on the
+# in-process broker announce themselves, then every device gets a command
+# and answers with its new state.
+#
+# usage: python benchmarks/bench_simulated_fleet.py [--sizes 100 1000 5000] [--leds 60]
+import argparse
+import asyncio
+import time
+
+from _common import print_table
+
+from device_simulator import DeviceFleet, InProcessBroker
+from mqtt_controller import MQTTController
+
+
+async def wait_until(condition, timeout: float = 60.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(0.001)
+
+
+async def run(size: int, args) -> list:
+    loop = asyncio.get_running_loop()
+    broker = InProcessBroker(loop)
+    controller = MQTTController("localhost", 1883, "", "")
+    controller.ingest_pipeline.start()
+    controller.publish_scheduler.start()
+    broker.connect_controller(controller)
+    device_manager = controller.device_manager
+
+    status_received = 0
+
+    def count_status(topic, payload):
+        nonlocal status_received
+        status_received += topic.endswith("/sts")
+
+    controller.message_received.subscribe(count_status)
+    fleet = DeviceFleet(size, args.leds, args.capabilities, delay=args.delay, seed=1)
+
+    start = time.perf_counter()
+    fleet.start_in_process(broker)
+    await wait_until(
+        lambda: device_manager.online_count == size
+        and status_received >= size
+        and controller.ingest_pipeline.queue_depth == 0
+    )
+    announce_time = time.perf_counter() - start
+
+    status_received = 0
+    start = time.perf_counter()
+    messages = controller.set_group_color("#ff8000")
+    await wait_until(lambda: status_received >= size)
+    await wait_until(lambda: controller.ingest_pipeline.queue_depth == 0)
+    command_time = time.perf_counter() - start
+
+    fleet.stop()
+    controller.ingest_pipeline.stop()
+    controller.publish_scheduler.stop()
+    return [
+        size,
+        f"{announce_time:.2f}",
+        f"{size / announce_time:.0f}",
+        messages,
+        f"{command_time:.2f}",
+        f"{size / command_time:.0f}",
+        controller.ingest_pipeline.batches,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 5_000])
+    parser.add_argument("--leds", type=int, default=60)
+    parser.add_argument("--capabilities", nargs="*", default=[])
+    parser.add_argument("--delay", type=float, default=0.0, help="device processing delay")
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run(size, args)) for size in args.sizes]
+    print(f"simulated devices with {args.leds} LEDs, capabilities {args.capabilities}\n")
+    print_table(
+        ["devices", "announce s", "devices/s", "cmd messages", "round trip s", "sts/s", "batches"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
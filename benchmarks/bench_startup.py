@@ -0,0 +1,91 @@
+# Cold start time of the UI (main.py): the app is started `--runs` times as a
+# new process and the median time from launching it until each startup phase
+# it logs ("Startup: <phase> after <n> ms", see metrics.StartupTimer) is
+# reported, plus the time until the first page was served (HTTP 200 on /),
+# measured from here. The process start itself (interpreter, site packages)
+# is only in "page served". Without --broker the broker phases are missing.
+#
+# usage: python benchmarks/bench_startup.py [--runs 5] [--broker localhost] [--port 8095]
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from _common import APP_DIR, print_table
+
+PHASE = re.compile(r"Startup: (.+) after (\d+) ms")
+
+
+def wait_for_page(url: str, timeout: float = 60.0) -> float:
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            if httpx.get(url).status_code == 200:
+                return time.perf_counter()
+        except httpx.TransportError:
+            pass
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"{url} did not answer")
+        time.sleep(0.01)
+
+
+def start_once(args, settle: float = 1.0) -> dict:
+    # phase -> seconds of one cold start
+    command = [
+        sys.executable,
+        str(APP_DIR / "main.py"),
+        "--host=127.0.0.1",
+        f"--port={args.port}",
+        "--no-reload",
+        "--no-test-devices",
+        "--log-level=INFO",
+    ]
+    if args.broker:
+        command += [f"--broker={args.broker}", f"--broker-port={args.broker_port}"]
+    else:
+        command += ["--broker=127.0.0.1", "--broker-port=1"]  # nothing listens there
+    env = dict(os.environ, MQTT_LED_SIMULATED_DEVICES="0")
+    with tempfile.TemporaryDirectory() as work_dir:  # keeps the device store out of the app folder
+        env["MQTT_LED_DEVICE_STORE_PATH"] = os.path.join(work_dir, "devices.json")
+        with open(os.path.join(work_dir, "app.log"), "w+") as log:
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=log, stderr=log)
+            try:
+                served = wait_for_page(f"http://127.0.0.1:{args.port}/") - start
+                time.sleep(settle)  # the broker phases may come after the first page
+            finally:
+                process.terminate()
+                process.wait(10)
+            log.seek(0)
+            phases = {phase: int(ms) / 1000 for phase, ms in PHASE.findall(log.read())}
+    phases["page served"] = served
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--broker", help="MQTT broker to connect to")
+    parser.add_argument("--broker-port", type=int, default=1883)
+    args = parser.parse_args()
+
+    start_once(args)  # warms the file system cache and the bytecode
+    runs = [start_once(args) for _ in range(args.runs)]
+    phases = list(dict.fromkeys(phase for run in runs for phase in run))
+    phases.sort(key=lambda phase: statistics.median(run[phase] for run in runs if phase in run))
+    rows = []
+    for phase in phases:
+        times = [run[phase] for run in runs if phase in run]
+        rows.append([phase, f"{statistics.median(times) * 1000:.0f}", f"{max(times) * 1000:.0f}", len(times)])
+    print(f"{args.runs} cold starts of main.py, ms (\"page served\" includes starting the interpreter)\n")
+    print_table(["phase", "median", "max", "runs"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Recording cost and memory use of the LED state history with many devices
+# changing at a fixed rate, on a simulated clock. "pixel" changes one LED per
+# frame (like picking colors), "effect" changes every LED (like rainbow). The
+# time of the same changes without a history is subtracted, so records/s is
+# the cost of recording alone. The traced memory of the history has to stay
+# close to the budget no matter how many devices there are.
+#
+# usage: python benchmarks/bench_state_history.py [--devices 1000] [--leds 300] [--budget-mb 16]
+import argparse
+import random
+import time
+import tracemalloc
+
+from _common import print_table, time_per_call
+
+from device_manager import DeviceManager
+from state_history import StateHistory
+
+
+def apply_changes(devices, args, pattern: str, clock: list, effect_frames: list) -> float:
+    # runs args.seconds of simulated changes, returns the wall time it took
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for frame_index in range(int(args.seconds * args.rate)):
+        clock[0] = frame_index / args.rate
+        for device in devices:
+            if pattern == "pixel":
+                led = rng.randrange(args.leds)
+                device.set_rgb(led, frame_index % 256, led % 256, 0)
+                device.notify_lights_changed([led])
+            else:
+                device.set_frame(effect_frames[(frame_index + len(device.device_id)) % 16])
+    return time.perf_counter() - start
+
+
+def stop_recording(device_manager, history) -> None:
+    for device in device_manager.devices:
+        history.unwatch(device)
+
+
+def run(args, pattern: str) -> list:
+    rng = random.Random(0)
+    clock = [0.0]
+    device_manager = DeviceManager()
+    devices = []
+    for i in range(args.devices):
+        device, _ = device_manager.get_or_add_device(f"esp32-{i:05d}")
+        device.led_count = args.leds
+        devices.append(device)
+    effect_frames = [bytes(rng.randrange(256) for _ in range(3 * args.leds)) for _ in range(16)]
+    # the same changes without a history, only the difference is counted
+    without_history = apply_changes(devices, args, pattern, clock, effect_frames)
+
+    clock[0] = 0.0
+    history = StateHistory(
+        device_manager, args.budget_mb * 2**20, clock=lambda: clock[0], wall_clock=lambda: clock[0]
+    )
+    elapsed = max(apply_changes(devices, args, pattern, clock, effect_frames) - without_history, 1e-9)
+    stop_recording(device_manager, history)
+
+    # once more under tracemalloc (which slows everything down) for the memory use
+    clock[0] = 0.0
+    tracemalloc.start()
+    history = StateHistory(
+        device_manager, args.budget_mb * 2**20, clock=lambda: clock[0], wall_clock=lambda: clock[0]
+    )
+    apply_changes(devices, args, pattern, clock, effect_frames)
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    records_per_second = history.records / elapsed
+    stats = history.stats()
+    query_time = time_per_call(
+        lambda: history.state_at(devices[0].device_id, clock[0] - 0.5 * (clock[0] - stats["oldest"])),
+        200,
+    )
+    return [
+        pattern,
+        f"{records_per_second:.0f}",
+        f"{args.devices * args.rate / records_per_second * 100:.0f}",
+        f"{stats['memory_used'] / 2**20:.1f}",
+        f"{traced / 2**20:.1f}",
+        f"{clock[0] - stats['oldest']:.1f}",
+        stats["segments_evicted"],
+        f"{query_time * 1e6:.0f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--leds", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=30.0, help="changes per second and device")
+    parser.add_argument("--seconds", type=float, default=5.0, help="simulated time")
+    parser.add_argument("--budget-mb", type=int, default=16)
+    args = parser.parse_args()
+
+    print(
+        f"{args.devices} devices x {args.leds} LEDs, {args.rate:.0f} changes/s each, "
+        f"{args.seconds:.0f} s simulated, budget {args.budget_mb} MiB\n"
+    )
+    rows = [run(args, pattern) for pattern in ("pixel", "effect")]
+    print_table(
+        [
+            "pattern",
+            "records/s",
+            "cpu % at rate",
+            "budget used MiB",
+            "traced MiB",
+            "span kept s",
+            "evicted",
+            "state_at us",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
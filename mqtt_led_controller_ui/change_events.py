@@ -0,0 +1,32 @@
+import logging
+
+
+class Event:
+    # Minimal observer list. Callbacks are called synchronously, in the order
+    # they subscribed, with the arguments passed to emit().
+
+    __slots__ = ("_callbacks",)
+
+    def __init__(self):
+        self._callbacks = []
+
+    def __len__(self):
+        return len(self._callbacks)
+
+    def subscribe(self, callback):
+        # returns a function that removes the subscription again
+        self._callbacks.append(callback)
+        return lambda: self.unsubscribe(callback)
+
+    def unsubscribe(self, callback) -> None:
+        try:
+            self._callbacks.remove(callback)
+        except ValueError:
+            pass
+
+    def emit(self, *args) -> None:
+        for callback in tuple(self._callbacks):
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception(f"Event callback {callback} failed")
@@ -0,0 +1,255 @@
+import hmac
+import ipaddress
+import logging
+
+from device_manager import parse_color
+from led_codec import loads
+
+# HTTP and WebSocket control of the devices for other programs (music sync,
+# show control, home automation), served by the NiceGUI app next to the UI:
+#
+#   GET  /api/devices                      id, LED count, online and groups of every device
+#   GET  /api/devices/<id>                 the same plus the frame as hex
+#   POST /api/frames                       set and publish many devices at once:
+#        {"devices": {"esp32-00001": {"frame": "ff0000..."},
+#                     "esp32-00002": {"color": "#ff8000"},
+#                     "esp32-00003": {"leds": {"0": "#ff0000", "5": "blue"}}}}
+#   POST /api/color                        {"color": "#ff8000", "group": "shelf"} (no group: all)
+#   POST /api/scenes/<name>                applies a scene
+#   WS   /api/stream                       binary frames, see FrameStream
+#
+# With a token every request needs "Authorization: Bearer <token>" (or
+# ?token=<token> for the WebSocket). Frames go to MQTTController.publish_batch
+# like effect frames; a running effect on the device is stopped. Without a
+# token the API is only served to the local host, see allowed_without_token().
+
+
+class FrameStream:
+    # Applies the binary messages of one stream connection. A message holds
+    # one or more records
+    #   [id length: 1 byte][device id: UTF-8][LED count: 2 bytes, big endian][RGB: 3 bytes per LED]
+    # or, for a connection opened with ?device=<id>, just the RGB bytes of
+    # that device. The frames are copied from the message into the devices'
+    # frame buffers, nothing is allocated per LED. Frames whose LED count
+    # differs from the device's are skipped. A message is parsed as a whole
+    # before any frame is applied, so a malformed one changes nothing.
+
+    def __init__(self, mqtt_controller, device_id: str = None):
+        self.mqtt_controller = mqtt_controller
+        self.device_manager = mqtt_controller.device_manager
+        self.device_id = device_id
+        self._batch = {}  # device id -> device, the latest frame of a message wins
+        self.messages = 0
+        self.frames = 0
+        self.frames_skipped = 0  # unknown device or wrong LED count
+
+    def stats(self) -> dict:
+        return {
+            "messages": self.messages,
+            "frames": self.frames,
+            "frames_skipped": self.frames_skipped,
+        }
+
+    def feed(self, message) -> int:
+        # applies and publishes the frames of `message`, returns how many;
+        # raises ValueError if it is malformed (nothing is published then)
+        view = memoryview(message)
+        if self.device_id is not None:
+            records = [(self.device_id, view)]
+        else:
+            records = []
+            offset = 0
+            end = len(view)
+            while offset < end:
+                id_end = offset + 1 + view[offset]
+                if id_end + 2 > end:
+                    raise ValueError(f"Record at byte {offset} is truncated")
+                frame_end = id_end + 2 + 3 * (view[id_end] << 8 | view[id_end + 1])
+                if frame_end > end:
+                    raise ValueError(f"Record at byte {offset} is truncated")
+                # raises UnicodeDecodeError, a ValueError, for an invalid id
+                device_id = str(view[offset + 1 : id_end], "utf-8")
+                records.append((device_id, view[id_end + 2 : frame_end]))
+                offset = frame_end
+        batch = self._batch
+        batch.clear()
+        for device_id, frame in records:
+            self._apply(device_id, frame)
+        self.messages += 1
+        if batch:
+            self.mqtt_controller.publish_batch(batch.values())
+        return len(batch)
+
+    def _apply(self, device_id: str, frame) -> None:
+        device = self.device_manager.get_device(device_id)
+        if device is None or len(frame) != 3 * device.led_count:
+            self.frames_skipped += 1
+            return
+        self.mqtt_controller.effect_engine.stop(device_id)
+        device.set_frame(frame)
+        self._batch[device_id] = device
+        self.frames += 1
+
+
+def _frame_update(device, update: dict):
+    # (frame, None) or (None, {index: (r, g, b)}) for one device of a
+    # /api/frames request, raises ValueError or KeyError if it is invalid
+    if "frame" in update:
+        frame = bytes.fromhex(update["frame"])
+        if len(frame) != 3 * device.led_count:
+            raise ValueError(f"{device.device_id} has {device.led_count} LEDs")
+        return frame, None
+    if "color" in update:
+        return bytes(parse_color(update["color"])) * device.led_count, None
+    if "leds" in update:
+        leds = {}
+        for index, color in update["leds"].items():
+            index = int(index)
+            if not 0 <= index < device.led_count:
+                raise ValueError(f"{device.device_id} has no LED {index}")
+            leds[index] = parse_color(color)
+        return None, leds
+    raise ValueError(f"{device.device_id}: expected frame, color or leds")
+
+
+def allowed_without_token(host: str) -> bool:
+    # True if the UI listens on `host` only for the local host
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:  # a host name
+        return False
+
+
+def add_control_routes(app, mqtt_controller, token: str = "", prefix: str = "/api") -> None:
+    # serves the control API on the NiceGUI app
+    from fastapi import HTTPException, Request, WebSocket, WebSocketDisconnect
+    from fastapi.responses import JSONResponse
+
+    device_manager = mqtt_controller.device_manager
+
+    def not_found(detail: str) -> JSONResponse:
+        # NiceGUI answers a raised 404 with its HTML error page
+        return JSONResponse({"detail": detail}, status_code=404)
+
+    def authorized(headers, query_params) -> bool:
+        if not token:
+            return True
+        given = headers.get("authorization", "").removeprefix("Bearer ") or query_params.get(
+            "token", ""
+        )
+        return hmac.compare_digest(given.encode(), token.encode())
+
+    def check(request: Request) -> None:
+        if not authorized(request.headers, request.query_params):
+            raise HTTPException(401, "Invalid token")
+
+    async def read_json(request: Request) -> dict:
+        try:
+            body = loads(await request.body())
+        except ValueError:
+            raise HTTPException(400, "Invalid JSON")
+        if not isinstance(body, dict):
+            raise HTTPException(400, "Expected a JSON object")
+        return body
+
+    def device_info(device) -> dict:
+        return {
+            "id": device.device_id,
+            "led_count": device.led_count,
+            "online": device.online,
+            "groups": sorted(device.groups),
+        }
+
+    # every route is async, so it runs on the event loop that owns the
+    # devices and not in FastAPI's threadpool
+    @app.get(prefix + "/devices")
+    async def list_devices(request: Request):
+        check(request)
+        return [device_info(device) for device in device_manager.devices]
+
+    @app.get(prefix + "/devices/{device_id}")
+    async def get_device(device_id: str, request: Request):
+        check(request)
+        device = device_manager.get_device(device_id)
+        if device is None:
+            return not_found(f"Unknown device {device_id}")
+        return {**device_info(device), "frame": device.frame.hex()}
+
+    @app.post(prefix + "/frames")
+    async def set_frames(request: Request):
+        check(request)
+        updates = (await read_json(request)).get("devices")
+        if not isinstance(updates, dict):
+            raise HTTPException(400, 'Expected {"devices": {"<id>": {...}}}')
+        # everything is checked before any device is changed
+        changes = []
+        unknown = []
+        for device_id, update in updates.items():
+            device = device_manager.get_device(device_id)
+            if device is None:
+                unknown.append(device_id)
+                continue
+            try:
+                changes.append((device, *_frame_update(device, update)))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise HTTPException(400, f"Invalid update for {device_id}: {e}")
+
+        for device, frame, leds in changes:
+            mqtt_controller.effect_engine.stop(device.device_id)
+            if frame is not None:
+                device.set_frame(frame)
+            else:
+                for index, (red, green, blue) in leds.items():
+                    device.set_rgb(index, red, green, blue)
+                device.notify_lights_changed(list(leds))
+        mqtt_controller.publish_batch([change[0] for change in changes])
+        return {"updated": len(changes), "unknown": unknown}
+
+    @app.post(prefix + "/color")
+    async def set_color(request: Request):
+        check(request)
+        body = await read_json(request)
+        group = body.get("group")
+        if group is not None and group not in device_manager.groups:
+            return not_found(f"Unknown group {group}")
+        try:
+            color = parse_color(body["color"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HTTPException(400, "Invalid color")
+        return {"messages": mqtt_controller.set_group_color(color, group)}
+
+    @app.post(prefix + "/scenes/{name}")
+    async def apply_scene(name: str, request: Request):
+        check(request)
+        try:
+            return {"devices": mqtt_controller.scenes.apply(name)}
+        except KeyError:
+            return not_found(f"Unknown scene {name}")
+
+    @app.websocket(prefix + "/stream")
+    async def stream(websocket: WebSocket):
+        if not authorized(websocket.headers, websocket.query_params):
+            await websocket.close(code=1008)
+            return
+        await websocket.accept()
+        frame_stream = FrameStream(mqtt_controller, websocket.query_params.get("device"))
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                data = message.get("bytes")
+                if data is None:
+                    await websocket.close(code=1003, reason="Frames are sent as binary messages")
+                    break
+                try:
+                    frame_stream.feed(data)
+                except ValueError as e:
+                    logging.info(f"Closing frame stream: {e}")
+                    await websocket.close(code=1007, reason=str(e))
+                    break
+        except WebSocketDisconnect:
+            pass
+        logging.debug(f"Frame stream closed: {frame_stream.stats()}")
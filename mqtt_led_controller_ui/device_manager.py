@@ -1,15 +1,80 @@
+import contextlib
 import logging
 
+from change_events import Event
+from led_codec import changed_leds
+
+TEST_DEVICE_IDS = ("test1", "test2", "test3")  # the dummy devices of ADD_DUMMY_TEST_DEVICES
+
+_NAMED_COLORS = {
+    "black": (0, 0, 0),
+    "white": (255, 255, 255),
+    "red": (255, 0, 0),
+    "green": (0, 128, 0),
+    "lime": (0, 255, 0),
+    "blue": (0, 0, 255),
+    "yellow": (255, 255, 0),
+    "cyan": (0, 255, 255),
+    "magenta": (255, 0, 255),
+    "purple": (128, 0, 128),
+    "orange": (255, 165, 0),
+}
+
+
+def parse_color(color: str) -> tuple:
+    """Convert ``#rrggbb``, ``#rgb``, ``rgb(r, g, b)`` or a basic color name to (r, g, b)."""
+    color = color.strip().lower()
+    if color.startswith("#"):
+        hex_value = color[1:]
+        if len(hex_value) == 3:
+            hex_value = "".join(c * 2 for c in hex_value)
+        value = int(hex_value[:6], 16)
+        return value >> 16, (value >> 8) & 0xFF, value & 0xFF
+    if color.startswith("rgb"):
+        red, green, blue = color[color.index("(") + 1 : color.index(")")].split(",")[:3]
+        channels = int(red), int(green), int(blue)
+        if not all(0 <= channel <= 255 for channel in channels):
+            raise ValueError(f"Color channels must be 0-255: {color}")
+        return channels
+    return _NAMED_COLORS[color]
+
 
 class Device:
+    # The LED state is stored as a packed RGB buffer (3 bytes per LED).
+    # `lights` is only a lazily built list of "#rrggbb" strings for the UI.
+    __slots__ = (
+        "device_id",
+        "_online",
+        "_led_count",
+        "_frame",
+        "_lights_cache",
+        "_online_change_event",
+        "_manager",
+        "_events",
+        "groups",
+        "_capabilities",
+        "_retain",
+        "qos",
+        "last_seen",
+        "last_status",
+        "__weakref__",
+    )
+
     def __init__(self, device_id: str):
         self.device_id = device_id
         self._online = False
-        self._online_str = ""
         self._led_count = 1
-        self.lights = [str(i) for i in range(self._led_count)]
+        self._frame = bytearray(3 * self._led_count)
+        self._lights_cache = None
         self._online_change_event = None
-        self.retain = True
+        self._manager = None
+        self._events = None
+        self.groups = set()
+        self._capabilities = set()  # protocol features the device advertised in sts, e.g. "delta"
+        self._retain = True
+        self.qos = None  # QoS of the commands to this device, None: PUBLISH_QOS
+        self.last_seen = None  # time.monotonic() of the last message from the device
+        self.last_status = None  # (payload digest, frame) of the last sts applied
 
     @property
     def led_count(self):
@@ -19,7 +84,74 @@ class Device:
     def led_count(self, count: int):
         if self._led_count != count:
             self._led_count = count
-            self.lights = [str(i) for i in range(count)]
+            size = 3 * count
+            if size < len(self._frame):
+                del self._frame[size:]
+            else:
+                self._frame.extend(bytes(size - len(self._frame)))
+            self._lights_cache = None
+            self._emit("led_count", count)
+
+    @property
+    def frame(self) -> bytearray:
+        # packed RGB buffer, LED i is frame[3 * i : 3 * i + 3]
+        return self._frame
+
+    def set_frame(self, frame) -> None:
+        self.led_count = len(frame) // 3
+        if len(frame) == len(self._frame):
+            # bytearray slice assignment would copy `frame` into a temporary first
+            memoryview(self._frame)[:] = frame
+        else:
+            self._frame[:] = frame
+        self._lights_cache = None
+        self.notify_lights_changed()
+
+    def update_frame(self, frame) -> list:
+        # like set_frame() but returns the changed LEDs instead of emitting
+        self.led_count = len(frame) // 3
+        led_indices = changed_leds(self._frame, frame)
+        if led_indices:
+            self._frame[:] = frame
+            self._lights_cache = None
+        return led_indices
+
+    @property
+    def lights(self) -> list:
+        if self._lights_cache is None:
+            hex_frame = self._frame.hex()
+            self._lights_cache = [
+                "#" + hex_frame[i : i + 6] for i in range(0, len(hex_frame), 6)
+            ]
+        return self._lights_cache
+
+    @lights.setter
+    def lights(self, colors) -> None:
+        colors = list(colors)
+        self.led_count = len(colors)
+        for index, color in enumerate(colors):
+            self.update_lights(index, color)
+
+    @property
+    def capabilities(self) -> set:
+        return self._capabilities
+
+    @capabilities.setter
+    def capabilities(self, capabilities) -> None:
+        capabilities = set(capabilities)
+        if self._capabilities != capabilities:
+            self._capabilities = capabilities
+            self._emit("capabilities", capabilities)
+
+    @property
+    def retain(self) -> bool:
+        return self._retain
+
+    @retain.setter
+    def retain(self, retain: bool) -> None:
+        if self._retain != retain:
+            self._retain = retain
+            self._emit("retain", retain)
 
     @property
     def online(self):
@@ -36,33 +168,259 @@ class Device:
     def online(self, status: bool):
         if self._online != status:
             self._online = status
-            if self._online_change_event is not None:
-                self._online_change_event(status)
+            if self._manager is not None and self._manager._online_status_changed(self):
+                return  # notified at the end of the manager's online_batch()
+            self._notify_online()
+
+    def _notify_online(self) -> None:
+        if self._online_change_event is not None:
+            self._online_change_event(self._online)
+        self._emit("online", self._online)
 
     def update_lights(self, index: int, color: str):
         try:
-            self.lights[index] = color
-        except IndexError:
+            red, green, blue = parse_color(color)
+        except (ValueError, KeyError):
+            logging.info(f"Unknown color {color}")
+            return
+        if self.set_rgb(index, red, green, blue):
+            self.notify_lights_changed([index])
+
+    def notify_lights_changed(self, led_indices: list = None) -> None:
+        # emits the "lights" event with the changed LEDs (None: all LEDs),
+        # set_rgb() does not emit so that decoders can report a whole frame once
+        self._emit("lights", led_indices)
+
+    def set_rgb(self, index: int, red: int, green: int, blue: int) -> bool:
+        # returns True if the LED changed
+        if not 0 <= index < self._led_count:
             logging.info("Index out of range")
+            return False
+        offset = 3 * index
+        frame = self._frame
+        if frame[offset] == red and frame[offset + 1] == green and frame[offset + 2] == blue:
+            return False
+        frame[offset] = red
+        frame[offset + 1] = green
+        frame[offset + 2] = blue
+        self._lights_cache = None
+        return True
+
+    def get_rgb(self, index: int) -> tuple:
+        offset = 3 * index
+        return tuple(self._frame[offset : offset + 3])
+
+    def color_hex(self, index: int) -> str:
+        offset = 3 * index
+        return "#" + self._frame[offset : offset + 3].hex()
 
     def set_online_change_event(self, event):
         self._online_change_event = event
 
+    def subscribe(self, name: str, callback):
+        # calls callback(new_value) whenever the attribute `name` changes,
+        # returns a function that removes the subscription
+        if self._events is None:
+            self._events = {}
+        event = self._events.get(name)
+        if event is None:
+            event = self._events[name] = Event()
+        return event.subscribe(callback)
+
+    def _emit(self, name: str, value) -> None:
+        if self._events is not None:
+            event = self._events.get(name)
+            if event is not None:
+                event.emit(value)
+
 
 class DeviceManager:
+    # Devices are kept in a dict keyed by device_id (insertion ordered for the
+    # tabs). The online/offline and per-group indexes are updated from the
+    # Device.online setter, so lookups never scan the whole fleet.
+
     def __init__(self):
-        self.devices = []
+        self._devices: dict[str, Device] = {}
+        self._online: dict[str, Device] = {}
+        self._offline: dict[str, Device] = {}
+        self._groups: dict[str, dict[str, Device]] = {}
+        self._groups_online: dict[str, dict[str, Device]] = {}
         self.selected_device = None
+        self.device_added = Event()
+        self.device_removed = Event()
+        self.groups_changed = Event()  # emits the group names when a group is created or emptied
+        self.online_changed = Event()  # emits the devices that went online or offline, once per batch
+        self._online_batch = None
+
+    @property
+    def devices(self):
+        # ordered, read-only view of all devices (no copy)
+        return self._devices.values()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, device_id: str):
+        return device_id in self._devices
 
     def add_device(self, device: Device):
-        self.devices.append(device)
-        self.selected_device = device.device_id
+        if device.device_id in self._devices:
+            self.remove_device(device.device_id)
+        self._devices[device.device_id] = device
+        device._manager = self
+        for group in device.groups:
+            self._index_group_member(group, device)
+        self._update_online_index(device)
+        if self.selected_device is None:
+            self.selected_device = device.device_id
+        self.device_added.emit(device)
+
+    def remove_device(self, device_id: str):
+        device = self._devices.pop(device_id, None)
+        if device is None:
+            return None
+        device._manager = None
+        self._online.pop(device_id, None)
+        self._offline.pop(device_id, None)
+        for group in device.groups:
+            self._unindex_group_member(group, device_id)
+        if self.selected_device == device_id:
+            self.selected_device = next(iter(self._devices), None)
+        self.device_removed.emit(device)
+        return device
+
+    def get_device(self, device_id: str):
+        return self._devices.get(device_id)
+
+    def get_or_add_device(self, device_id: str):
+        """Return ``(device, created)`` for ``device_id``, adding it if unknown."""
+        device = self._devices.get(device_id)
+        if device is not None:
+            return device, False
+        device = Device(device_id)
+        self.add_device(device)
+        return device, True
 
     def list_devices(self):
-        for device in self.devices:
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return  # formatting the lights of a large fleet is not free
+        for device in self._devices.values():
             logging.info(
                 f"Device ID: {device.device_id}, Online: {device.online}, Lights: {device.lights}"
             )
 
-    def get_online_devices(self):
-        return [device for device in self.devices if device.online]
+    def get_online_devices(self, group: str = None):
+        if group is None:
+            return list(self._online.values())
+        return list(self._groups_online.get(group, {}).values())
+
+    def get_offline_devices(self):
+        return list(self._offline.values())
+
+    @property
+    def online_count(self):
+        return len(self._online)
+
+    @contextlib.contextmanager
+    def online_batch(self):
+        # the online changes made inside are reported at the end: one
+        # online_changed event instead of one per device, then the "online"
+        # event of every device, only for devices whose state differs from
+        # the one before the batch
+        if self._online_batch is not None:
+            yield
+            return
+        batch = self._online_batch = {}
+        try:
+            yield
+        finally:
+            self._online_batch = None
+            changed = [device for device, online in batch.values() if device.online != online]
+            if changed:
+                self.online_changed.emit(changed)
+                for device in changed:
+                    device._notify_online()
+
+    def set_online(self, devices, online: bool) -> None:
+        with self.online_batch():
+            for device in devices:
+                device.online = online
+
+    # groups
+
+    @property
+    def groups(self):
+        return self._groups.keys()
+
+    def add_to_group(self, device_id: str, group: str):
+        device = self._devices[device_id]
+        if group not in device.groups:
+            device.groups.add(group)
+            self._index_group_member(group, device)
+            device._emit("groups", device.groups)
+
+    def remove_from_group(self, device_id: str, group: str):
+        device = self._devices[device_id]
+        if group in device.groups:
+            device.groups.discard(group)
+            self._unindex_group_member(group, device_id)
+            device._emit("groups", device.groups)
+
+    def set_groups(self, device_id: str, groups):
+        # replaces the groups of a device, e.g. with the ones it reported in sts
+        device = self._devices[device_id]
+        groups = set(groups)
+        for group in device.groups - groups:
+            self.remove_from_group(device_id, group)
+        for group in groups - device.groups:
+            self.add_to_group(device_id, group)
+
+    def get_group_devices(self, group: str = None):
+        # all devices of `group`, every device if group is None
+        if group is None:
+            return list(self._devices.values())
+        return list(self._groups.get(group, {}).values())
+
+    def _index_group_member(self, group: str, device: Device):
+        created = group not in self._groups
+        self._groups.setdefault(group, {})[device.device_id] = device
+        online_members = self._groups_online.setdefault(group, {})
+        if device.online:
+            online_members[device.device_id] = device
+        if created:
+            self.groups_changed.emit(list(self._groups))
+
+    def _unindex_group_member(self, group: str, device_id: str):
+        members = self._groups.get(group)
+        if members is None:
+            return
+        members.pop(device_id, None)
+        self._groups_online[group].pop(device_id, None)
+        if not members:
+            del self._groups[group]
+            del self._groups_online[group]
+            self.groups_changed.emit(list(self._groups))
+
+    def _online_status_changed(self, device: Device) -> bool:
+        # returns True if the device's own notifications wait for the batch
+        self._update_online_index(device)
+        if self._online_batch is not None:
+            # the state before the batch, the first change of the device saw it
+            self._online_batch.setdefault(device.device_id, (device, not device.online))
+            return True
+        if self.online_changed:
+            self.online_changed.emit([device])
+        return False
+
+    def _update_online_index(self, device: Device):
+        device_id = device.device_id
+        if device.online:
+            self._offline.pop(device_id, None)
+            self._online[device_id] = device
+            for group in device.groups:
+                self._groups_online[group][device_id] = device
+        else:
+            self._online.pop(device_id, None)
+            self._offline[device_id] = device
+            for group in device.groups:
+                self._groups_online[group].pop(device_id, None)
@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+
+import paho.mqtt.client as mqtt
+from led_codec import encode_lights
+from mqtt_transport import AsyncioMQTTTransport
+
+# Simulated ESP32 LED controllers that speak the real protocol: each device
+# subscribes to lightstrips/<id>/cmd (and the broadcast/group topics if it
+# has the "broadcast" capability), publishes its state on lightstrips/<id>/sts
+# after a configurable processing delay and announces itself on
+# lightstrips/<id>/last-will. With a heartbeat interval they also publish on
+# lightstrips/<id>/heartbeat. The devices either connect to a real broker
+# (one paho client per device, all on one asyncio loop) or to an
+# InProcessBroker, which needs no network at all.
+
+topic_main = "lightstrips"
+
+
+class _Message:
+    __slots__ = ("topic", "payload", "retain", "qos")
+
+    def __init__(self, topic: str, payload: bytes, retain: bool = False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.qos = 0
+
+
+class InProcessClient:
+    # The part of the paho client API used by MQTTController and the devices
+
+    def __init__(self, broker, client_id: str):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_disconnect = None
+        self._connected = False
+        self._will = None
+        self._mid = 0
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self._will = _Message(topic, _to_bytes(payload), retain)
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def connect(self, *args, **kwargs):
+        self._connected = True
+        if self.on_connect is not None:
+            self.broker.loop.call_soon(self.on_connect, self, None, {}, 0)
+
+    def disconnect(self):
+        # a clean disconnect, the will is discarded
+        self._will = None
+        self._close()
+
+    def drop(self):
+        # an unexpected connection loss, the broker publishes the will
+        will, self._will = self._will, None
+        self._close()
+        if will is not None:
+            self.broker.publish(will.topic, will.payload, will.retain)
+
+    def _close(self):
+        if not self._connected:
+            return
+        self._connected = False
+        self.broker.unsubscribe_all(self)
+        if self.on_disconnect is not None:
+            self.broker.loop.call_soon(self.on_disconnect, self, None, 0)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self.broker.subscribe(self, topic)
+        self._mid += 1
+        if self.on_subscribe is not None:
+            self.broker.loop.call_soon(self.on_subscribe, self, None, self._mid, (qos,))
+        return mqtt.MQTT_ERR_SUCCESS, self._mid
+
+    def max_inflight_messages_set(self, inflight: int):
+        pass
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self._mid += 1
+        info = mqtt.MQTTMessageInfo(self._mid)
+        if not self._connected:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+        self.broker.publish(topic, _to_bytes(payload), retain)
+        if self.on_publish is not None:
+            if qos and self.broker.ack_delay:
+                # QoS 1 is acknowledged after the round trip to the broker
+                self.broker.loop.call_later(self.broker.ack_delay, self.on_publish, self, None, self._mid)
+            else:
+                self.broker.loop.call_soon(self.on_publish, self, None, self._mid)
+        return info
+
+
+def _to_bytes(payload) -> bytes:
+    if payload is None:
+        return b""
+    if isinstance(payload, str):
+        return payload.encode()
+    return bytes(payload)
+
+
+class InProcessBroker:
+    # Stand-in for an MQTT broker inside one process. Messages are delivered
+    # with loop.call_soon, so publishing never calls back into the publisher.
+    # Exact topic subscriptions (all devices) are looked up in a dict, only
+    # wildcard subscriptions (the UI) are matched one by one. QoS 1 messages
+    # are acknowledged `ack_delay` seconds after they were published.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, ack_delay: float = 0.0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.ack_delay = ack_delay
+        self._exact = {}
+        self._wildcards = []
+        self._retained = {}
+        self.messages_published = 0
+        self.messages_delivered = 0
+
+    def client(self, client_id: str = "") -> InProcessClient:
+        return InProcessClient(self, client_id)
+
+    def subscribe(self, client: InProcessClient, topic: str) -> None:
+        if "+" in topic or "#" in topic:
+            self._wildcards.append((topic, client))
+            retained = [
+                message
+                for retained_topic, message in self._retained.items()
+                if mqtt.topic_matches_sub(topic, retained_topic)
+            ]
+        else:
+            self._exact.setdefault(topic, []).append(client)
+            retained = [self._retained[topic]] if topic in self._retained else []
+        for message in retained:
+            self._deliver(client, message)
+
+    def unsubscribe_all(self, client: InProcessClient) -> None:
+        self._wildcards = [(topic, c) for topic, c in self._wildcards if c is not client]
+        for topic, clients in list(self._exact.items()):
+            if client in clients:
+                clients.remove(client)
+                if not clients:
+                    del self._exact[topic]
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False) -> None:
+        self.messages_published += 1
+        if retain:
+            if payload:
+                self._retained[topic] = _Message(topic, payload, True)
+            else:
+                self._retained.pop(topic, None)
+        message = _Message(topic, payload)
+        for client in self._exact.get(topic, ()):
+            self._deliver(client, message)
+        for subscription, client in self._wildcards:
+            if mqtt.topic_matches_sub(subscription, topic):
+                self._deliver(client, message)
+
+    def _deliver(self, client: InProcessClient, message: _Message) -> None:
+        if client.on_message is not None:
+            self.messages_delivered += 1
+            self.loop.call_soon(client.on_message, client, None, message)
+
+    def connect_controller(self, mqtt_controller) -> InProcessClient:
+        # puts an MQTTController on this broker instead of the network
+        mqtt_controller.client = client = self.client("mqtt-led-controller-ui")
+        mqtt_controller._loop = self.loop
+        mqtt_controller._setup_client()
+        client.connect()
+        return client
+
+
+class SimulatedDevice:
+    def __init__(
+        self,
+        device_id: str,
+        led_count: int = 12,
+        capabilities=(),
+        groups=(),
+        delay: float = 0.0,
+        jitter: float = 0.0,
+        drop_rate: float = 0.0,
+        rng: random.Random = None,
+    ):
+        self.device_id = device_id
+        self.frame = bytearray(3 * led_count)
+        self.capabilities = list(capabilities)
+        self.groups = list(groups)
+        self.delay = delay
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.rng = rng or random.Random()
+        self.client = None
+        self.loop = None
+        self.hung = False  # keeps the connection but ignores commands and sends no heartbeats
+
+        self.cmd_topic = f"{topic_main}/{device_id}/cmd"
+        self.sts_topic = f"{topic_main}/{device_id}/sts"
+        self.last_will_topic = f"{topic_main}/{device_id}/last-will"
+        self.heartbeat_topic = f"{topic_main}/{device_id}/heartbeat"
+
+        self.commands_received = 0
+        self.commands_dropped = 0
+        self.status_sent = 0
+        self.heartbeats_sent = 0
+
+    @property
+    def subscriptions(self) -> list:
+        topics = [self.cmd_topic]
+        if "broadcast" in self.capabilities:
+            topics.append(f"{topic_main}/cmd/all")
+            topics.extend(f"{topic_main}/cmd/{group}" for group in self.groups)
+        return topics
+
+    def attach(self, client, loop: asyncio.AbstractEventLoop) -> None:
+        self.client = client
+        self.loop = loop
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        client.will_set(self.last_will_topic, "offline", retain=True)
+
+    def status_payload(self) -> str:
+        return '{"capabilities":%s,"groups":%s,"lights":%s}' % (
+            json.dumps(self.capabilities),
+            json.dumps(self.groups),
+            encode_lights(self.frame),
+        )
+
+    def publish_status(self, payload: str = None) -> None:
+        self.status_sent += 1
+        self.client.publish(self.sts_topic, payload or self.status_payload())
+
+    def send_heartbeat(self) -> None:
+        if not self.hung and self.client is not None and self.client.is_connected():
+            self.heartbeats_sent += 1
+            self.client.publish(self.heartbeat_topic, b"")
+
+    def apply_command(self, payload: bytes) -> bool:
+        # full frames replace the state, deltas only touch the listed LEDs
+        try:
+            data = json.loads(payload)
+            lights = data["lights"]
+            if not data.get("delta"):
+                self.frame[:] = bytes(len(self.frame))
+            for led_index, color_data in lights.items():
+                offset = 3 * int(led_index)
+                if offset < len(self.frame):
+                    self.frame[offset : offset + 3] = bytes(
+                        (color_data["red"], color_data["green"], color_data["blue"])
+                    )
+        except (json.JSONDecodeError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return True
+
+    def _on_connect(self, client, userdata, flags, rc):
+        for topic in self.subscriptions:
+            client.subscribe(topic)
+        client.publish(self.last_will_topic, "online", retain=True)
+        self.publish_status()
+
+    def _on_message(self, client, userdata, msg):
+        self.commands_received += 1
+        if self.hung:
+            return
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.commands_dropped += 1
+            return
+        if not self.apply_command(msg.payload):
+            return
+        delay = self.delay
+        if self.jitter:
+            delay = max(0.0, delay + self.rng.uniform(-self.jitter, self.jitter))
+        if delay:
+            # the reported state is the one after this command, even if more
+            # commands arrive while it is being "processed"
+            self.loop.call_later(delay, self.publish_status, self.status_payload())
+        else:
+            self.publish_status()
+
+
+class DeviceFleet:
+    def __init__(
+        self,
+        count: int,
+        led_count: int = 12,
+        capabilities=(),
+        groups: int = 0,
+        delay: float = 0.0,
+        jitter: float = 0.0,
+        drop_rate: float = 0.0,
+        id_prefix: str = "sim",
+        seed: int = None,
+        heartbeat_interval: float = 0.0,
+    ):
+        rng = random.Random(seed)
+        self.heartbeat_interval = heartbeat_interval
+        self.devices = [
+            SimulatedDevice(
+                f"{id_prefix}-{i:05d}",
+                led_count,
+                capabilities,
+                [f"group-{i % groups}"] if groups else (),
+                delay,
+                jitter,
+                drop_rate,
+                rng,
+            )
+            for i in range(count)
+        ]
+        self._transports = []
+        self._heartbeat_task = None
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self.devices),
+            "commands_received": sum(d.commands_received for d in self.devices),
+            "commands_dropped": sum(d.commands_dropped for d in self.devices),
+            "status_sent": sum(d.status_sent for d in self.devices),
+            "heartbeats_sent": sum(d.heartbeats_sent for d in self.devices),
+        }
+
+    def start_in_process(self, broker: InProcessBroker) -> None:
+        for device in self.devices:
+            client = broker.client(device.device_id)
+            device.attach(client, broker.loop)
+            client.connect()
+        self._start_heartbeats(broker.loop)
+
+    async def start_mqtt(
+        self,
+        host: str,
+        port: int,
+        username: str = "",
+        password: str = "",
+        max_concurrent_connects: int = 50,
+    ) -> None:
+        # every device gets its own connection, so the broker handles the
+        # last wills exactly like for real hardware
+        loop = asyncio.get_running_loop()
+        connect_slots = asyncio.Semaphore(max_concurrent_connects)
+
+        async def connect(device: SimulatedDevice):
+            client = mqtt.Client(device.device_id)
+            client.username_pw_set(username, password)
+            device.attach(client, loop)
+            transport = AsyncioMQTTTransport(client, loop)
+            self._transports.append(transport)
+            async with connect_slots:
+                try:
+                    await transport.connect(host, port)
+                except OSError as e:
+                    logging.error(f"Simulated device {device.device_id} could not connect: {e}")
+
+        await asyncio.gather(*(connect(device) for device in self.devices))
+        self._start_heartbeats(loop)
+
+    def _start_heartbeats(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.heartbeat_interval > 0 and self._heartbeat_task is None:
+            self._heartbeat_task = loop.create_task(self._send_heartbeats())
+
+    async def _send_heartbeats(self, steps: int = 10) -> None:
+        # one task for the fleet, every step a tenth of the devices
+        for step in itertools.cycle(range(steps)):
+            await asyncio.sleep(self.heartbeat_interval / steps)
+            for device in self.devices[step::steps]:
+                device.send_heartbeat()
+
+    def stop(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        for device in self.devices:
+            if device.client is not None and device.client.is_connected():
+                device.client.publish(device.last_will_topic, "offline", retain=True)
+        for transport in self._transports:
+            transport.disconnect()
+        self._transports.clear()
+        for device in self.devices:
+            if isinstance(device.client, InProcessClient):
+                device.client.disconnect()
+
+
+async def _run_cli(args) -> None:
+    fleet = DeviceFleet(
+        args.devices,
+        args.leds,
+        args.capabilities,
+        args.groups,
+        args.delay,
+        args.jitter,
+        args.drop_rate,
+        args.prefix,
+        args.seed,
+        args.heartbeat,
+    )
+    await fleet.start_mqtt(args.broker, args.port, args.username, args.password)
+    print(f"{args.devices} simulated devices connected to {args.broker}:{args.port}")
+    try:
+        while True:
+            await asyncio.sleep(args.report_interval)
+            print(", ".join(f"{key}: {value}" for key, value in fleet.stats().items()))
+    finally:
+        fleet.stop()
+        await asyncio.sleep(0.5)  # let the offline messages go out
+
+
+def main():
+    from settings import BROKER_ADRESS, BROKER_PASSWORD, BROKER_PORT, BROKER_USERNAME
+
+    parser = argparse.ArgumentParser(description="Simulate ESP32 LED controllers")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--leds", type=int, default=12)
+    parser.add_argument("--capabilities", nargs="*", default=[], help="e.g. delta broadcast")
+    parser.add_argument("--groups", type=int, default=0, help="spread the devices over N groups")
+    parser.add_argument("--delay", type=float, default=0.005, help="seconds to process a command")
+    parser.add_argument("--jitter", type=float, default=0.002, help="+/- seconds on the delay")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of commands ignored")
+    parser.add_argument("--prefix", default="sim", help="device id prefix")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--heartbeat", type=float, default=0.0, help="seconds between heartbeats (0: none)")
+    parser.add_argument("--broker", default=BROKER_ADRESS)
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    parser.add_argument("--username", default=BROKER_USERNAME)
+    parser.add_argument("--password", default=BROKER_PASSWORD)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(_run_cli(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
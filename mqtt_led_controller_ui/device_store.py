@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+
+from device_manager import Device, DeviceManager
+
+# Snapshot of the device registry (LED count, last known colors, online
+# state, groups, ...) in a local SQLite file. It is loaded before the UI
+# starts, so the tabs are there on the first page load, and written every
+# `interval` seconds with only the devices that changed since the last write.
+# The writes run in a worker thread. Restored devices keep their last known
+# state until the broker reports otherwise; devices that stay silent for
+# `reconcile_timeout` seconds after connecting are marked offline.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY,
+    led_count INTEGER NOT NULL,
+    frame BLOB NOT NULL,
+    online INTEGER NOT NULL,
+    groups TEXT NOT NULL,
+    capabilities TEXT NOT NULL,
+    retain INTEGER NOT NULL,
+    status_digest BLOB
+)
+"""
+_COLUMNS = "device_id, led_count, frame, online, groups, capabilities, retain, status_digest"
+
+
+def device_row(device: Device) -> tuple:
+    last_status = device.last_status
+    # the digest only helps if the frame still is the state of that sts
+    digest = (
+        last_status[0]
+        if last_status is not None and last_status[1] == device.frame
+        else None
+    )
+    return (
+        device.device_id,
+        device.led_count,
+        bytes(device.frame),
+        int(device.online),
+        json.dumps(sorted(device.groups)),
+        json.dumps(sorted(device.capabilities)),
+        int(device.retain),
+        digest,
+    )
+
+
+def device_from_row(row) -> Device:
+    device_id, led_count, frame, online, groups, capabilities, retain, digest = row
+    device = Device(device_id)
+    device.led_count = led_count
+    device.frame[:] = frame
+    device.online = bool(online)
+    device.groups = set(json.loads(groups))
+    device.capabilities = set(json.loads(capabilities))
+    device.retain = bool(retain)
+    if digest is not None:
+        device.last_status = (digest, bytes(frame))
+    return device
+
+
+# the per-device attributes a row is built from, see Device.subscribe()
+_WATCHED = ("lights", "led_count", "online", "groups", "capabilities", "retain")
+
+
+class DeviceStore:
+    # Only the devices that emitted a change since the last save are turned
+    # into rows, so a save costs nothing for the silent part of the fleet.
+    # Devices whose id is in `exclude` (the dummy test devices) are never
+    # written, and rows of them left by an older version are deleted.
+
+    def __init__(
+        self,
+        device_manager: DeviceManager,
+        path: str,
+        interval: float = 10.0,
+        reconcile_timeout: float = 10.0,
+        exclude=(),
+    ):
+        self.device_manager = device_manager
+        self.path = path
+        self.interval = interval
+        self.reconcile_timeout = reconcile_timeout
+        self.exclude = frozenset(exclude)
+        self._connection = None
+        self._lock = threading.Lock()  # one write at a time, also from stop()
+        self._dirty = {}  # device_id -> device changed since the last save
+        self._removed = set()  # device ids to delete on the next save
+        self._unsubscribe = {}  # device_id -> functions removing the subscriptions
+        self._restored = set()  # restored devices not heard from since
+        self._task = None
+        self.saves = 0
+        self.rows_written = 0
+        device_manager.device_added.subscribe(self._on_device_added)
+        device_manager.device_removed.subscribe(self._on_device_removed)
+        for device in device_manager.devices:
+            self._on_device_added(device)
+
+    def _on_device_added(self, device: Device) -> None:
+        device_id = device.device_id
+        if device_id in self.exclude:
+            return
+
+        def changed(_value):
+            self._dirty[device_id] = device
+
+        self._unsubscribe[device_id] = [device.subscribe(name, changed) for name in _WATCHED]
+        self._removed.discard(device_id)
+        self._dirty[device_id] = device
+
+    def _on_device_removed(self, device: Device) -> None:
+        device_id = device.device_id
+        for unsubscribe in self._unsubscribe.pop(device_id, ()):
+            unsubscribe()
+        self._dirty.pop(device_id, None)
+        if device_id not in self.exclude:
+            self._removed.add(device_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(_SCHEMA)
+        return self._connection
+
+    def load(self) -> int:
+        # adds the stored devices that are not known yet, returns their number
+        try:
+            with self._lock:
+                rows = self._connect().execute(f"SELECT {_COLUMNS} FROM devices").fetchall()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not load the device store {self.path}: {e}")
+            return 0
+
+        restored = 0
+        for row in rows:
+            device_id = row[0]
+            if device_id in self.exclude:
+                self._removed.add(device_id)
+                continue
+            if device_id in self.device_manager:
+                continue
+            self.device_manager.add_device(device_from_row(row))
+            del self._dirty[device_id]  # the row is what was just read
+            self._restored.add(device_id)
+            restored += 1
+        logging.info(f"Restored {restored} devices from {self.path}")
+        return restored
+
+    def _changes(self):
+        dirty, self._dirty = self._dirty, {}
+        removed, self._removed = self._removed, set()
+        return [device_row(device) for device in dirty.values()], [(device_id,) for device_id in removed]
+
+    def _changes_failed(self, changed: list, removed: list) -> None:
+        # the rows were not written, they are written with the next save
+        for row in changed:
+            device = self.device_manager.get_device(row[0])
+            if device is not None:
+                self._dirty.setdefault(row[0], device)
+        for (device_id,) in removed:
+            if device_id not in self.device_manager or device_id in self.exclude:
+                self._removed.add(device_id)
+
+    def _write(self, changed: list, removed: list) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:  # one transaction
+                if changed:
+                    connection.executemany(
+                        f"INSERT OR REPLACE INTO devices ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        changed,
+                    )
+                if removed:
+                    connection.executemany("DELETE FROM devices WHERE device_id = ?", removed)
+
+    def save(self) -> int:
+        # writes the devices that changed since the last save, returns their number
+        changed, removed = self._changes()
+        if changed or removed:
+            try:
+                self._write(changed, removed)
+            except sqlite3.Error:
+                self._changes_failed(changed, removed)
+                raise
+        self.saves += 1
+        self.rows_written += len(changed)
+        return len(changed)
+
+    async def save_async(self) -> int:
+        # the rows are built on the event loop, only the write is in a thread
+        changed, removed = self._changes()
+        if changed or removed:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, changed, removed)
+            except sqlite3.Error:
+                self._changes_failed(changed, removed)
+                raise
+        self.saves += 1
+        self.rows_written += len(changed)
+        return len(changed)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            self.save()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not save the device store {self.path}: {e}")
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+                self._connection = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save_async()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not save the device store {self.path}: {e}")
+
+    def on_connection_changed(self, connected: bool) -> None:
+        # subscribe to MQTTController.connection_changed
+        if connected and self._restored:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # connected from paho's thread, no loop to wait on
+                return
+            loop.call_later(self.reconcile_timeout, self.reconcile)
+
+    def reconcile(self) -> int:
+        # marks restored devices offline that sent nothing since the start,
+        # the broker has no retained state for them; one online_changed event
+        get_device = self.device_manager.get_device
+        stale = [
+            device
+            for device in map(get_device, self._restored)
+            if device is not None and device.last_seen is None and device.online
+        ]
+        self._restored.clear()
+        self.device_manager.set_online(stale, False)
+        if stale:
+            logging.info(f"{len(stale)} restored devices did not report back, marked offline")
+        return len(stale)
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import math
+from collections import OrderedDict
+
+from settings import EFFECT_CACHE_BUDGET
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, the effects fall back to pure Python
+    np = None
+
+
+# Effects render all frames of one period for a given LED count at once
+# (vectorized with NumPy when it is installed). The frames are packed RGB
+# bytes and cached up to EFFECT_CACHE_BUDGET bytes, so playing an effect
+# again does no per-LED work at all.
+
+EFFECTS = {}
+
+
+def register_effect(name: str):
+    def decorator(function):
+        EFFECTS[name] = function
+        return function
+
+    return decorator
+
+
+class FrameCache:
+    # Rendered frames by (effect, LED count, parameters), least recently used
+    # first. Bounded by the bytes of the frames, not by entries: one chase
+    # over 1,000 LEDs alone is 3 MB. Frames bigger than the whole budget are
+    # not cached.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self._frames = OrderedDict()
+
+    def get(self, key):
+        frames = self._frames.get(key)
+        if frames is not None:
+            self._frames.move_to_end(key)
+        return frames
+
+    def put(self, key, frames: tuple) -> None:
+        size = sum(len(frame) for frame in frames)
+        if size > self.max_bytes:
+            return
+        old = self._frames.pop(key, None)
+        if old is not None:
+            self.bytes_used -= sum(len(frame) for frame in old)
+        self._frames[key] = frames
+        self.bytes_used += size
+        while self.bytes_used > self.max_bytes:
+            _, evicted = self._frames.popitem(last=False)
+            self.bytes_used -= sum(len(frame) for frame in evicted)
+
+    def clear(self) -> None:
+        self._frames.clear()
+        self.bytes_used = 0
+
+
+frame_cache = FrameCache(EFFECT_CACHE_BUDGET)
+
+
+def render_effect(name: str, led_count: int, **params) -> tuple:
+    # colors must be passed as (r, g, b) tuples so that the frames can be cached
+    if name not in EFFECTS:
+        raise KeyError(f"Unknown effect {name}")
+    key = (name, led_count, tuple(sorted(params.items())))
+    frames = frame_cache.get(key)
+    if frames is None:
+        frames = tuple(EFFECTS[name](led_count, **params))
+        frame_cache.put(key, frames)
+    return frames
+
+
+@register_effect("solid")
+def solid(led_count: int, color: tuple = (0, 0, 0)) -> list:
+    return [bytes(color) * led_count]
+
+
+@register_effect("chase")
+def chase(led_count: int, colors: tuple = ((255, 0, 0),)) -> list:
+    # one LED after the other, each in the next color of `colors`; a single
+    # frame is lit and copied LED by LED, which beats a led_count x led_count
+    # NumPy array in time and memory at large LED counts
+    frame = bytearray(3 * led_count)
+    frames = []
+    for i in range(led_count):
+        frame[3 * i : 3 * i + 3] = colors[i % len(colors)]
+        frames.append(bytes(frame))
+        frame[3 * i : 3 * i + 3] = b"\0\0\0"
+    return frames
+
+
+@register_effect("wipe")
+def wipe(
+    led_count: int, colors: tuple = ((255, 0, 0), (0, 255, 0), (0, 0, 255))
+) -> list:
+    # fills the strip LED by LED with a color and turns it off again
+    frames = []
+    for color in colors:
+        lit = bytes(color)
+        frames.extend(
+            lit * (i + 1) + bytes(3 * (led_count - i - 1)) for i in range(led_count)
+        )
+        frames.extend(
+            bytes(3 * (i + 1)) + lit * (led_count - i - 1) for i in range(led_count)
+        )
+    return frames
+
+
+@register_effect("rainbow")
+def rainbow(led_count: int, period: int = 60) -> list:
+    # a hue gradient over the strip that moves once around in `period` frames
+    if period <= 0:
+        raise ValueError(f"period must be positive, got {period}")
+    if np is not None:
+        hue = (
+            np.arange(led_count)[None, :] / led_count
+            + np.arange(period)[:, None] / period
+        ) % 1.0
+        h6 = hue[..., None] * 6.0 - np.array([3.0, 2.0, 4.0])
+        sign = np.array([1.0, -1.0, -1.0])
+        offset = np.array([-1.0, 2.0, 2.0])
+        rgb = np.clip(sign * np.abs(h6) + offset, 0.0, 1.0)
+        frames = (rgb * 255).astype(np.uint8)
+        return [frame.tobytes() for frame in frames]
+
+    frames = []
+    for step in range(period):
+        frame = bytearray(3 * led_count)
+        for i in range(led_count):
+            h6 = ((i / led_count + step / period) % 1.0) * 6.0
+            frame[3 * i] = int(min(max(abs(h6 - 3.0) - 1.0, 0.0), 1.0) * 255)
+            frame[3 * i + 1] = int(min(max(2.0 - abs(h6 - 2.0), 0.0), 1.0) * 255)
+            frame[3 * i + 2] = int(min(max(2.0 - abs(h6 - 4.0), 0.0), 1.0) * 255)
+        frames.append(bytes(frame))
+    return frames
+
+
+@register_effect("fade")
+def fade(led_count: int, color: tuple = (255, 255, 255), period: int = 60) -> list:
+    # the whole strip fades in and out once per `period` frames
+    if period <= 0:
+        raise ValueError(f"period must be positive, got {period}")
+    levels = [(1 - math.cos(2 * math.pi * step / period)) / 2 for step in range(period)]
+    return [
+        bytes(int(channel * level) for channel in color) * led_count for level in levels
+    ]
+
+
+class _Playback:
+    __slots__ = ("device", "frames", "start_tick", "frame_rate", "end_frame", "last_frame", "done")
+
+    def __init__(self, device, frames, start_tick, frame_rate, end_frame, done):
+        self.device = device
+        self.frames = frames
+        self.start_tick = start_tick
+        self.frame_rate = frame_rate
+        self.end_frame = end_frame
+        self.last_frame = -1
+        self.done = done
+
+
+class EffectEngine:
+    # Plays effects on many devices from one fixed timestep clock. Every tick
+    # is scheduled against the clock's start time, so sleeping late does not
+    # accumulate drift; ticks that are already over are skipped instead of
+    # being caught up. All devices that got a new frame in a tick are handed
+    # to `publish_batch` together.
+
+    def __init__(self, publish_batch, fps: float = 30.0):
+        self._publish_batch = publish_batch
+        self.fps = fps
+        self._playbacks = {}
+        self._task = None
+        self._tick = 0
+
+        self.ticks = 0
+        self.ticks_skipped = 0
+        self.frames_published = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def active_devices(self) -> int:
+        return len(self._playbacks)
+
+    def stats(self) -> dict:
+        return {
+            "active_devices": self.active_devices,
+            "ticks": self.ticks,
+            "ticks_skipped": self.ticks_skipped,
+            "frames_published": self.frames_published,
+        }
+
+    def play(self, device, effect: str, cycles: int = None, frame_rate: float = None, **params):
+        # starts `effect` on `device` (replacing a running one) and returns a
+        # future that completes after `cycles` periods (never if None)
+        frames = render_effect(effect, device.led_count, **params) if device.led_count else ()
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.stop(device.device_id)
+        if not frames:
+            # e.g. a device that has not reported its LED count yet
+            logging.info(f"Effect {effect} has no frames for {device.led_count} LEDs of {device.device_id}")
+            done.set_result(False)
+            return done
+        end_frame = None if cycles is None else cycles * len(frames)
+
+        start_tick = self._tick if self.running else 0
+        self._playbacks[device.device_id] = _Playback(
+            device, frames, start_tick, frame_rate or self.fps, end_frame, done
+        )
+        if not self.running:
+            self._task = loop.create_task(self._run())
+        return done
+
+    def stop(self, device_id: str) -> None:
+        playback = self._playbacks.pop(device_id, None)
+        if playback is not None and not playback.done.done():
+            playback.done.set_result(False)
+
+    def stop_all(self) -> None:
+        for device_id in list(self._playbacks):
+            self.stop(device_id)
+
+    def render_tick(self, tick: int) -> None:
+        batch = []
+        finished = []
+        failed = []
+        for playback in self._playbacks.values():
+            frame_index = int((tick - playback.start_tick) * playback.frame_rate / self.fps)
+            if playback.end_frame is not None and frame_index >= playback.end_frame:
+                finished.append(playback)
+            elif frame_index != playback.last_frame:
+                playback.last_frame = frame_index
+                # one failing device must not stop the clock for the others
+                try:
+                    playback.device.set_frame(playback.frames[frame_index % len(playback.frames)])
+                except Exception:
+                    logging.exception(f"Playing an effect on {playback.device.device_id} failed")
+                    failed.append(playback)
+                    continue
+                batch.append(playback.device)
+
+        if batch:
+            try:
+                self._publish_batch(batch)
+            except Exception:
+                logging.exception("Publishing effect frames failed")
+            self.frames_published += len(batch)
+        for playback in finished:
+            del self._playbacks[playback.device.device_id]
+            if not playback.done.done():
+                playback.done.set_result(True)
+        for playback in failed:
+            self.stop(playback.device.device_id)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self._tick = 0
+        while self._playbacks:
+            due_tick = int((loop.time() - start) * self.fps)
+            if due_tick > self._tick:
+                self.ticks_skipped += due_tick - self._tick
+                self._tick = due_tick
+            self.render_tick(self._tick)
+            self.ticks += 1
+            self._tick += 1
+            await asyncio.sleep(max(0.0, start + self._tick / self.fps - loop.time()))
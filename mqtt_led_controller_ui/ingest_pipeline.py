@@ -0,0 +1,94 @@
+import asyncio
+import collections
+import logging
+
+
+class IngestPipeline:
+    # Bounded queue between the MQTT network callbacks and the event loop.
+    # Messages are drained in batches once per render tick. Within a batch
+    # only the last payload per topic (= per device and message type) is
+    # handed on, so the work per tick grows with the number of changed
+    # devices instead of the number of received messages. The batch is
+    # ordered by the last message of each topic, so e.g. an sts after a
+    # last will of the same device is still applied after it.
+
+    def __init__(
+        self,
+        handle_batch,
+        max_queue_size: int = 10000,
+        interval: float = 0.05,
+        max_batch_size: int = 10000,
+    ):
+        self._handle_batch = handle_batch
+        # a full deque drops its oldest message on append, the one most
+        # likely to be superseded
+        self._queue = collections.deque(maxlen=max_queue_size)
+        self.max_queue_size = max_queue_size
+        self.interval = interval
+        self.max_batch_size = max_batch_size
+        self._task = None
+
+        self.messages_received = 0
+        self.messages_dropped = 0
+        self.messages_deduplicated = 0
+        self.batches = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "messages_received": self.messages_received,
+            "messages_dropped": self.messages_dropped,
+            "messages_deduplicated": self.messages_deduplicated,
+            "batches": self.batches,
+        }
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.drain()
+
+    def put(self, topic: str, payload: bytes) -> None:
+        # called from the network callbacks, possibly on paho's thread. Only
+        # drain() takes messages off the queue, deque appends and pops are
+        # thread-safe.
+        self.messages_received += 1
+        if len(self._queue) == self.max_queue_size:
+            self.messages_dropped += 1
+        self._queue.append((topic, payload))
+
+    def drain(self) -> int:
+        count = min(len(self._queue), self.max_batch_size)
+        if count == 0:
+            return 0
+        batch = {}
+        pop = batch.pop
+        popleft = self._queue.popleft
+        for _ in range(count):
+            topic, payload = popleft()
+            pop(topic, None)  # moves the topic to the position of its last message
+            batch[topic] = payload
+        self.messages_deduplicated += count - len(batch)
+        self.batches += 1
+        try:
+            self._handle_batch(batch)
+        except Exception:
+            logging.exception("Handling a batch of MQTT messages failed")
+        return count
+
+    async def _run(self) -> None:
+        while True:
+            self.drain()
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import math
+import statistics
+import time
+
+# Round trip latency of a device: every probe sets one LED to a color that is
+# unique to the probe, publishes the frame and completes when an sts message
+# of the device reports that color. Probes are matched on arrival of the
+# message (before the ingest pipeline batches it), so waiting costs nothing
+# and up to `in_flight` probes can be pipelined.
+
+_HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _probe_color(seq: int) -> tuple:
+    # unique for 65025 probes and never black
+    return 1 + seq % 255, (seq // 255) % 255 + 1, 0x55
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return math.nan
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class _Probe:
+    __slots__ = ("seq", "led", "color", "sent", "future", "timeout_handle")
+
+    def __init__(self, seq, led, color, sent, future):
+        self.seq = seq
+        self.led = led
+        self.color = color
+        self.sent = sent
+        self.future = future
+        self.timeout_handle = None
+
+
+class LatencyResult:
+    def __init__(self, device_id: str, led_count: int, cycles: int, in_flight: int):
+        self.device_id = device_id
+        self.led_count = led_count
+        self.cycles = cycles
+        self.in_flight = in_flight
+        self.samples = []  # (seq, led, latency in seconds or None on timeout)
+        self.total_time = 0.0
+
+    @property
+    def latencies(self) -> list:
+        return sorted(latency for _, _, latency in self.samples if latency is not None)
+
+    @property
+    def timeouts(self) -> int:
+        return sum(latency is None for _, _, latency in self.samples)
+
+    def histogram(self) -> dict:
+        # number of probes per latency bucket, keyed by the upper bound in ms
+        counts = dict.fromkeys([f"<={bound}ms" for bound in _HISTOGRAM_BUCKETS_MS], 0)
+        counts[f">{_HISTOGRAM_BUCKETS_MS[-1]}ms"] = 0
+        for latency in self.latencies:
+            latency_ms = latency * 1e3
+            for bound in _HISTOGRAM_BUCKETS_MS:
+                if latency_ms <= bound:
+                    counts[f"<={bound}ms"] += 1
+                    break
+            else:
+                counts[f">{_HISTOGRAM_BUCKETS_MS[-1]}ms"] += 1
+        return counts
+
+    def summary(self) -> dict:
+        latencies = self.latencies
+        return {
+            "device_id": self.device_id,
+            "led_count": self.led_count,
+            "cycles": self.cycles,
+            "in_flight": self.in_flight,
+            "completed": len(latencies),
+            "timeouts": self.timeouts,
+            "total_time": self.total_time,
+            "throughput": len(latencies) / self.total_time if self.total_time else 0.0,
+            "min": latencies[0] if latencies else math.nan,
+            "mean": statistics.mean(latencies) if latencies else math.nan,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else math.nan,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "summary": self.summary(),
+                "histogram": self.histogram(),
+                "samples": [
+                    {"seq": seq, "led": led, "latency": latency}
+                    for seq, led, latency in self.samples
+                ],
+            },
+            indent=2,
+        )
+
+    def to_csv(self) -> str:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["seq", "led", "latency_ms"])
+        for seq, led, latency in self.samples:
+            writer.writerow([seq, led, "" if latency is None else f"{latency * 1e3:.3f}"])
+        return output.getvalue()
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        return (
+            f"Tested {self.device_id} with {self.cycles} cycles, {self.in_flight} in flight "
+            f"and {self.led_count} lights\n"
+            f"Total time: {summary['total_time']:.2f} seconds "
+            f"({summary['throughput']:.1f} commands/s, {summary['timeouts']} timeouts)\n\n"
+            "The response time per color change is:\n"
+            f"p50:  {summary['p50'] * 1e3:.2f} ms\n"
+            f"p90:  {summary['p90'] * 1e3:.2f} ms\n"
+            f"p99:  {summary['p99'] * 1e3:.2f} ms\n"
+            f"Max:  {summary['max'] * 1e3:.2f} ms\n"
+            f"Min:  {summary['min'] * 1e3:.2f} ms\n"
+            f"Mean: {summary['mean'] * 1e3:.2f} ms\n"
+        )
+
+
+class LatencyProbe:
+    def __init__(
+        self,
+        mqtt_controller,
+        device,
+        cycles: int = 100,
+        in_flight: int = 1,
+        timeout: float = 5.0,
+    ):
+        if not device.led_count:
+            # every probe sets an LED, see _send_probe()
+            raise ValueError(f"{device.device_id} has no LEDs to probe")
+        self.mqtt_controller = mqtt_controller
+        self.device = device
+        self.cycles = cycles
+        # every probe in flight needs an LED of its own
+        self.in_flight = max(1, min(in_flight, device.led_count))
+        self.timeout = timeout
+        self._sts_topic = f"lightstrips/{device.device_id}/sts"
+        self._pending = {}
+        self._loop = None
+
+    async def run(self) -> LatencyResult:
+        self._loop = asyncio.get_running_loop()
+        device = self.device
+        result = LatencyResult(device.device_id, device.led_count, self.cycles, self.in_flight)
+        initial_frame = bytes(device.frame)
+        window = asyncio.Semaphore(self.in_flight)
+        futures = []
+
+        unsubscribe = self.mqtt_controller.message_received.subscribe(self._on_message)
+        start = time.perf_counter()
+        try:
+            for seq in range(self.cycles):
+                await window.acquire()
+                future = self._send_probe(seq)
+                future.add_done_callback(lambda _: window.release())
+                futures.append(future)
+            await asyncio.gather(*futures)
+        finally:
+            result.total_time = time.perf_counter() - start
+            unsubscribe()
+            for probe in self._pending.values():
+                probe.timeout_handle.cancel()
+            self._pending.clear()
+
+        for seq, future in enumerate(futures):
+            result.samples.append((seq, seq % result.led_count, future.result()))
+
+        device.set_frame(initial_frame)
+        self.mqtt_controller.send_color(device)
+        return result
+
+    def _send_probe(self, seq: int) -> asyncio.Future:
+        device = self.device
+        led = seq % device.led_count
+        color = _probe_color(seq)
+        device.set_rgb(led, *color)
+        device.notify_lights_changed([led])
+
+        probe = _Probe(seq, led, color, time.perf_counter(), self._loop.create_future())
+        probe.timeout_handle = self._loop.call_later(self.timeout, self._complete, seq, None)
+        self._pending[seq] = probe
+        # published right away, the scheduler would coalesce pipelined probes
+        self.mqtt_controller.publish_batch([device])
+        return probe.future
+
+    def _on_message(self, topic: str, payload: bytes) -> None:
+        # may be called from paho's thread in "thread" transport mode, the
+        # arrival time is taken here and the probes are matched on the loop
+        if topic == self._sts_topic:
+            self._loop.call_soon_threadsafe(self._match, payload, time.perf_counter())
+
+    def _match(self, payload: bytes, received: float) -> None:
+        # payloads that are not valid sts messages match no probe
+        try:
+            data = json.loads(payload)
+        except ValueError:  # includes json.JSONDecodeError and undecodable bytes
+            return
+        lights = data.get("lights") if isinstance(data, dict) else None
+        if not isinstance(lights, dict):
+            return
+        for probe in list(self._pending.values()):
+            color_data = lights.get(str(probe.led))
+            if isinstance(color_data, dict) and (
+                color_data.get("red"),
+                color_data.get("green"),
+                color_data.get("blue"),
+            ) == probe.color:
+                self._complete(probe.seq, received - probe.sent)
+
+    def _complete(self, seq: int, latency) -> None:
+        probe = self._pending.pop(seq, None)
+        if probe is None:
+            return
+        probe.timeout_handle.cancel()
+        if latency is None:
+            logging.info(f"Latency probe {seq} of {self.device.device_id} timed out")
+        probe.future.set_result(latency)
+
+
+async def _run_cli(args) -> LatencyResult:
+    from mqtt_controller import MQTTController
+
+    mqtt_controller = MQTTController(
+        args.broker, args.port, args.username, args.password, transport=args.transport
+    )
+    mqtt_controller.ingest_pipeline.start()
+    state = await mqtt_controller.connect_to_mqtt_async()
+    if not state.startswith("Connected"):
+        raise SystemExit(state)
+
+    try:
+        device = await _wait_for_device(mqtt_controller, args)
+        try:
+            probe = LatencyProbe(mqtt_controller, device, args.cycles, args.in_flight, args.timeout)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        return await probe.run()
+    finally:
+        mqtt_controller.ingest_pipeline.stop()
+        mqtt_controller.disconnect_from_mqtt()
+
+
+async def _wait_for_device(mqtt_controller, args):
+    device_manager = mqtt_controller.device_manager
+    if args.leds:
+        device, _ = device_manager.get_or_add_device(args.device)
+        device.led_count = args.leds
+        return device
+
+    # the LED count is taken from the first sts of the device
+    sts_topic = f"lightstrips/{args.device}/sts"
+    reported = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    unsubscribe = mqtt_controller.message_received.subscribe(
+        lambda topic, payload: topic == sts_topic and loop.call_soon_threadsafe(reported.set)
+    )
+    try:
+        await asyncio.wait_for(reported.wait(), args.wait)
+    except asyncio.TimeoutError:
+        raise SystemExit(f"No sts message from {args.device} within {args.wait} seconds")
+    finally:
+        unsubscribe()
+    # let the ingest pipeline apply it
+    await asyncio.sleep(2 * mqtt_controller.ingest_pipeline.interval)
+    return device_manager.get_device(args.device)
+
+
+def main():
+    from settings import BROKER_ADRESS, BROKER_PASSWORD, BROKER_PORT, BROKER_USERNAME
+
+    parser = argparse.ArgumentParser(description="Measure the command to sts latency of a device")
+    parser.add_argument("device", help="device id, e.g. esp32-00001")
+    parser.add_argument("--broker", default=BROKER_ADRESS)
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    parser.add_argument("--username", default=BROKER_USERNAME)
+    parser.add_argument("--password", default=BROKER_PASSWORD)
+    parser.add_argument("--transport", choices=["asyncio", "thread"], default="asyncio")
+    parser.add_argument("--cycles", type=int, default=100)
+    parser.add_argument("--in-flight", type=int, default=1, help="pipelined probes")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds per probe")
+    parser.add_argument("--leds", type=int, default=0, help="LED count, skips waiting for sts")
+    parser.add_argument("--wait", type=float, default=10.0, help="seconds to wait for sts")
+    parser.add_argument("--json", help="write the results as JSON to this file")
+    parser.add_argument("--csv", help="write the samples as CSV to this file")
+    args = parser.parse_args()
+
+    result = asyncio.run(_run_cli(args))
+    print(result.format_summary())
+    if args.json:
+        with open(args.json, "w") as file:
+            file.write(result.to_json())
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            file.write(result.to_csv())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, changed_leds() falls back to pure Python
+    np = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, sts messages are decoded with json then
+    orjson = None
+
+
+# Encoding of the "lights" map of a command straight from a packed RGB frame.
+# The JSON text for a given LED count is compiled once into a %-template, so
+# encoding a frame is a single string format call with no per-LED objects.
+
+_LED_ENTRY = '"%d":{"red":%%d,"green":%%d,"blue":%%d}'
+
+
+@lru_cache(maxsize=64)
+def _lights_template(led_count: int) -> str:
+    return "{" + ",".join(_LED_ENTRY % i for i in range(led_count)) + "}"
+
+
+def encode_lights(frame) -> str:
+    return _lights_template(len(frame) // 3) % tuple(frame)
+
+
+def encode_lights_subset(frame, led_indices) -> str:
+    return (
+        "{"
+        + ",".join(
+            _LED_ENTRY % i % (frame[3 * i], frame[3 * i + 1], frame[3 * i + 2])
+            for i in led_indices
+        )
+        + "}"
+    )
+
+
+def encode_command(device_id: str, lights_json: str, delta: bool = False) -> str:
+    if delta:
+        return '{"device-id":%s,"delta":true,"lights":%s}' % (
+            json.dumps(device_id),
+            lights_json,
+        )
+    return '{"device-id":%s,"lights":%s}' % (json.dumps(device_id), lights_json)
+
+
+def changed_leds(old_frame, new_frame) -> list:
+    if len(old_frame) != len(new_frame):
+        return list(range(len(new_frame) // 3))
+    if old_frame == new_frame:
+        return []
+    if len(new_frame) == 3:  # a single LED, and the frames differ
+        return [0]
+    if np is not None and len(new_frame) >= 96:
+        old_leds = np.frombuffer(old_frame, np.uint8).reshape(-1, 3)
+        new_leds = np.frombuffer(new_frame, np.uint8).reshape(-1, 3)
+        return np.flatnonzero((old_leds != new_leds).any(axis=1)).tolist()
+    # compares (r, g, b) tuples instead of slicing both frames per LED
+    old_leds = zip(*[iter(old_frame)] * 3)
+    new_leds = zip(*[iter(new_frame)] * 3)
+    return [i for i, (old, new) in enumerate(zip(old_leds, new_leds)) if old != new]
+
+
+# Decoding of sts messages. status_digest() lets the controller skip a
+# message that is identical to the last one applied, decode_lights() packs the
+# "lights" map into a frame without going through Device.set_rgb() per LED.
+
+loads = orjson.loads if orjson is not None else json.loads
+
+def status_digest(payload) -> bytes:
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return hashlib.sha1(payload).digest()
+
+
+@lru_cache(maxsize=64)
+def _index_keys(led_count: int) -> list:
+    return [str(i) for i in range(led_count)]
+
+
+def decode_lights(lights: dict) -> bytearray:
+    led_count = len(lights)
+    if list(lights) == _index_keys(led_count):
+        # the usual case, LEDs "0" to "n-1" in order
+        values = []
+        extend = values.extend
+        for color_data in lights.values():
+            extend(
+                (color_data.get("red", 0), color_data.get("green", 0), color_data.get("blue", 0))
+            )
+        return bytearray(values)
+
+    frame = bytearray(3 * led_count)
+    for led_index, color_data in lights.items():
+        led_index = int(led_index)
+        if not 0 <= led_index < led_count:
+            logging.info("Index out of range")
+            continue
+        offset = 3 * led_index
+        frame[offset : offset + 3] = (
+            color_data.get("red", 0),
+            color_data.get("green", 0),
+            color_data.get("blue", 0),
+        )
+    return frame
+
+
+class DeltaEncoder:
+    # Tracks the last state acknowledged (reported via sts) per device and
+    # encodes commands as deltas against it. A full keyframe is sent when
+    # there is no acknowledged state yet, after `keyframe_interval` deltas,
+    # and after reset() (e.g. on reconnect).
+
+    def __init__(self, keyframe_interval: int = 50):
+        self.keyframe_interval = keyframe_interval
+        self._acked = {}
+        self._deltas_since_keyframe = {}
+        self._stale_retained = set()
+
+    def acknowledge(self, device_id: str, frame) -> None:
+        self._acked[device_id] = bytes(frame)
+
+    def reset(self, device_id: str = None) -> None:
+        if device_id is None:
+            self._acked.clear()
+            self._deltas_since_keyframe.clear()
+        else:
+            self._acked.pop(device_id, None)
+            self._deltas_since_keyframe.pop(device_id, None)
+
+    def needs_retained_keyframe(self, device_id: str) -> bool:
+        # True if deltas were sent after the last retained keyframe, so the
+        # retained command of this device no longer matches its state
+        return device_id in self._stale_retained
+
+    def encode(self, device_id: str, frame, retain: bool = False):
+        # returns (payload, is_keyframe), payload is None if nothing changed
+        acked = self._acked.get(device_id)
+        deltas = self._deltas_since_keyframe.get(device_id, 0)
+        if acked is None or deltas >= self.keyframe_interval or len(acked) != len(frame):
+            return self.encode_keyframe(device_id, frame, retain), True
+
+        led_indices = changed_leds(acked, frame)
+        if not led_indices:
+            return None, False
+        self._deltas_since_keyframe[device_id] = deltas + 1
+        if retain:
+            self._stale_retained.add(device_id)
+        return (
+            encode_command(device_id, encode_lights_subset(frame, led_indices), delta=True),
+            False,
+        )
+
+    def encode_keyframe(self, device_id: str, frame, retain: bool = False) -> str:
+        self.keyframe_sent(device_id, retain)
+        return encode_command(device_id, encode_lights(frame))
+
+    def keyframe_sent(self, device_id: str, retain: bool = False) -> None:
+        # for full commands encoded elsewhere (e.g. compiled scenes)
+        self._deltas_since_keyframe[device_id] = 0
+        if retain:
+            self._stale_retained.discard(device_id)
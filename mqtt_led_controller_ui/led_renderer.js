@@ -0,0 +1,88 @@
+// The LEDs of one device on a single canvas, see led_renderer.py.
+// positions: flat [x0, y0, x1, y1, ...] in surface units, colors: hex string
+// of the packed RGB frame. patch() redraws only the LEDs it is given.
+export default {
+  template: `
+    <canvas
+      ref="canvas"
+      :width="width"
+      :height="height"
+      :style="{ width: '100%', maxWidth: width + 'px', opacity: disabled ? 0.3 : 1, cursor: disabled ? 'default' : 'pointer' }"
+      @mousedown="onMouseDown"
+    ></canvas>
+  `,
+  props: {
+    positions: Array,
+    radius: Number,
+    width: Number,
+    height: Number,
+    colors: String,
+    background: String,
+    disabled: Boolean,
+  },
+  data() {
+    return { image: null };
+  },
+  mounted() {
+    this.context = this.$refs.canvas.getContext("2d");
+    this.leds = this.split(this.colors);
+    if (this.background) {
+      this.image = new Image();
+      this.image.onload = () => this.drawAll();
+      this.image.src = (this.background.startsWith("/") ? window.path_prefix : "") + this.background;
+    }
+    this.drawAll();
+  },
+  watch: {
+    colors(value) {
+      this.set_colors(value);
+    },
+    positions() {
+      this.$nextTick(() => this.drawAll());
+    },
+  },
+  methods: {
+    drawAll() {
+      const context = this.context;
+      context.clearRect(0, 0, this.width, this.height);
+      if (this.image && this.image.complete) {
+        context.drawImage(this.image, 0, 0, this.width, this.height);
+      }
+      const count = Math.min(this.positions.length / 2, this.leds.length);
+      for (let i = 0; i < count; i++) {
+        this.drawLed(i, this.leds[i]);
+      }
+    },
+    drawLed(index, color) {
+      const context = this.context;
+      context.fillStyle = "#" + color;
+      context.beginPath();
+      context.arc(this.positions[2 * index], this.positions[2 * index + 1], this.radius, 0, 2 * Math.PI);
+      context.fill();
+    },
+    split(colors) {
+      return (colors || "").match(/.{6}/g) || [];
+    },
+    set_colors(colors) {
+      this.leds = this.split(colors);
+      this.drawAll();
+    },
+    patch(changes) {
+      // [index, "rrggbb", index, "rrggbb", ...]
+      for (let i = 0; i < changes.length; i += 2) {
+        if (changes[i] < this.positions.length / 2) {
+          this.leds[changes[i]] = changes[i + 1];
+          this.drawLed(changes[i], changes[i + 1]);
+        }
+      }
+    },
+    onMouseDown(e) {
+      if (this.disabled) return;
+      const rect = this.$refs.canvas.getBoundingClientRect();
+      this.$emit("led_click", {
+        x: ((e.clientX - rect.left) * this.width) / rect.width,
+        y: ((e.clientY - rect.top) * this.height) / rect.height,
+      });
+    },
+  },
+};
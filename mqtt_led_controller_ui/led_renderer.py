@@ -0,0 +1,233 @@
+import functools
+import math
+
+from nicegui import app, ui
+from settings import LED_LAYOUTS, LED_STRIP_COLUMNS, led_ring_12_image_path
+
+# Draws the LEDs of a device on one canvas instead of one element per LED.
+# A layout maps every LED to a position on the drawing surface; the canvas
+# gets the whole frame once and afterwards only the LEDs that changed. Clicks
+# are sent back as surface coordinates and mapped to an LED with a grid
+# index, so a click costs the same for 12 and 10,000 LEDs.
+
+LED_RING_12_POSITIONS = [
+    [109.6, 318.8],
+    [202.5, 176.0],
+    [361.9, 99.6],
+    [527.9, 109.6],
+    [667.4, 199.2],
+    [747.1, 348.6],
+    [740.4, 524.6],
+    [647.5, 670.7],
+    [494.7, 750.4],
+    [318.8, 740.4],
+    [176.0, 650.8],
+    [102.9, 491.4],
+]
+
+
+class LedLayout:
+    # positions of the LEDs on a width x height surface; a click within
+    # `hit_radius` of an LED selects it
+
+    def __init__(
+        self,
+        positions: list,
+        radius: float = 8.0,
+        width: float = None,
+        height: float = None,
+        background: str = None,
+    ):
+        self.positions = [(float(x), float(y)) for x, y in positions]
+        self.radius = radius
+        self.hit_radius = 1.25 * radius
+        self.width = width or max((x for x, _ in self.positions), default=0) + 2 * radius
+        self.height = height or max((y for _, y in self.positions), default=0) + 2 * radius
+        self.background = background
+        # grid index: cell -> LEDs whose center lies in it; a cell is as large
+        # as the hit radius, so a hit is always within the 3x3 cells around it
+        self._cell_size = self.hit_radius
+        self._cells = {}
+        for index, (x, y) in enumerate(self.positions):
+            self._cells.setdefault(self._cell(x, y), []).append(index)
+
+    def _cell(self, x: float, y: float) -> tuple:
+        return int(x // self._cell_size), int(y // self._cell_size)
+
+    @classmethod
+    def strip(cls, led_count: int, columns: int = 30, spacing: float = 20.0) -> "LedLayout":
+        # a strip wrapped into rows of `columns` LEDs
+        columns = max(min(columns, led_count), 1)
+        positions = [
+            ((i % columns + 0.5) * spacing, (i // columns + 0.5) * spacing)
+            for i in range(led_count)
+        ]
+        return cls(
+            positions,
+            0.4 * spacing,
+            columns * spacing,
+            math.ceil(led_count / columns) * spacing,
+        )
+
+    @classmethod
+    def matrix(
+        cls,
+        columns: int,
+        rows: int,
+        spacing: float = 20.0,
+        serpentine: bool = False,
+        led_count: int = None,
+    ) -> "LedLayout":
+        # row by row from the top left; with `serpentine` every second row
+        # runs from right to left, as most LED matrices are wired. Only the
+        # first `led_count` positions get an LED, clicks on the others miss.
+        positions = []
+        for row in range(rows):
+            order = range(columns - 1, -1, -1) if serpentine and row % 2 else range(columns)
+            positions.extend(((column + 0.5) * spacing, (row + 0.5) * spacing) for column in order)
+        return cls(positions[:led_count], 0.4 * spacing, columns * spacing, rows * spacing)
+
+    @classmethod
+    def ring(cls, led_count: int, diameter: float = 400.0) -> "LedLayout":
+        # clockwise from the top
+        radius = min(0.4 * math.pi * diameter / max(led_count, 1), 0.1 * diameter)
+        center = diameter / 2
+        orbit = center - radius
+        positions = [
+            (
+                center + orbit * math.sin(2 * math.pi * i / led_count),
+                center - orbit * math.cos(2 * math.pi * i / led_count),
+            )
+            for i in range(led_count)
+        ]
+        return cls(positions, radius, diameter, diameter)
+
+    @classmethod
+    def ring_12(cls) -> "LedLayout":
+        # the 12-LED ring drawn over its photo
+        return cls(LED_RING_12_POSITIONS, 40.0, 850, 850, led_ring_12_image_path)
+
+    @classmethod
+    def from_definition(cls, definition: dict, led_count: int) -> "LedLayout":
+        # a layout from LED_LAYOUTS, see settings.py
+        kind = definition.get("type", "positions" if "positions" in definition else "strip")
+        if kind == "positions":
+            return cls(
+                definition["positions"][:led_count],
+                definition.get("radius", 8.0),
+                definition.get("width"),
+                definition.get("height"),
+                definition.get("background"),
+            )
+        if kind == "matrix":
+            return cls.matrix(
+                definition["columns"],
+                definition["rows"],
+                definition.get("spacing", 20.0),
+                definition.get("serpentine", False),
+                led_count,
+            )
+        if kind == "ring":
+            return cls.ring(led_count, definition.get("diameter", 400.0))
+        if kind == "strip":
+            return cls.strip(
+                led_count,
+                definition.get("columns", LED_STRIP_COLUMNS),
+                definition.get("spacing", 20.0),
+            )
+        raise ValueError(f"Unknown LED layout type {kind}")
+
+    def hit(self, x: float, y: float):
+        # index of the LED at (x, y), None if there is none
+        cell_x, cell_y = self._cell(x, y)
+        best = None
+        best_distance = self.hit_radius**2
+        for cx in (cell_x - 1, cell_x, cell_x + 1):
+            for cy in (cell_y - 1, cell_y, cell_y + 1):
+                for index in self._cells.get((cx, cy), ()):
+                    led_x, led_y = self.positions[index]
+                    distance = (x - led_x) ** 2 + (y - led_y) ** 2
+                    if distance <= best_distance:
+                        best, best_distance = index, distance
+        return best
+
+
+@functools.lru_cache(maxsize=None)
+def _static_url(local_file: str) -> str:
+    # every call of add_static_file() adds another route
+    return app.add_static_file(local_file=local_file)
+
+
+_layouts = {}  # (device id, LED count) -> LedLayout
+
+
+def layout_for(device) -> LedLayout:
+    key = (device.device_id, device.led_count)
+    layout = _layouts.get(key)
+    if layout is None:
+        definition = LED_LAYOUTS.get(device.device_id)
+        if definition is not None:
+            layout = LedLayout.from_definition(definition, device.led_count)
+        elif device.led_count == 12:
+            layout = LedLayout.ring_12()
+        else:
+            layout = LedLayout.strip(device.led_count, LED_STRIP_COLUMNS)
+        _layouts[key] = layout
+    return layout
+
+
+class LedCanvas(ui.element, component="led_renderer.js"):
+    # The LEDs of `layout` on one <canvas>. `colors` is the packed RGB frame,
+    # on_click is called with the index of the clicked LED.
+
+    def __init__(self, layout: LedLayout, frame=b"", on_click=None):
+        super().__init__()
+        self.layout = layout
+        self._frame = frame
+        self._colors_stale = False  # patched since the colors prop was set
+        self._props["positions"] = [round(c, 1) for position in layout.positions for c in position]
+        self._props["radius"] = layout.radius
+        self._props["width"] = layout.width
+        self._props["height"] = layout.height
+        self._props["colors"] = bytes(frame).hex()
+        if layout.background:
+            self._props["background"] = _static_url(layout.background)
+        self._on_click = on_click
+        self.on("led_click", self._handle_click, ["x", "y"])
+
+    def _handle_click(self, e) -> None:
+        index = self.layout.hit(e.args["x"], e.args["y"])
+        if self._on_click is not None:
+            self._on_click(index)
+
+    def _to_dict(self) -> dict:
+        # the colors prop is only brought up to date when the element is
+        # sent as a whole, e.g. to a reloaded page
+        if self._colors_stale:
+            self._props["colors"] = bytes(self._frame).hex()
+            self._colors_stale = False
+        return super()._to_dict()
+
+    def set_frame(self, frame) -> None:
+        # redraws all LEDs
+        self._frame = frame
+        self._colors_stale = False
+        self._props["colors"] = colors = bytes(frame).hex()
+        self.run_method("set_colors", colors)
+
+    def patch(self, frame, led_indices) -> None:
+        # redraws only the LEDs in led_indices, only their colors are encoded
+        self._frame = frame
+        self._colors_stale = True
+        led_count = len(frame) // 3
+        changes = []
+        for index in led_indices:
+            if index < led_count:
+                changes.append(index)
+                changes.append(frame[3 * index : 3 * index + 3].hex())
+        if changes:
+            self.run_method("patch", changes)
+
+    def set_disabled(self, disabled: bool) -> None:
+        self._props["disabled"] = disabled
+        self.update()
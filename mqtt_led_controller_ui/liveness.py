@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+
+
+class LivenessMonitor:
+    # Marks online devices offline when nothing (sts or heartbeat) was heard
+    # from them for `timeout` seconds, e.g. a device that hangs without
+    # losing its connection, so the broker never publishes its last will.
+    # A device marked offline this way is online again with its next message.
+    #
+    # Instead of a timer per device or a periodic scan of the fleet, the
+    # online devices sit in a hashed timer wheel: a ring of slots that each
+    # cover `precision` seconds, one device in exactly one slot. seen() only
+    # stores the time (Device.last_seen), the device is not moved. When the
+    # wheel reaches a slot, each device in it is either expired or moved to
+    # the slot of its new deadline, so a device is looked at about once per
+    # `timeout` no matter how many messages it sends.
+    #
+    # Transitions are collected and applied once per tick inside
+    # DeviceManager.online_batch(), so listeners get one online_changed
+    # event for all devices that expired or came back in that tick.
+
+    def __init__(self, device_manager, timeout: float, precision: float = 1.0):
+        self.device_manager = device_manager
+        self.timeout = timeout
+        self.precision = min(precision, timeout)
+        # a deadline is at most `timeout` ahead, so it never wraps around
+        self._wheel = [[] for _ in range(int(timeout / self.precision) + 2)]
+        self._tick = None  # number of the last tick processed
+        self._scheduled = {}  # device id -> time.monotonic() it was scheduled at
+        self._stale = set()  # devices marked offline by the monitor
+        self._pending = {}  # device id -> (device, online), applied on the next tick
+        self._task = None
+        device_manager.online_changed.subscribe(self._on_online_changed)
+
+        self.devices_checked = 0
+        self.devices_expired = 0
+        self.devices_revived = 0
+
+    @property
+    def tracked_devices(self) -> int:
+        return len(self._scheduled)
+
+    def stats(self) -> dict:
+        return {
+            "tracked_devices": self.tracked_devices,
+            "stale_devices": len(self._stale),
+            "devices_checked": self.devices_checked,
+            "devices_expired": self.devices_expired,
+            "devices_revived": self.devices_revived,
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            now = time.monotonic()
+            for device in self.device_manager.get_online_devices():
+                self._schedule(device.device_id, now)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def seen(self, device) -> None:
+        # called for every sts or heartbeat, after device.last_seen was set
+        device_id = device.device_id
+        if device_id in self._stale:
+            self._pending[device_id] = (device, True)
+        elif device_id not in self._scheduled and device.online:
+            self._schedule(device_id, device.last_seen)
+
+    def forget(self, device_id: str) -> None:
+        # the device went offline for good (last will), its next message
+        # does not bring it back online
+        self._stale.discard(device_id)
+        self._pending.pop(device_id, None)
+
+    def reset(self) -> None:
+        # the broker connection was lost, every device is offline anyway
+        self._stale.clear()
+        self._pending.clear()
+
+    def advance(self, now: float = None) -> None:
+        # processes the slots up to `now` and applies the transitions
+        now = time.monotonic() if now is None else now
+        tick = int(now / self.precision)
+        if self._tick is None:
+            self._tick = tick - 1
+        slots = len(self._wheel)
+        # after a long stall every slot is processed once
+        first = max(self._tick + 1, tick - slots + 1)
+        self._tick = tick
+        for slot_tick in range(first, tick + 1):
+            self._process_slot(slot_tick % slots, now)
+        self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        pending = list(self._pending.values())
+        self._pending.clear()
+        with self.device_manager.online_batch():
+            for device, online in pending:
+                device.online = online
+        logging.debug(f"Liveness: {len(pending)} devices changed")
+
+    def _process_slot(self, index: int, now: float) -> None:
+        devices = self._wheel[index]
+        if not devices:
+            return
+        wheel = self._wheel
+        wheel[index] = []
+        get_device = self.device_manager.get_device
+        scheduled = self._scheduled
+        timeout = self.timeout
+        precision = self.precision
+        next_tick = self._tick + 1
+        slots = len(wheel)
+        self.devices_checked += len(devices)
+        for device_id in devices:
+            device = get_device(device_id)
+            if device is None or not device.online:
+                del scheduled[device_id]  # dropped lazily, see _on_online_changed
+                continue
+            last_seen = device.last_seen
+            since = scheduled[device_id]
+            if last_seen is None or last_seen < since:
+                last_seen = since
+            if last_seen + timeout <= now:
+                del scheduled[device_id]
+                self._stale.add(device_id)
+                self._pending[device_id] = (device, False)
+                self.devices_expired += 1
+            else:
+                # like _slot(), inlined
+                tick = int((last_seen + timeout) / precision) + 1
+                wheel[(tick if tick > next_tick else next_tick) % slots].append(device_id)
+
+    def _slot(self, deadline: float) -> list:
+        # a slot processed after `deadline`
+        tick = int(deadline / self.precision) + 1
+        if self._tick is not None and tick <= self._tick:
+            tick = self._tick + 1
+        return self._wheel[tick % len(self._wheel)]
+
+    def _schedule(self, device_id: str, now: float) -> None:
+        if device_id not in self._scheduled:
+            self._slot(now + self.timeout).append(device_id)
+        self._scheduled[device_id] = now
+
+    def _on_online_changed(self, devices) -> None:
+        now = time.monotonic()
+        for device in devices:
+            if device.online:
+                if device.device_id in self._stale:  # heard from again, or its last will said "online"
+                    self._stale.discard(device.device_id)
+                    self.devices_revived += 1
+                self._schedule(device.device_id, now)
+            else:
+                self._pending.pop(device.device_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.precision)
+            try:
+                self.advance()
+            except Exception:
+                logging.exception("Checking the device liveness failed")
@@ -1,22 +1,79 @@
-import os
-import random
-
-from device_manager import Device
-from mqtt_controller import MQTTController
-from nicegui import ui
-from settings import (
-    ADD_DUMMY_TEST_DEVICES,
-    BROKER_ADRESS,
-    BROKER_PASSWORD,
-    BROKER_PORT,
-    BROKER_USERNAME,
-)
-from ui_elements import ui_connection_control, ui_panels, ui_title
-
-if ADD_DUMMY_TEST_DEVICES:
-    device_test_1 = Device(device_id="test1")
-    device_test_2 = Device(device_id="test2")
-    device_test_3 = Device(device_id="test3")
+import time
+
+STARTED = time.perf_counter()  # the startup phases are measured from here
+
+import argparse
+import logging
+import sys
+
+import settings
+
+# Entry point of the UI. Every option defaults to its value in settings.py,
+# which can be overridden with MQTT_LED_<SETTING> environment variables, e.g.
+#
+#   python main.py --port 8080 --broker 192.168.1.10
+#   MQTT_LED_BROKER_PASSWORD=secret python main.py --workers 4
+#   python main.py --reload  # restart on source changes while developing
+#
+# The app modules read the settings when they are imported, so they are only
+# imported after the command line was applied; optional parts (metrics,
+# control API, simulated devices, device store, test devices) only when
+# enabled. The time until each startup phase is logged and exported on
+# /metrics as mqtt_led_startup_seconds.
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="MQTT LED Controller UI")
+    parser.add_argument("--host", default=settings.UI_HOST)
+    parser.add_argument("--port", type=int, default=settings.UI_PORT)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.UI_WORKERS,
+        help="UI processes, more than one runs multi_worker.py",
+    )
+    parser.add_argument(
+        "--reload",
+        action=argparse.BooleanOptionalAction,
+        default=settings.UI_RELOAD,
+        help="restart when a source file changes (development only)",
+    )
+    parser.add_argument("--broker", default=settings.BROKER_ADRESS)
+    parser.add_argument("--broker-port", type=int, default=settings.BROKER_PORT)
+    parser.add_argument("--username", default=settings.BROKER_USERNAME)
+    parser.add_argument(
+        "--password", default=settings.BROKER_PASSWORD, help="prefer MQTT_LED_BROKER_PASSWORD"
+    )
+    parser.add_argument(
+        "--test-devices",
+        action=argparse.BooleanOptionalAction,
+        default=settings.ADD_DUMMY_TEST_DEVICES,
+        help="add three test devices",
+    )
+    parser.add_argument("--log-level", default=settings.LOG_LEVEL)
+    return parser.parse_args(argv)
+
+
+def apply_args(args: argparse.Namespace) -> None:
+    settings.UI_HOST = args.host
+    settings.UI_PORT = args.port
+    settings.UI_WORKERS = args.workers
+    settings.UI_RELOAD = args.reload
+    settings.BROKER_ADRESS = args.broker
+    settings.BROKER_PORT = args.broker_port
+    settings.BROKER_USERNAME = args.username
+    settings.BROKER_PASSWORD = args.password
+    settings.ADD_DUMMY_TEST_DEVICES = args.test_devices
+    settings.LOG_LEVEL = args.log_level
+
+
+def add_test_devices(device_manager) -> None:
+    import random
+
+    from device_manager import TEST_DEVICE_IDS, Device
+    from nicegui import ui
+
+    device_test_1, device_test_2, device_test_3 = map(Device, TEST_DEVICE_IDS)
 
     device_test_1.led_count = 6
 
@@ -26,30 +83,146 @@ if ADD_DUMMY_TEST_DEVICES:
     device_test_3.led_count = 12
     for device_test_3_led in range(device_test_3.led_count):
         color = random.choice(["red", "green", "blue"])
-        device_test_3.lights[device_test_3_led] = color
+        device_test_3.update_lights(device_test_3_led, color)
 
     ui.timer(4.0, lambda: setattr(device_test_3, "online", True), once=True)
     ui.timer(15.0, lambda: setattr(device_test_2, "online", True), once=True)
 
+    device_manager.add_device(device_test_1)
+    device_manager.add_device(device_test_2)
+    device_manager.add_device(device_test_3)
 
-def main():
-    os.system('cls')  # clear screen
 
-    mqtt_controller = MQTTController(
-        BROKER_ADRESS, BROKER_PORT, BROKER_USERNAME, BROKER_PASSWORD
-    )
+def run_workers(args: argparse.Namespace) -> None:
+    from multi_worker import main as multi_worker_main
+
+    multi_worker_main([
+        "--workers", str(args.workers),
+        "--host", args.host,
+        "--port", str(args.port),
+        "--broker", args.broker,
+        "--broker-port", str(args.broker_port),
+        "--username", args.username,
+        "--password", args.password,
+        "--log-level", args.log_level,
+    ])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    apply_args(args)
+    logging.basicConfig(level=args.log_level)
+    if args.workers > 1:
+        # the worker processes import this module again, as __mp_main__
+        if __name__ == "__main__":
+            run_workers(args)
+        return
 
-    mqtt_controller.connect_to_mqtt()
+    from metrics import StartupTimer
 
-    if ADD_DUMMY_TEST_DEVICES:
-        mqtt_controller.device_manager.add_device(device_test_1)
-        mqtt_controller.device_manager.add_device(device_test_2)
-        mqtt_controller.device_manager.add_device(device_test_3)
+    startup = StartupTimer(STARTED)
+    from mqtt_controller import MQTTController
+    from nicegui import app, ui
+    from ui_elements import ui_connection_control, ui_group_control, ui_panels, ui_title
+
+    startup.mark("imports")
+
+    mqtt_controller = MQTTController(
+        settings.BROKER_ADRESS, settings.BROKER_PORT, settings.BROKER_USERNAME, settings.BROKER_PASSWORD
+    )
+    startup.mark_on(mqtt_controller.connection_changed, "broker connected", bool)
+    startup.mark_on(mqtt_controller.subscribed, "first subscribe")
+
+    def on_first_client():
+        if "first client connected" not in startup.phases:
+            startup.mark("first client connected")  # the first page is loaded and live
+            logging.info(f"Startup: {startup.summary()}")
+
+    app.on_connect(on_first_client)
+
+    app.on_startup(mqtt_controller.connect_to_mqtt_async)
+    app.on_startup(mqtt_controller.ingest_pipeline.start)
+    app.on_startup(mqtt_controller.publish_scheduler.start)
+    app.on_startup(mqtt_controller.publish_window.start)
+    if mqtt_controller.liveness is not None:
+        app.on_startup(mqtt_controller.liveness.start)
+        app.on_shutdown(mqtt_controller.liveness.stop)
+    app.on_shutdown(mqtt_controller.ingest_pipeline.stop)
+    app.on_shutdown(mqtt_controller.effect_engine.stop_all)
+    app.on_shutdown(mqtt_controller.publish_scheduler.stop)
+    app.on_shutdown(mqtt_controller.publish_window.stop)
+    app.on_shutdown(mqtt_controller.disconnect_from_mqtt)
+    if settings.ENABLE_METRICS_ENDPOINT:
+        from control_api import allowed_without_token
+        from metrics import add_metrics_route
+
+        # device ids and traffic are not for everyone on the network either
+        if settings.CONTROL_API_TOKEN or allowed_without_token(args.host):
+            add_metrics_route(
+                app, mqtt_controller, startup_timer=startup, token=settings.CONTROL_API_TOKEN
+            )
+        else:
+            logging.warning(
+                f"/metrics is not served: set CONTROL_API_TOKEN to serve it on {args.host}"
+            )
+    if settings.ENABLE_CONTROL_API:
+        from control_api import add_control_routes, allowed_without_token
+
+        if settings.CONTROL_API_TOKEN or allowed_without_token(args.host):
+            add_control_routes(app, mqtt_controller, settings.CONTROL_API_TOKEN)
+        else:
+            logging.error(
+                f"The control API is not served: set CONTROL_API_TOKEN to serve it on {args.host}"
+            )
+
+    if settings.SIMULATED_DEVICES:
+        from device_simulator import DeviceFleet
+
+        fleet = DeviceFleet(
+            settings.SIMULATED_DEVICES,
+            delay=0.005,
+            jitter=0.002,
+            heartbeat_interval=settings.DEVICE_TIMEOUT / 3,
+        )
+
+        async def start_fleet():
+            # NiceGUI only awaits coroutine functions, not lambdas returning a coroutine
+            await fleet.start_mqtt(
+                settings.BROKER_ADRESS,
+                settings.BROKER_PORT,
+                settings.BROKER_USERNAME,
+                settings.BROKER_PASSWORD,
+            )
+
+        app.on_startup(start_fleet)
+        app.on_shutdown(fleet.stop)
+
+    if settings.ADD_DUMMY_TEST_DEVICES:
+        add_test_devices(mqtt_controller.device_manager)
 
     for device in mqtt_controller.device_manager.devices:
         device.online = False
 
+    if settings.DEVICE_STORE_PATH:
+        from device_manager import TEST_DEVICE_IDS
+        from device_store import DeviceStore
+
+        # restored devices keep their last known state until the broker reports
+        device_store = DeviceStore(
+            mqtt_controller.device_manager,
+            settings.DEVICE_STORE_PATH,
+            settings.DEVICE_STORE_INTERVAL,
+            settings.DEVICE_STORE_RECONCILE_TIMEOUT,
+            exclude=TEST_DEVICE_IDS,
+        )
+        device_store.load()
+        mqtt_controller.connection_changed.subscribe(device_store.on_connection_changed)
+        app.on_startup(device_store.start)
+        app.on_shutdown(device_store.stop)
+
+    mqtt_controller.scenes.load()
     mqtt_controller.device_manager.list_devices()
+    startup.mark("devices loaded")
 
     ui.colors(primary="#3785b2", secondary="blue")
 
@@ -58,19 +231,22 @@ def main():
 
     ui_title()
     ui_connection_control(mqtt_controller)
+    ui_group_control(mqtt_controller)
     ui_panels(mqtt_controller)
-
-    ui.timer(600.0, lambda: ui_panels.refresh(),)
+    startup.mark("UI built")
+    app.on_startup(lambda: startup.mark("server ready"))
 
     ui.run(
         dark=None,
         title="MQTT LED Controller",
-        reload=True,
+        reload=args.reload,
         native=False,
-        port=80,
+        show=False,
+        host=args.host,
+        port=args.port,
         favicon="💡",
     )
 
 
 if __name__ in {"__main__", "__mp_main__"}:
-    main()
+    main(sys.argv[1:])
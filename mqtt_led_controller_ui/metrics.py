@@ -0,0 +1,369 @@
+import asyncio
+import bisect
+import logging
+import time
+
+# Telemetry in the Prometheus text format. The hot paths only increment
+# plain counters and Histogram buckets; everything else (queue depths,
+# device ages, ...) is read when /metrics is scraped.
+
+PARSE_TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+ACK_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class LoopLagMonitor:
+    # Sleeps for `interval` and records how much later than that the loop
+    # woke it up, i.e. how long callbacks blocked the event loop.
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.histogram = Histogram(LOOP_LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.histogram.observe(lag)
+
+
+class StartupTimer:
+    # Seconds from `start` (time.perf_counter() when the process began
+    # loading the app) until each startup phase was first reached. Every
+    # phase is logged once, so cold start regressions show up in the logs
+    # and in /metrics.
+
+    def __init__(self, start: float = None):
+        self.start = time.perf_counter() if start is None else start
+        self.phases = {}  # phase -> seconds since start, in the order reached
+
+    def mark(self, phase: str) -> None:
+        if phase not in self.phases:
+            elapsed = self.phases[phase] = time.perf_counter() - self.start
+            logging.info(f"Startup: {phase} after {elapsed * 1000:.0f} ms")
+
+    def mark_on(self, event, phase: str, condition=None) -> None:
+        # marks `phase` the first time `event` is emitted (with a value for
+        # which condition(value) is true)
+        def on_event(*args):
+            if condition is None or condition(*args):
+                self.mark(phase)
+                unsubscribe()
+
+        unsubscribe = event.subscribe(on_event)
+
+    def summary(self) -> str:
+        return ", ".join(f"{phase} {elapsed * 1000:.0f} ms" for phase, elapsed in self.phases.items())
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Writer:
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name: str, kind: str, help_text: str, samples) -> None:
+        # samples: value or iterable of (labels dict, value)
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        if not isinstance(samples, (list, tuple)):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{self._labels(labels)} {value}")
+
+    def histogram(self, name: str, help_text: str, histogram: Histogram) -> None:
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        self.lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+        self.lines.append(f"{name}_sum {histogram.sum}")
+        self.lines.append(f"{name}_count {histogram.count}")
+
+    @staticmethod
+    def _labels(labels: dict) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def render_metrics(
+    mqtt_controller, browser_clients: int = 0, loop_monitor=None, startup_timer=None
+) -> str:
+    writer = _Writer()
+    client = mqtt_controller.client
+    device_manager = mqtt_controller.device_manager
+
+    writer.metric(
+        "mqtt_led_messages_received_total",
+        "counter",
+        "MQTT messages received by topic type",
+        [({"type": kind}, count) for kind, count in mqtt_controller.messages_received.items()],
+    )
+    writer.metric(
+        "mqtt_led_messages_published_total",
+        "counter",
+        "MQTT messages published by command type",
+        [({"type": kind}, count) for kind, count in mqtt_controller.messages_published.items()],
+    )
+    writer.metric(
+        "mqtt_led_sts_unchanged_total",
+        "counter",
+        "sts messages identical to the last one applied, skipped without decoding",
+        mqtt_controller.sts_unchanged,
+    )
+    writer.histogram(
+        "mqtt_led_sts_parse_seconds",
+        "Time to decode and apply one sts message",
+        mqtt_controller.parse_time,
+    )
+    writer.metric(
+        "mqtt_led_mqtt_connected", "gauge", "1 if connected to the broker", int(client.is_connected())
+    )
+    writer.metric(
+        "mqtt_led_mqtt_inflight_messages",
+        "gauge",
+        "QoS>0 messages published but not yet acknowledged by the broker",
+        getattr(client, "_inflight_messages", 0),
+    )
+    writer.metric(
+        "mqtt_led_mqtt_out_packets",
+        "gauge",
+        "MQTT packets waiting to be written to the socket",
+        len(getattr(client, "_out_packet", ())),
+    )
+
+    window = mqtt_controller.publish_window
+    writer.metric(
+        "mqtt_led_publish_window_messages_total",
+        "counter",
+        "Messages handled by the publish window, published by QoS (retries included)",
+        [({"result": "published", "qos": str(qos)}, count) for qos, count in window.published.items()]
+        + [
+            ({"result": "acknowledged"}, window.acknowledged),
+            ({"result": "retried"}, window.retries),
+            ({"result": "failed"}, window.failed),
+            ({"result": "superseded"}, window.superseded),
+        ],
+    )
+    writer.metric(
+        "mqtt_led_publish_window_in_flight",
+        "gauge",
+        "QoS 1 messages published but not yet acknowledged by the broker",
+        window.in_flight,
+    )
+    writer.metric(
+        "mqtt_led_publish_window_queued",
+        "gauge",
+        "QoS 1 messages waiting for room in the publish window",
+        window.queued,
+    )
+    writer.histogram(
+        "mqtt_led_publish_ack_seconds",
+        "Time from publishing a QoS 1 message until the broker acknowledged it",
+        window.ack_time,
+    )
+
+    scheduler = mqtt_controller.publish_scheduler
+    writer.metric(
+        "mqtt_led_publish_queue_depth", "gauge", "Devices waiting to be published", scheduler.queue_depth
+    )
+    writer.metric(
+        "mqtt_led_publish_frames_total",
+        "counter",
+        "Frames handled by the publish scheduler",
+        [
+            ({"result": "requested"}, scheduler.frames_requested),
+            ({"result": "published"}, scheduler.frames_published),
+            ({"result": "coalesced"}, scheduler.frames_coalesced),
+            ({"result": "dropped"}, scheduler.frames_dropped),
+        ],
+    )
+
+    pipeline = mqtt_controller.ingest_pipeline
+    writer.metric(
+        "mqtt_led_ingest_queue_depth", "gauge", "Received messages waiting to be applied", pipeline.queue_depth
+    )
+    writer.metric(
+        "mqtt_led_ingest_messages_total",
+        "counter",
+        "Messages handled by the ingest pipeline",
+        [
+            ({"result": "received"}, pipeline.messages_received),
+            ({"result": "dropped"}, pipeline.messages_dropped),
+            ({"result": "deduplicated"}, pipeline.messages_deduplicated),
+        ],
+    )
+    writer.metric("mqtt_led_ingest_batches_total", "counter", "Batches applied", pipeline.batches)
+
+    effect_engine = mqtt_controller.effect_engine
+    writer.metric(
+        "mqtt_led_effect_devices", "gauge", "Devices playing an effect", effect_engine.active_devices
+    )
+    writer.metric(
+        "mqtt_led_effect_ticks_skipped_total",
+        "counter",
+        "Effect clock ticks skipped because the loop was late",
+        effect_engine.ticks_skipped,
+    )
+
+    scenes = mqtt_controller.scenes
+    writer.metric(
+        "mqtt_led_scene_cache_total",
+        "counter",
+        "Lookups of compiled scene commands",
+        [
+            ({"result": "hit"}, scenes.cache_hits),
+            ({"result": "miss"}, scenes.cache_misses),
+            ({"result": "evicted"}, scenes.cache_evictions),
+        ],
+    )
+    writer.metric(
+        "mqtt_led_scenes_applied_total", "counter", "Scenes applied", scenes.scenes_applied
+    )
+
+    liveness = mqtt_controller.liveness
+    if liveness is not None:
+        writer.metric(
+            "mqtt_led_liveness_transitions_total",
+            "counter",
+            "Devices marked offline for sending nothing within DEVICE_TIMEOUT, and back online",
+            [
+                ({"result": "expired"}, liveness.devices_expired),
+                ({"result": "revived"}, liveness.devices_revived),
+            ],
+        )
+        writer.metric(
+            "mqtt_led_liveness_checks_total",
+            "counter",
+            "Devices looked at by the liveness timer wheel",
+            liveness.devices_checked,
+        )
+        writer.metric(
+            "mqtt_led_liveness_tracked_devices", "gauge", "Devices in the liveness timer wheel", liveness.tracked_devices
+        )
+
+    history = mqtt_controller.history
+    if history is not None:
+        writer.metric(
+            "mqtt_led_history_memory_bytes", "gauge", "Memory used by the LED state history", history.memory_used
+        )
+        writer.metric(
+            "mqtt_led_history_records_total", "counter", "LED state changes recorded", history.records
+        )
+        writer.metric(
+            "mqtt_led_history_segments_evicted_total",
+            "counter",
+            "History segments evicted to stay within the memory budget",
+            history.segments_evicted,
+        )
+
+    writer.metric("mqtt_led_devices", "gauge", "Known devices", len(device_manager))
+    writer.metric("mqtt_led_devices_online", "gauge", "Online devices", device_manager.online_count)
+    now = time.monotonic()
+    writer.metric(
+        "mqtt_led_device_last_seen_age_seconds",
+        "gauge",
+        "Seconds since the last message of a device",
+        [
+            ({"device": device.device_id}, round(now - device.last_seen, 3))
+            for device in device_manager.devices
+            if device.last_seen is not None
+        ],
+    )
+
+    writer.metric("mqtt_led_browser_clients", "gauge", "Connected browser clients", browser_clients)
+    if loop_monitor is not None:
+        writer.histogram(
+            "mqtt_led_event_loop_lag_seconds", "Delay of event loop wakeups", loop_monitor.histogram
+        )
+        writer.metric(
+            "mqtt_led_event_loop_lag_max_seconds", "gauge", "Largest event loop lag seen", loop_monitor.max_lag
+        )
+    if startup_timer is not None:
+        writer.metric(
+            "mqtt_led_startup_seconds",
+            "gauge",
+            "Seconds from process start until each startup phase was reached",
+            [({"phase": phase}, round(elapsed, 4)) for phase, elapsed in startup_timer.phases.items()],
+        )
+    return writer.text()
+
+
+def add_metrics_route(
+    app,
+    mqtt_controller,
+    path: str = "/metrics",
+    startup_timer: StartupTimer = None,
+    token: str = "",
+) -> LoopLagMonitor:
+    # serves render_metrics() on the NiceGUI app, returns the loop lag monitor;
+    # with a token a scrape needs "Authorization: Bearer <token>"
+    import hmac
+
+    from fastapi import Request
+    from fastapi.responses import PlainTextResponse
+
+    loop_monitor = LoopLagMonitor()
+    browser_clients = {"count": 0}
+
+    def on_connect():
+        browser_clients["count"] += 1
+
+    def on_disconnect():
+        browser_clients["count"] = max(0, browser_clients["count"] - 1)
+
+    app.on_connect(on_connect)
+    app.on_disconnect(on_disconnect)
+    app.on_startup(loop_monitor.start)
+    app.on_shutdown(loop_monitor.stop)
+
+    @app.get(path)
+    async def metrics(request: Request):
+        given = request.headers.get("authorization", "").removeprefix("Bearer ")
+        if token and not hmac.compare_digest(given.encode(), token.encode()):
+            return PlainTextResponse("Invalid token\n", status_code=401)
+        return PlainTextResponse(
+            render_metrics(mqtt_controller, browser_clients["count"], loop_monitor, startup_timer),
+            media_type="text/plain; version=0.0.4",
+        )
+
+    return loop_monitor
@@ -1,19 +1,77 @@
+import asyncio
 import json
 import logging
 import time
 
 import paho.mqtt.client as mqtt
-from device_manager import Device, DeviceManager
-from nicegui import ui
+from change_events import Event
+from device_manager import Device, DeviceManager, parse_color
+from effects import EffectEngine
+from ingest_pipeline import IngestPipeline
+from liveness import LivenessMonitor
+from led_codec import (
+    DeltaEncoder,
+    decode_lights,
+    encode_command,
+    encode_lights,
+    loads,
+    status_digest,
+)
+from metrics import PARSE_TIME_BUCKETS, Histogram
+from mqtt_transport import AsyncioMQTTTransport
+from publish_scheduler import PublishScheduler
+from publish_window import PublishWindow
+from scenes import SceneEngine
+from state_history import StateHistory
+from settings import (
+    DELTA_KEYFRAME_INTERVAL,
+    DEVICE_TIMEOUT,
+    DEVICE_TIMEOUT_PRECISION,
+    EFFECT_ENGINE_FPS,
+    ENABLE_DELTA_PUBLISHING,
+    HISTORY_MEMORY_BUDGET,
+    INGEST_QUEUE_SIZE,
+    MAX_PUBLISH_RATE_HZ,
+    MQTT_TRANSPORT,
+    PUBLISH_ACK_TIMEOUT,
+    PUBLISH_MAX_IN_FLIGHT,
+    PUBLISH_MAX_RETRIES,
+    PUBLISH_QOS,
+    SCENE_CACHE_SIZE,
+    SCENES_PATH,
+    UI_RENDER_INTERVAL,
+)
 
 topic_main = "lightstrips"
 topic_broadcast_command = topic_main + "/" + "cmd"
 topic_state = topic_main + "/+/" + "sts"
 topic_last_will = topic_main + "/+/" + "last-will"
+topic_heartbeat = topic_main + "/+/" + "heartbeat"
 topics = [topic_broadcast_command + "/" + str(i) for i in range(12)]
 topics2 = topic_broadcast_command + "/" + "all"
 
 
+def group_command_topic(group: str = None) -> str:
+    # lightstrips/cmd/<group>, lightstrips/cmd/all for every device
+    if group is None:
+        return topics2
+    return topic_broadcast_command + "/" + group
+
+
+def valid_group(group: str) -> bool:
+    # a group name is one topic level of lightstrips/cmd/<group>: not empty,
+    # no wildcards or separators, and not "all", the topic of every device
+    return bool(group) and group != "all" and not any(c in group for c in "+#/")
+
+
+def _string_list(data: dict, key: str):
+    # data[key] if it is a list of strings, None if the key is missing
+    value = data.get(key)
+    if value is not None and not (isinstance(value, list) and all(isinstance(item, str) for item in value)):
+        raise ValueError(f"{key} is not a list of strings")
+    return value
+
+
 class MQTTController:
     def __init__(
             self,
@@ -21,183 +79,420 @@ class MQTTController:
             broker_port: int,
             broker_username: str,
             broker_password: str,
+            transport: str = MQTT_TRANSPORT,
     ):
         self.broker_address = broker_address
         self.broker_port = broker_port
         self.broker_username = broker_username
         self.broker_password = broker_password
         self.client = mqtt.Client()
+        self.transport_mode = transport  # "asyncio" or "thread"
+        self.transport = None
+        self._loop = None
+        self.connection_changed = Event()  # emits True/False on (dis)connect
+        self.message_received = Event()  # emits (topic, payload) as each message arrives
+        self.subscribed = Event()  # emitted when the broker acknowledged a subscription
         self.device_manager = DeviceManager()
+        self.delta_encoder = (
+            DeltaEncoder(DELTA_KEYFRAME_INTERVAL) if ENABLE_DELTA_PUBLISHING else None
+        )
+        self.publish_window = PublishWindow(
+            self._client_publish,
+            PUBLISH_MAX_IN_FLIGHT,
+            PUBLISH_ACK_TIMEOUT,
+            PUBLISH_MAX_RETRIES,
+            lambda: self.client.is_connected(),
+        )
+        self.publish_scheduler = PublishScheduler(
+            self.publish_color, MAX_PUBLISH_RATE_HZ, lambda: not self.publish_window.full
+        )
+        self.publish_window.capacity_available.subscribe(self.publish_scheduler.resume)
+        self.ingest_pipeline = IngestPipeline(
+            self.handle_message_batch, INGEST_QUEUE_SIZE, UI_RENDER_INTERVAL
+        )
+        self.effect_engine = EffectEngine(self.publish_batch, EFFECT_ENGINE_FPS)
+        self.history = (
+            StateHistory(self.device_manager, HISTORY_MEMORY_BUDGET) if HISTORY_MEMORY_BUDGET else None
+        )
+        self.liveness = (
+            LivenessMonitor(self.device_manager, DEVICE_TIMEOUT, DEVICE_TIMEOUT_PRECISION)
+            if DEVICE_TIMEOUT
+            else None
+        )
+        self._stale_retained = set()  # devices whose retained command predates a group command
+        self.scenes = SceneEngine(self, SCENES_PATH, SCENE_CACHE_SIZE)
+
+        self.messages_received = {"sts": 0, "last-will": 0, "heartbeat": 0, "other": 0}
+        self.messages_published = {"cmd": 0, "delta": 0, "group": 0, "scene": 0, "clear": 0}
+        self.parse_time = Histogram(PARSE_TIME_BUCKETS)
+        self.sts_unchanged = 0  # sts messages skipped by parse_json_message
 
     @property
     def mqtt_connected(self):
         return self.client.is_connected()
 
-    def connect_to_mqtt(self):
+    def _setup_client(self):
         self.client.username_pw_set(self.broker_username, self.broker_password)
+        # the publish window limits the messages in flight, paho would
+        # otherwise queue QoS 1 messages beyond its default of 20 itself
+        self.client.max_inflight_messages_set(max(PUBLISH_MAX_IN_FLIGHT, 20))
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_publish = self._on_publish
+        self.client.on_subscribe = self._on_subscribe
         self.client.on_disconnect = self._on_disconnect
 
-        try:
-            self.client.connect(self.broker_address, self.broker_port)
-            self.client.loop_start()
-        except ConnectionRefusedError:
+    def _connection_error(self, error: Exception) -> str:
+        if isinstance(error, ConnectionRefusedError):
             logging.error("MQTT connection refused")
             return "MQTT connection refused"
-        except TimeoutError:
+        if isinstance(error, TimeoutError):
             logging.error("MQTT connection timed out")
             return "MQTT connection timed out"
+        logging.error(f"MQTT connection error: {error}")
+        return "MQTT connection error: " + str(error)
+
+    def connect_to_mqtt(self):
+        # blocking connect, the client runs in paho's loop_start() thread
+        self._setup_client()
+        try:
+            self.client.connect(self.broker_address, self.broker_port)
+            self.client.loop_start()
         except Exception as e:
-            logging.error("MQTT connection error:", str(e))
-            return "MQTT connection error: " + str(e)
+            return self._connection_error(e)
+        else:
+            return "Connected to MQTT broker " + self.broker_address
+
+    async def connect_to_mqtt_async(self):
+        # non-blocking connect, with the "asyncio" transport the client runs on
+        # the event loop so all callbacks share the loop with the UI
+        loop = self._loop = asyncio.get_running_loop()
+        if self.transport_mode != "asyncio":
+            return await loop.run_in_executor(None, self.connect_to_mqtt)
+
+        self._setup_client()
+        if self.transport is None:
+            self.transport = AsyncioMQTTTransport(self.client, loop)
+        try:
+            await self.transport.connect(self.broker_address, self.broker_port)
+        except Exception as e:
+            return self._connection_error(e)
         else:
             return "Connected to MQTT broker " + self.broker_address
 
     def disconnect_from_mqtt(self):
-        self.client.loop_stop()
-        self.client.disconnect()
+        if self.transport is not None:
+            self.transport.disconnect()
+        else:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+    def _call_on_loop(self, callback, *args):
+        # in "thread" mode paho calls back from its own thread
+        if self._loop is not None and self.transport_mode != "asyncio":
+            self._loop.call_soon_threadsafe(callback, *args)
+        else:
+            callback(*args)
 
     def _on_connect(self, client, userdata, flags, rc):
         logging.info("Connected to MQTT broker with result code " + str(rc))
         client.subscribe(topic_last_will)
         client.subscribe(topic_state)
+        if self.liveness is not None:
+            client.subscribe(topic_heartbeat)
+        if self.delta_encoder is not None:
+            # the devices may have missed commands while we were away
+            self.delta_encoder.reset()
 
-        ui.status_label.text = "Connected to MQTT broker " + self.broker_address
-        ui.broker_address_textbox.enabled = False
-        ui.broker_port_textbox.enabled = False
-        ui.connect_button.props("color=negative")
+        self._call_on_loop(self.connection_changed.emit, True)
 
     def _on_message(self, client, userdata, msg):
-        # logging.info("Received message: " + msg.topic + " " + str(msg.payload))
-        _topic_parts = msg.topic.split("/")
+        topic_type = msg.topic[msg.topic.rfind("/") + 1 :]
+        if topic_type in self.messages_received:
+            self.messages_received[topic_type] += 1
+        else:
+            self.messages_received["other"] += 1
+        if self.message_received:
+            self.message_received.emit(msg.topic, msg.payload)
+        # queued and applied once per render tick when the pipeline is running
+        if self.ingest_pipeline.running:
+            self.ingest_pipeline.put(msg.topic, msg.payload)
+        else:
+            self.handle_message(msg.topic, msg.payload)
+
+    def handle_message_batch(self, messages: dict):
+        for topic, payload in messages.items():
+            # one bad message must not cost the others of the tick
+            try:
+                self.handle_message(topic, payload)
+            except Exception:
+                logging.exception(f"Handling the message on {topic} failed")
+
+    def handle_message(self, topic: str, payload: bytes):
+        _topic_parts = topic.split("/")
+        if len(_topic_parts) < 3:
+            logging.info(f"Unexpected topic {topic}")
+            return
         _device_id = _topic_parts[1]
-        logging.info(f'Topic: {msg.topic}')
-        logging.info(f'Device ID: {_device_id}')
+        logging.debug("Topic: %s", topic)  # formatted only when enabled, this runs per message
 
-        for _device_number, _device in enumerate(self.device_manager.devices):
-            if _device_id == _device.device_id:
-                break
-        else:
-            logging.info(f"New device found - adding {_device_id} to device manager")
-            self.device_manager.add_device(Device(_device_id))
-            _device_number = len(self.device_manager.devices) - 1
-            _device = self.device_manager.devices[_device_number]
+        _device, _created = self.device_manager.get_or_add_device(_device_id)
+        if _created:
+            logging.info(f"New device found - added {_device_id} to device manager")
+        _device.last_seen = time.monotonic()
 
         if _topic_parts[2] == "sts":
-            self.parse_json_message(msg.payload, _device)
+            start = time.perf_counter()
+            self.parse_json_message(payload, _device)
+            self.parse_time.observe(time.perf_counter() - start)
         elif _topic_parts[2] == "last-will":
-            self.parse_last_will(msg.payload, _device)
+            self.parse_last_will(payload, _device)
+        if self.liveness is not None and _topic_parts[2] != "last-will":
+            self.liveness.seen(_device)  # sts or heartbeat
 
     def _on_publish(self, client, userdata, mid):
-        logging.info("Message published")
+        self._call_on_loop(self.publish_window.on_publish, mid)
 
-    def _on_disconnect(self, client, userdata, rc):
-        logging.info("Disconnected from MQTT broker")
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        self._call_on_loop(self.subscribed.emit)
+
+    def _client_publish(self, topic: str, payload, qos: int, retain: bool):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
 
-        ui.status_label.text = "Disconnected from MQTT broker"
+    def _qos(self, device, qos: int = None) -> int:
+        # per command, else per device, else PUBLISH_QOS
+        if qos is not None:
+            return qos
+        return PUBLISH_QOS if device.qos is None else device.qos
 
-        ui.broker_port_textbox.enabled = True
-        ui.broker_address_textbox.enabled = True
+    def _on_disconnect(self, client, userdata, rc):
+        logging.info("Disconnected from MQTT broker")
+        self._call_on_loop(self._handle_disconnect)
 
-        for device in self.device_manager.devices:
-            device.online = False
+    def _handle_disconnect(self):
+        self.publish_scheduler.drop()
+        if self.liveness is not None:
+            self.liveness.reset()
+        self.device_manager.set_online(self.device_manager.devices, False)
 
-        ui.connect_button.props("color=positive")
-        ui.notify("Disconnected from MQTT broker", type="negative")
+        self.connection_changed.emit(False)
 
     def parse_json_message(self, json_message, device: Device):
+        # An sts identical to the last one applied is skipped without decoding,
+        # unless the frame was changed locally since (e.g. a command the device
+        # did not apply). Otherwise the lights are decoded into a new frame and
+        # only the LEDs that differ are reported.
+        digest = status_digest(json_message)
+        last_status = device.last_status
+        if last_status is not None and last_status[0] == digest and last_status[1] == device.frame:
+            self.sts_unchanged += 1
+            if self.delta_encoder is not None:
+                self.delta_encoder.acknowledge(device.device_id, device.frame)
+            return device.frame, device.led_count
+
         led_count = 0
         try:
-            data = json.loads(json_message)
+            # the whole message is validated before anything is applied
+            data = loads(json_message)
+            if not isinstance(data, dict):
+                raise ValueError("the message is not an object")
             lights = data.get("lights", {})
-
-            for led_index, color_data in lights.items():
-                led_count += 1
-
-            device.led_count = led_count    
-
-            for led_index, color_data in lights.items():
-                red = color_data.get("red", 0)
-                green = color_data.get("green", 0)
-                blue = color_data.get("blue", 0)
-                color_hex = "#{:02x}{:02x}{:02x}".format(red, green, blue)
-                device.update_lights(int(led_index), color_hex)
-                try:
-                    ui.led_buttons[device][int(led_index)].style(f"color:{color_hex}!important")           
-                except IndexError:
-                    logging.debug("Index out of range")
-                except KeyError:
-                    logging.debug("Key not found")
-
-        except json.JSONDecodeError:
-            logging.info("Invalid JSON message")
-
-        logging.info(f'LED lights: {device.lights}')
-        logging.info(f'LED count: {device.led_count}')
-        return device.lights, led_count
+            if not isinstance(lights, dict):
+                raise ValueError("lights is not an object")
+            # raises for colors that are not objects or channels that are not 0-255 integers
+            frame = decode_lights(lights)
+            del lights
+            capabilities = _string_list(data, "capabilities")
+            groups = _string_list(data, "groups")
+            del data
+
+            if capabilities is not None:
+                device.capabilities = set(capabilities)
+            if groups is not None:
+                invalid = [group for group in groups if not valid_group(group)]
+                if invalid:
+                    logging.info(f"Ignoring the invalid groups {invalid} of {device.device_id}")
+                    groups = [group for group in groups if valid_group(group)]
+                self.device_manager.set_groups(device.device_id, groups)
+            led_count = len(frame) // 3
+            changed_leds = device.update_frame(frame)
+            device.last_status = (digest, bytes(frame))
+
+            if self.delta_encoder is not None:
+                self.delta_encoder.acknowledge(device.device_id, device.frame)
+
+            if changed_leds:
+                device.notify_lights_changed(changed_leds)
+
+        except (ValueError, TypeError, AttributeError) as e:  # ValueError includes the JSON decode errors
+            logging.info(f"Invalid sts message from {device.device_id}: {e}")
+
+        return device.frame, led_count
 
     def parse_last_will(self, msg_payload, _device: Device):
-        if msg_payload.decode() == "offline":
+        status = msg_payload.decode(errors="replace")
+        if status == "offline":
             _device.online = False
-
-        elif msg_payload.decode() == "online":
-            _device.online = True      
+            if self.liveness is not None:
+                self.liveness.forget(_device.device_id)
+
+        elif status == "online":
+            _device.online = True
+            stale_retained = _device.device_id in self._stale_retained
+            if self.delta_encoder is not None:
+                self.delta_encoder.reset(_device.device_id)
+                stale_retained = stale_retained or self.delta_encoder.needs_retained_keyframe(
+                    _device.device_id
+                )
+            if _device.retain and stale_retained:
+                # the retained command is older than the deltas or group
+                # commands sent since
+                self.send_color(_device)
 
         else:
             logging.info("the last message is not recognized")
 
-        logging.info(f'Online: {_device.online}')
+        logging.debug(f'Online: {_device.online}')
 
     def send_color(self, device):
-        payload = {"device-id": device.device_id, "lights": {}}
-        for led_index, color in enumerate(device.lights):
-            red, green, blue = (
-                int(color[1:3], 16),
-                int(color[3:5], 16),
-                int(color[5:7], 16),
-            )
-            payload["lights"][str(led_index)] = {
-                "red": red,
-                "green": green,
-                "blue": blue,
-            }
-        self.client.publish(
-            topic_main + "/" + device.device_id + "/cmd",
-            json.dumps(payload),
-            retain=device.retain,
+        # coalesced through the publish scheduler once it runs on the event loop
+        if self.publish_scheduler.running:
+            self.publish_scheduler.mark_dirty(device)
+        else:
+            self.publish_color(device)
+
+    def publish_batch(self, devices):
+        # publishes the frames of several devices at once (e.g. one tick of the
+        # effect engine), pending scheduler frames of these devices are stale.
+        # Devices showing the same frame share one encoded lights map.
+        lights_pool = {}
+        for device in devices:
+            self.publish_scheduler.drop(device.device_id)
+            self.publish_color(device, lights_pool)
+
+    def set_group_color(self, color, group: str = None, qos: int = None) -> int:
+        # sets every LED of the devices in `group` (None: all devices) to
+        # `color` and publishes it, returns the number of messages sent
+        if isinstance(color, str):
+            color = parse_color(color)
+        devices = self.device_manager.get_group_devices(group)
+        frames = {}
+        for device in devices:
+            frame = frames.get(device.led_count)
+            if frame is None:
+                frame = frames[device.led_count] = bytes(color) * device.led_count
+            device.set_frame(frame)
+        return self.publish_group(devices, group, qos)
+
+    def publish_group(self, devices, group: str = None, qos: int = None) -> int:
+        # one command on the group (or broadcast) topic when every member
+        # supports it and shows the same frame, one command per device otherwise
+        if not devices:
+            return 0
+        if group is not None and not valid_group(group):
+            logging.info(f"{group!r} is not a valid group topic, publishing to each device")
+            self.publish_batch(devices)
+            return len(devices)
+        frame = devices[0].frame
+        if not all(
+            "broadcast" in device.capabilities and device.frame == frame
+            for device in devices
+        ):
+            self.publish_batch(devices)
+            return len(devices)
+
+        for device in devices:
+            self.publish_scheduler.drop(device.device_id)
+            if device.retain:
+                # group commands are not retained, the next time the device
+                # comes online it gets its own command again
+                self._stale_retained.add(device.device_id)
+        self.publish_window.publish(
+            group_command_topic(group),
+            encode_command(group or "all", encode_lights(frame)),
+            PUBLISH_QOS if qos is None else qos,
+            key=group_command_topic(group),
         )
-
-    def delete_retained_messages(self, device):
+        self.messages_published["group"] += 1
+        return 1
+
+    def publish_color(self, device, lights_pool: dict = None, qos: int = None):
+        # returns the future of publish_window.publish()
+        retain = device.retain
+        if self.delta_encoder is not None and "delta" in device.capabilities:
+            payload, keyframe = self.delta_encoder.encode(
+                device.device_id, device.frame, retain
+            )
+            if payload is None:
+                return None
+            # a retained delta would be replayed without its keyframe
+            retain = retain and keyframe
+            self.messages_published["cmd" if keyframe else "delta"] += 1
+        else:
+            self.messages_published["cmd"] += 1
+            payload = encode_command(
+                device.device_id, self._encode_lights(device.frame, lights_pool)
+            )
+        return self._publish_command(device, payload, retain, qos)
+
+    def publish_payload(self, device, payload, qos: int = None):
+        # publishes a full command encoded beforehand (e.g. a compiled scene)
+        # for the current frame of `device`
+        if self.delta_encoder is not None and "delta" in device.capabilities:
+            self.delta_encoder.keyframe_sent(device.device_id, device.retain)
+        return self._publish_command(device, payload, device.retain, qos)
+
+    def _publish_command(self, device, payload, retain: bool, qos: int = None):
+        if retain:
+            self._stale_retained.discard(device.device_id)
+
+        topic = topic_main + "/" + device.device_id + "/cmd"
+        # a newer frame replaces one still waiting for room in the window
+        return self.publish_window.publish(topic, payload, self._qos(device, qos), retain, topic)
+
+    @staticmethod
+    def _encode_lights(frame, lights_pool: dict = None) -> str:
+        if lights_pool is None:
+            return encode_lights(frame)
+        key = bytes(frame)
+        lights = lights_pool.get(key)
+        if lights is None:
+            lights = lights_pool[key] = encode_lights(frame)
+        return lights
+
+    def delete_retained_messages(self, device, qos: int = None):
         payload = ""
-        self.client.publish(
+        qos = self._qos(device, qos)
+        self.messages_published["clear"] += 2
+        self.publish_window.publish(
             topic_main + "/" + device.device_id + "/cmd",
             json.dumps(payload),
+            qos,
             retain=True,
         )
-        self.client.publish(
+        self.publish_window.publish(
             topic_main + "/cmd",
             json.dumps(payload),
+            qos,
             retain=True,
         )
 
-    def test_performance(self, device):
-
-        # Start the performance timer
-        start_time = time.time()
-
-
-
-        # Send the color message
-        self.send_color(device)
-
-        # Wait for the device to change its light status
-        while device.lights != device.target_lights:
-            pass
-
-        # Calculate the elapsed time
-        elapsed_time = time.time() - start_time
-
-        # Print the elapsed time
-        print(f"Elapsed time: {elapsed_time} seconds")
+    async def test_performance(
+        self, device, cycles: int = 100, in_flight: int = 1, timeout: float = 5.0
+    ):
+        # command to sts round trip times of `device` as a LatencyResult, see latency_probe.py
+        from latency_probe import LatencyProbe  # imported on first use, it is optional
+
+        result = await LatencyProbe(self, device, cycles, in_flight, timeout).run()
+        logging.info(result.format_summary())
+        return result
+
+    async def replay_history(
+        self, start: float, end: float = None, speed: float = 1.0, device_ids=None
+    ) -> int:
+        # publishes the recorded LED states between start and end (time.time()
+        # timestamps) again, see state_history.py
+        if self.history is None:
+            logging.info("The LED state history is off (HISTORY_MEMORY_BUDGET = 0)")
+            return 0
+        return await self.history.replay(self, start, end, speed, device_ids)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+
+class AsyncioMQTTTransport:
+    # Runs a paho client on an asyncio event loop instead of loop_start().
+    # The socket is watched with add_reader/add_writer, so all paho callbacks
+    # run on the loop. The blocking TCP connect runs in the default executor
+    # and lost connections are re-established with exponential backoff.
+
+    def __init__(
+        self,
+        client: mqtt.Client,
+        loop: asyncio.AbstractEventLoop,
+        min_reconnect_delay: float = 1.0,
+        max_reconnect_delay: float = 60.0,
+    ):
+        self.client = client
+        self.loop = loop
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._loop_thread = None
+        self._misc_task = None
+        self._reconnect_task = None
+        self._closing = False
+        self.reconnect_attempts = 0
+
+        client.on_socket_open = self._threadsafe(self._on_socket_open)
+        client.on_socket_close = self._threadsafe(self._on_socket_close)
+        client.on_socket_register_write = self._threadsafe(self._on_socket_register_write)
+        client.on_socket_unregister_write = self._threadsafe(
+            self._on_socket_unregister_write
+        )
+
+    async def connect(self, host: str, port: int, keepalive: int = 60) -> None:
+        self._loop_thread = threading.get_ident()
+        self._closing = False
+        self._cancel_reconnect()
+        await self.loop.run_in_executor(None, self.client.connect, host, port, keepalive)
+
+    def disconnect(self) -> None:
+        self._closing = True
+        self._cancel_reconnect()
+        self.client.disconnect()
+
+    def _threadsafe(self, callback):
+        # paho calls the socket callbacks from the executor thread while connecting
+        def wrapper(client, userdata, sock):
+            if threading.get_ident() == self._loop_thread:
+                callback(client, userdata, sock)
+            else:
+                self.loop.call_soon_threadsafe(callback, client, userdata, sock)
+
+        return wrapper
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        if not self._closing:
+            self._schedule_reconnect()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # keepalive pings and timeouts
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = self.loop.create_task(self._reconnect_loop())
+
+    def _cancel_reconnect(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+
+    async def _reconnect_loop(self):
+        delay = self.min_reconnect_delay
+        while not self._closing:
+            await asyncio.sleep(delay)
+            self.reconnect_attempts += 1
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            except (OSError, mqtt.WebsocketConnectionError) as e:
+                delay = min(2 * delay, self.max_reconnect_delay)
+                logging.info(f"MQTT reconnect failed ({e}), next attempt in {delay}s")
+            else:
+                logging.info("Reconnected to MQTT broker")
+                return
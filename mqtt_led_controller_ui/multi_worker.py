@@ -0,0 +1,409 @@
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from change_events import Event
+from device_manager import TEST_DEVICE_IDS, DeviceManager
+from shared_state import SharedStateReader, SharedStateWriter
+
+# Serving the UI from several processes: one ingest process owns the
+# MQTTController (MQTT, publish scheduler, effects, history, store) and
+# mirrors the device registry into shared memory. Every UI worker process
+# runs its own NiceGUI server on its own port, reads the device state from
+# shared memory and forwards commands to the ingest process through a queue.
+# Replies (connect result, effect done, latency results) come back on a queue
+# per worker. NiceGUI keeps the page state per process, so a load balancer in
+# front of the workers has to keep a browser on one worker (sticky sessions).
+#
+# usage: python multi_worker.py --workers 4 --port 8080
+#        python main.py --workers 4 --port 8080
+
+
+class CommandHandler:
+    # Executes the commands of the UI workers in the ingest process. Every
+    # command is (worker index, call id or None, name, args); only the
+    # methods below named "_<name>" can be called.
+
+    def __init__(self, mqtt_controller, replies: list):
+        self.mqtt_controller = mqtt_controller
+        self.device_manager = mqtt_controller.device_manager
+        self.replies = replies
+        self.commands_handled = 0
+
+    def listen(self, commands, loop) -> threading.Thread:
+        # reads the command queue in a thread, the commands run on `loop`
+        def run():
+            while True:
+                command = commands.get()
+                if command is None:
+                    return
+                asyncio.run_coroutine_threadsafe(self.handle(*command), loop)
+
+        thread = threading.Thread(target=run, name="commands", daemon=True)
+        thread.start()
+        return thread
+
+    async def handle(self, worker: int, call_id, name: str, args: tuple) -> None:
+        result = error = None
+        try:
+            result = getattr(self, "_" + name)(*args)
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            logging.exception(f"Command {name} of worker {worker} failed")
+            error = repr(e)
+        self.commands_handled += 1
+        if call_id is not None:
+            self.replies[worker].put((call_id, result, error))
+
+    def _device(self, device_id: str):
+        device = self.device_manager.get_device(device_id)
+        if device is None:
+            raise KeyError(f"Unknown device {device_id}")
+        return device
+
+    def _set_frame(self, device_id: str, frame: bytes, retain: bool) -> None:
+        device = self._device(device_id)
+        device.retain = retain
+        device.set_frame(frame)
+        self.mqtt_controller.send_color(device)
+
+    def _set_group_color(self, color, group: str) -> int:
+        return self.mqtt_controller.set_group_color(color, group)
+
+    def _delete_retained_messages(self, device_id: str, retain: bool) -> None:
+        device = self._device(device_id)
+        device.retain = retain
+        self.mqtt_controller.delete_retained_messages(device)
+
+    def _play(self, device_id: str, effect: str, cycles, frame_rate, params: dict):
+        return self.mqtt_controller.effect_engine.play(
+            self._device(device_id), effect, cycles, frame_rate, **params
+        )
+
+    def _test_performance(self, device_id: str, cycles: int, in_flight: int, timeout: float):
+        return self.mqtt_controller.test_performance(
+            self._device(device_id), cycles, in_flight, timeout
+        )
+
+    def _apply_scene(self, name: str, qos) -> int:
+        return self.mqtt_controller.scenes.apply(name, qos)
+
+    def _capture_scene(self, name: str, device_ids) -> None:
+        devices = None if device_ids is None else [self._device(device_id) for device_id in device_ids]
+        self.mqtt_controller.scenes.capture(name, devices)
+
+    def _connect(self):
+        return self.mqtt_controller.connect_to_mqtt_async()
+
+    def _disconnect(self) -> None:
+        self.mqtt_controller.disconnect_from_mqtt()
+
+
+class _RemoteEffectEngine:
+    def __init__(self, remote_controller):
+        self._remote_controller = remote_controller
+
+    def play(self, device, effect: str, cycles: int = None, frame_rate: float = None, **params):
+        return self._remote_controller.call(
+            "play", device.device_id, effect, cycles, frame_rate, params
+        )
+
+
+class _RemoteScenes:
+    # the scene names are read from the scenes file the ingest process writes
+    def __init__(self, remote_controller, path: str):
+        self._remote_controller = remote_controller
+        self._path = path
+        self._saved = set()  # captured here, possibly not written yet
+
+    @property
+    def names(self) -> list:
+        names = set(self._saved)
+        if self._path and os.path.exists(self._path):
+            try:
+                with open(self._path, encoding="utf-8") as file:
+                    names.update(json.load(file))
+            except (OSError, ValueError):
+                pass
+        return sorted(names)
+
+    def apply(self, name: str, qos: int = None) -> int:
+        # the messages are counted in the ingest process
+        self._remote_controller.send("apply_scene", name, qos)
+        return 0
+
+    def capture(self, name: str, devices=None) -> None:
+        device_ids = None if devices is None else [device.device_id for device in devices]
+        self._saved.add(name)
+        self._remote_controller.send("capture_scene", name, device_ids)
+
+
+class RemoteController:
+    # Stands in for MQTTController in a UI worker, with the attributes the UI
+    # elements use. The devices are read from shared memory into a local
+    # DeviceManager; everything that publishes runs in the ingest process.
+
+    def __init__(
+        self,
+        state_name: str,
+        commands,
+        replies,
+        worker: int,
+        broker_address: str = "",
+        broker_port: int = 0,
+        scenes_path: str = "",
+    ):
+        self.broker_address = broker_address
+        self.broker_port = broker_port
+        self.device_manager = DeviceManager()
+        self.connection_changed = Event()
+        self.reader = SharedStateReader(state_name, self.device_manager)
+        self.reader.connection_changed = self.connection_changed
+        self.effect_engine = _RemoteEffectEngine(self)
+        self.scenes = _RemoteScenes(self, scenes_path)
+        self.client = self  # the UI calls client.is_connected()
+        self._commands = commands
+        self._replies = replies
+        self._worker = worker
+        self._pending = {}
+        self._next_call_id = 0
+        self._loop = None
+
+    def is_connected(self) -> bool:
+        return self.reader.connected
+
+    @property
+    def mqtt_connected(self):
+        return self.reader.connected
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self.reader.poll()
+        self.reader.start()
+        threading.Thread(target=self._read_replies, name="replies", daemon=True).start()
+
+    def stop(self) -> None:
+        self.reader.close()
+
+    def _read_replies(self) -> None:
+        while True:
+            call_id, result, error = self._replies.get()
+            self._loop.call_soon_threadsafe(self._resolve, call_id, result, error)
+
+    def _resolve(self, call_id: int, result, error) -> None:
+        future = self._pending.pop(call_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(result)
+
+    def send(self, name: str, *args) -> None:
+        self._commands.put((self._worker, None, name, args))
+
+    def call(self, name: str, *args) -> asyncio.Future:
+        # like send(), the returned future completes with the reply
+        call_id = self._next_call_id
+        self._next_call_id += 1
+        future = self._pending[call_id] = asyncio.get_running_loop().create_future()
+        self._commands.put((self._worker, call_id, name, args))
+        return future
+
+    # the MQTTController methods used by the UI
+
+    def send_color(self, device) -> None:
+        self.send("set_frame", device.device_id, bytes(device.frame), device.retain)
+
+    def set_group_color(self, color, group: str = None) -> int:
+        # the messages are counted in the ingest process
+        self.send("set_group_color", color, group)
+        return 0
+
+    def delete_retained_messages(self, device) -> None:
+        self.send("delete_retained_messages", device.device_id, device.retain)
+
+    async def test_performance(self, device, cycles: int = 100, in_flight: int = 1, timeout: float = 5.0):
+        return await self.call("test_performance", device.device_id, cycles, in_flight, timeout)
+
+    async def connect_to_mqtt_async(self):
+        return await self.call("connect")
+
+    def disconnect_from_mqtt(self) -> None:
+        self.send("disconnect")
+
+
+def run_ingest(state_name: str, commands, replies: list, ready, args) -> None:
+    logging.basicConfig(level=args.log_level)
+    from device_simulator import DeviceFleet
+    from device_store import DeviceStore
+    from mqtt_controller import MQTTController
+    from settings import (
+        DEVICE_STORE_INTERVAL,
+        DEVICE_STORE_PATH,
+        DEVICE_STORE_RECONCILE_TIMEOUT,
+        DEVICE_TIMEOUT,
+        SIMULATED_DEVICES,
+    )
+
+    async def main():
+        stop = asyncio.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+            except NotImplementedError:  # Windows, KeyboardInterrupt ends the process
+                pass
+        mqtt_controller = MQTTController(args.broker, args.broker_port, args.username, args.password)
+        writer = SharedStateWriter(state_name, args.capacity, args.max_leds)
+        device_store = None
+        if DEVICE_STORE_PATH:
+            device_store = DeviceStore(
+                mqtt_controller.device_manager,
+                DEVICE_STORE_PATH,
+                DEVICE_STORE_INTERVAL,
+                DEVICE_STORE_RECONCILE_TIMEOUT,
+                exclude=TEST_DEVICE_IDS,
+            )
+            device_store.load()
+            mqtt_controller.connection_changed.subscribe(device_store.on_connection_changed)
+            device_store.start()
+        mqtt_controller.scenes.load()
+        writer.attach(mqtt_controller)
+        writer.flush()
+        writer.start()
+        ready.set()
+
+        handler = CommandHandler(mqtt_controller, replies)
+        handler.listen(commands, asyncio.get_running_loop())
+        mqtt_controller.ingest_pipeline.start()
+        mqtt_controller.publish_scheduler.start()
+        mqtt_controller.publish_window.start()
+        if mqtt_controller.liveness is not None:
+            mqtt_controller.liveness.start()
+        fleet = None
+        if SIMULATED_DEVICES:
+            fleet = DeviceFleet(
+                SIMULATED_DEVICES, delay=0.005, jitter=0.002, heartbeat_interval=DEVICE_TIMEOUT / 3
+            )
+            await fleet.start_mqtt(args.broker, args.broker_port, args.username, args.password)
+        logging.info(await mqtt_controller.connect_to_mqtt_async())
+        try:
+            await stop.wait()
+        finally:
+            if fleet is not None:
+                fleet.stop()
+            mqtt_controller.effect_engine.stop_all()
+            mqtt_controller.ingest_pipeline.stop()
+            mqtt_controller.publish_scheduler.stop()
+            mqtt_controller.publish_window.stop()
+            if mqtt_controller.liveness is not None:
+                mqtt_controller.liveness.stop()
+            mqtt_controller.disconnect_from_mqtt()
+            if device_store is not None:
+                device_store.stop()
+            writer.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_worker(state_name: str, commands, replies, worker: int, args) -> None:
+    logging.basicConfig(level=args.log_level)
+    import uvicorn
+    from fastapi import FastAPI
+    from nicegui import app, ui
+    from settings import SCENES_PATH
+    from ui_elements import ui_connection_control, ui_group_control, ui_panels, ui_title
+
+    remote_controller = RemoteController(
+        state_name, commands, replies, worker, args.broker, args.broker_port, SCENES_PATH
+    )
+    remote_controller.reader.poll()  # the devices are there on the first page load
+    app.on_startup(remote_controller.start)
+    app.on_shutdown(remote_controller.stop)
+
+    ui.colors(primary="#3785b2", secondary="blue")
+    ui_title()
+    ui_connection_control(remote_controller)
+    ui_group_control(remote_controller)
+    ui_panels(remote_controller)
+    # ui.run() does not start a server outside the main process, the worker
+    # mounts NiceGUI on its own app and runs uvicorn itself
+    server_app = FastAPI()
+    ui.run_with(server_app, dark=None, title="MQTT LED Controller", favicon="💡")
+    uvicorn.run(server_app, host=args.host, port=args.port + worker, log_level="warning")
+
+
+def main(argv=None):
+    from settings import BROKER_ADRESS, BROKER_PASSWORD, BROKER_PORT, BROKER_USERNAME, LOG_LEVEL, UI_HOST
+
+    parser = argparse.ArgumentParser(description="Serve the UI from several worker processes")
+    parser.add_argument("--workers", type=int, default=2, help="UI worker processes")
+    parser.add_argument("--host", default=UI_HOST)
+    parser.add_argument("--port", type=int, default=8080, help="port of the first worker")
+    parser.add_argument("--broker", default=BROKER_ADRESS)
+    parser.add_argument("--broker-port", type=int, default=BROKER_PORT)
+    parser.add_argument("--username", default=BROKER_USERNAME)
+    parser.add_argument("--password", default=BROKER_PASSWORD)
+    parser.add_argument("--capacity", type=int, default=5000, help="devices in shared memory")
+    parser.add_argument("--max-leds", type=int, default=1024, help="LEDs per device in shared memory")
+    parser.add_argument("--log-level", default=LOG_LEVEL)
+    args = parser.parse_args(argv)
+    # the finally below also stops the workers when this process is terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    context = multiprocessing.get_context("spawn")
+    state_name = f"mqtt_led_state_{os.getpid()}"
+    commands = context.Queue()
+    replies = [context.Queue() for _ in range(args.workers)]
+    ready = context.Event()
+
+    ingest = context.Process(
+        target=run_ingest, args=(state_name, commands, replies, ready, args), name="ingest"
+    )
+    ingest.start()
+    if not ready.wait(30):
+        ingest.terminate()
+        raise SystemExit("The ingest process did not start")
+
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(state_name, commands, replies[worker], worker, args),
+            name=f"ui-{worker}",
+        )
+        for worker in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+    print(
+        f"UI workers on ports {args.port} to {args.port + args.workers - 1}, "
+        "put a load balancer with sticky sessions in front of them"
+    )
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join(5)
+        commands.put(None)
+        ingest.terminate()
+        ingest.join(5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import threading
+import time
+
+
+class PublishScheduler:
+    # Outbound scheduler between Device.update_lights and client.publish.
+    # send_color only marks a device dirty; the latest state of a device wins
+    # and every device is published at most `max_rate_hz` times per second.
+    # While `ready()` is False (e.g. the publish window is full) nothing is
+    # published and newer frames keep replacing the pending ones; resume()
+    # continues.
+
+    def __init__(self, publish, max_rate_hz: float = 30.0, ready=None):
+        self._publish = publish
+        self._ready = ready
+        self.min_interval = 1.0 / max_rate_hz
+        self._dirty = {}
+        self._last_publish = {}
+        self._loop = None
+        self._loop_thread = None
+        self._wakeup = None
+        self._task = None
+
+        self.frames_requested = 0
+        self.frames_published = 0
+        self.frames_coalesced = 0
+        self.frames_dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._dirty)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "frames_requested": self.frames_requested,
+            "frames_published": self.frames_published,
+            "frames_coalesced": self.frames_coalesced,
+            "frames_dropped": self.frames_dropped,
+        }
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush(force=True)
+
+    def mark_dirty(self, device) -> None:
+        self.frames_requested += 1
+        if device.device_id in self._dirty:
+            self.frames_coalesced += 1
+        else:
+            self._dirty[device.device_id] = device
+        self.resume()
+
+    def resume(self) -> None:
+        if self._wakeup is not None:
+            if threading.get_ident() == self._loop_thread:
+                self._wakeup.set()
+            else:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def drop(self, device_id: str = None) -> None:
+        # discard pending frames, e.g. when the broker connection is lost
+        if device_id is None:
+            self.frames_dropped += len(self._dirty)
+            self._dirty.clear()
+        elif self._dirty.pop(device_id, None) is not None:
+            self.frames_dropped += 1
+
+    def flush(self, now: float = None, force: bool = False):
+        # publishes every device that is due, returns the seconds until the
+        # next pending device is due (None if nothing is pending)
+        now = time.monotonic() if now is None else now
+        next_due = None
+        for device_id, device in list(self._dirty.items()):
+            due = self._last_publish.get(device_id, 0.0) + self.min_interval
+            if force or due <= now:
+                if not force and self._ready is not None and not self._ready():
+                    return None  # resume() wakes us up
+                del self._dirty[device_id]
+                self._last_publish[device_id] = now
+                try:
+                    self._publish(device)
+                except Exception:
+                    logging.exception(f"Publishing {device_id} failed")
+                    self.frames_dropped += 1
+                else:
+                    self.frames_published += 1
+            elif next_due is None or due - now < next_due:
+                next_due = due - now
+        return next_due
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self.flush()
+            try:
+                # a newly dirty device wakes us up before the delay is over
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
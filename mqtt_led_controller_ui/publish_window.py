@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from change_events import Event
+from metrics import ACK_TIME_BUCKETS, Histogram
+
+
+class _Message:
+    __slots__ = ("topic", "payload", "qos", "retain", "key", "future", "sent", "attempts", "mids")
+
+    def __init__(self, topic, payload, qos, retain, key, future):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.key = key
+        self.future = future
+        self.sent = 0.0
+        self.attempts = 0
+        self.mids = []  # message id of every attempt, any of them acknowledges it
+
+
+class PublishWindow:
+    # Flow control between MQTTController and client.publish for QoS 1
+    # messages. They are tracked by message id until on_publish reports the
+    # broker's acknowledgement. At most `max_in_flight` are unacknowledged;
+    # further messages wait in a queue in which a newer message with the same
+    # `key` (the command topic of a device) replaces the waiting one, so a
+    # saturated connection drops stale frames instead of sending them late.
+    # Messages that are not acknowledged within `ack_timeout` seconds are
+    # published again, up to `max_retries` times. A retry gets a new message
+    # id while paho may still deliver the old one, so the acknowledgement of
+    # any attempt completes the message. While disconnected nothing times
+    # out: paho sends the unacknowledged messages again itself after
+    # reconnecting, and the timeout starts over. QoS 0 messages are passed
+    # through and only counted.
+
+    def __init__(
+        self,
+        publish,
+        max_in_flight: int = 100,
+        ack_timeout: float = 10.0,
+        max_retries: int = 3,
+        is_connected=lambda: True,
+    ):
+        self._publish = publish  # publish(topic, payload, qos, retain) -> MQTTMessageInfo
+        self._is_connected = is_connected
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self._in_flight = {}  # message id -> _Message, a message under each of its ids
+        self._in_flight_count = 0  # messages, not ids
+        self._queue = {}  # key -> _Message waiting for a free slot, in arrival order
+        self._keys = itertools.count()  # keys of messages that nothing replaces
+        self._loop = None
+        self._task = None
+        self.capacity_available = Event()  # emitted when a full window has room again
+        self.ack_time = Histogram(ACK_TIME_BUCKETS)
+
+        self.published = {0: 0, 1: 0, 2: 0}  # by QoS, retries included
+        self.acknowledged = 0
+        self.retries = 0
+        self.failed = 0  # QoS 1 messages given up after max_retries or refused by paho
+        self.superseded = 0  # waiting messages replaced by a newer one
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight_count
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    @property
+    def full(self) -> bool:
+        return self._in_flight_count >= self.max_in_flight
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "published": dict(self.published),
+            "acknowledged": self.acknowledged,
+            "retries": self.retries,
+            "failed": self.failed,
+            "superseded": self.superseded,
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False, key=None):
+        # sends the message now or once there is room in the window; returns
+        # a future that completes with True when the broker acknowledged the
+        # message and False when it was superseded or failed (None for QoS 0
+        # or when the window is not started)
+        if not qos:
+            self.published[0] += 1
+            self._publish(topic, payload, 0, retain)
+            return None
+        future = self._loop.create_future() if self._loop is not None else None
+        message = _Message(topic, payload, qos, retain, key, future)
+        if key is None:
+            key = message.key = next(self._keys)
+        waiting = self._queue.get(key)
+        if waiting is not None:
+            self.superseded += 1
+            _resolve(waiting.future, False)
+            self._queue[key] = message
+        elif self._queue or self.full:
+            self._queue[key] = message
+        else:
+            self._send(message)
+        return future
+
+    async def publish_wait(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        # like publish(), but waits until the window has room, so callers
+        # that produce faster than the broker accepts are slowed down
+        while self.full:
+            await self.wait_for_capacity()
+        return self.publish(topic, payload, qos, retain)
+
+    async def wait_for_capacity(self) -> None:
+        if not self.full:
+            return
+        future = asyncio.get_running_loop().create_future()
+        unsubscribe = self.capacity_available.subscribe(lambda: _resolve(future, None))
+        try:
+            await future
+        finally:
+            unsubscribe()
+
+    def _send(self, message: _Message) -> None:
+        # a message paho refuses (e.g. an invalid topic) gives back its slot
+        # and completes with False
+        try:
+            info = self._publish(message.topic, message.payload, message.qos, message.retain)
+        except Exception:
+            logging.exception(f"Publishing to {message.topic} failed")
+            if message.attempts:
+                self._remove(message)
+            self.failed += 1
+            _resolve(message.future, False)
+            return
+        if not message.attempts:
+            self._in_flight_count += 1
+        message.attempts += 1
+        message.sent = time.monotonic()
+        self.published[message.qos] += 1
+        # without a connection paho keeps the message and sends it after
+        # reconnecting, so it is tracked in any case
+        message.mids.append(info.mid)
+        self._in_flight[info.mid] = message
+
+    def _remove(self, message: _Message) -> None:
+        for mid in message.mids:
+            if self._in_flight.get(mid) is message:
+                del self._in_flight[mid]
+        self._in_flight_count -= 1
+
+    def on_publish(self, mid: int) -> None:
+        was_full = self.full
+        message = self._in_flight.get(mid)
+        if message is None:
+            return
+        self._remove(message)
+        self.acknowledged += 1
+        self.ack_time.observe(time.monotonic() - message.sent)
+        _resolve(message.future, True)
+        self._release(was_full)
+
+    def _release(self, was_full: bool) -> None:
+        # fills the window from the queue after messages left it
+        queue = self._queue
+        while queue and self._in_flight_count < self.max_in_flight:
+            self._send(queue.pop(next(iter(queue))))
+        if was_full and not self.full:
+            self.capacity_available.emit()
+
+    def check_timeouts(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        messages = dict.fromkeys(self._in_flight.values())  # each message once, in order
+        if not self._is_connected():
+            for message in messages:
+                message.sent = now
+            return
+        was_full = self.full
+        expired = [message for message in messages if now - message.sent > self.ack_timeout]
+        for message in expired:
+            if message.key in self._queue:
+                self._remove(message)
+                # a newer message for the same key is waiting, this one is stale
+                self.superseded += 1
+                _resolve(message.future, False)
+            elif message.attempts > self.max_retries:
+                self._remove(message)
+                logging.info(f"No acknowledgement for {message.topic}, giving up")
+                self.failed += 1
+                _resolve(message.future, False)
+            else:
+                self.retries += 1
+                self._send(message)
+        if expired:
+            self._release(was_full)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.ack_timeout / 4, 1.0))
+            self.check_timeouts()
+
+
+def _resolve(future, result) -> None:
+    if future is not None and not future.done():
+        future.set_result(result)
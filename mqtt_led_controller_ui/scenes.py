@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from device_manager import parse_color
+from led_codec import encode_command, encode_lights
+
+# Named scenes: full LED states for devices or groups, e.g.
+#
+#   {"evening": [
+#       {"color": "#000000"},                                  every device
+#       {"group": "shelf", "color": "#ff8000"},                all LEDs one color
+#       {"group": "desk", "colors": ["#ff0000", "#0000ff"]},   a repeated pattern
+#       {"device": "esp32-00001", "frame": "ff0000..."}        packed RGB as hex
+#   ]}
+#
+# A later target overrides an earlier one for the same device. Scenes are
+# kept in a JSON file. The command payload of a device is compiled once per
+# scene and LED count and kept in an LRU cache, so applying a scene is a loop
+# of publishes without per-LED work. A device's entries are dropped when its
+# LED count changes.
+
+
+class Scene:
+    __slots__ = ("name", "targets", "_patterns", "_by_device", "_by_group", "_all")
+
+    def __init__(self, name: str, targets: list):
+        if not isinstance(targets, list) or not all(isinstance(t, dict) for t in targets):
+            raise ValueError(f"Scene {name}: expected a list of targets (objects)")
+        self.name = name
+        self.targets = targets
+        # packed RGB of every target, repeated to the LED count when compiled
+        self._patterns = []
+        # the last target for a device id, for a group, and for all devices
+        self._by_device = {}
+        self._by_group = {}
+        self._all = None
+        for index, target in enumerate(targets):
+            if "device" in target:
+                self._by_device[target["device"]] = index
+            elif "group" in target:
+                self._by_group[target["group"]] = index
+            else:
+                self._all = index
+            if "frame" in target:
+                pattern = bytes.fromhex(target["frame"])
+            elif "colors" in target:
+                if not target["colors"]:
+                    raise ValueError(f"Scene {name}: colors is empty")
+                pattern = b"".join(bytes(parse_color(color)) for color in target["colors"])
+            elif "color" in target:
+                pattern = bytes(parse_color(target["color"]))
+            else:
+                raise ValueError(f"Scene {name}: a target needs a color, colors or frame")
+            self._patterns.append(pattern)
+
+    def target_index(self, device):
+        # index of the target that sets `device`, None if none does
+        index = self._all
+        device_index = self._by_device.get(device.device_id)
+        if device_index is not None and (index is None or device_index > index):
+            index = device_index
+        if self._by_group:
+            for group in device.groups:
+                group_index = self._by_group.get(group)
+                if group_index is not None and (index is None or group_index > index):
+                    index = group_index
+        return index
+
+    def frame(self, index: int, led_count: int) -> bytes:
+        pattern = self._patterns[index]
+        size = 3 * led_count
+        if "frame" in self.targets[index]:
+            return pattern[:size].ljust(size, b"\0")
+        return (pattern * (size // len(pattern) + 1))[:size]
+
+
+class SceneEngine:
+    def __init__(self, mqtt_controller, path: str = None, cache_size: int = 4096):
+        self.mqtt_controller = mqtt_controller
+        self.path = path
+        self.cache_size = cache_size
+        self._scenes = {}
+        self._cache = OrderedDict()  # (scene, device id) -> (LED count, target, frame, payload)
+        self._cached_scenes = {}  # device id -> scenes with a cache entry for it
+        self._unsubscribe = {}  # device id -> removes the led_count subscription
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.scenes_applied = 0
+
+        device_manager = mqtt_controller.device_manager
+        for device in device_manager.devices:
+            self._watch(device)
+        device_manager.device_added.subscribe(self._watch)
+        device_manager.device_removed.subscribe(self._unwatch)
+
+    @property
+    def names(self) -> list:
+        return sorted(self._scenes)
+
+    def stats(self) -> dict:
+        return {
+            "scenes": len(self._scenes),
+            "cached_payloads": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_evictions": self.cache_evictions,
+            "scenes_applied": self.scenes_applied,
+        }
+
+    def _watch(self, device) -> None:
+        self._unsubscribe[device.device_id] = device.subscribe(
+            "led_count", lambda _count: self.invalidate(device_id=device.device_id)
+        )
+
+    def _unwatch(self, device) -> None:
+        unsubscribe = self._unsubscribe.pop(device.device_id, None)
+        if unsubscribe is not None:
+            unsubscribe()
+        self.invalidate(device_id=device.device_id)
+
+    def load(self) -> int:
+        # returns the number of scenes loaded
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                definitions = json.load(file)
+            if not isinstance(definitions, dict):
+                raise ValueError("expected an object of scenes")
+            scenes = {name: Scene(name, targets) for name, targets in definitions.items()}
+        # TypeError: values of the wrong type, e.g. a number as frame or a list as device id
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Could not load the scenes {self.path}: {e}")
+            return 0
+        self._scenes = scenes
+        self.invalidate()
+        logging.info(f"Loaded {len(scenes)} scenes from {self.path}")
+        return len(scenes)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        definitions = {name: scene.targets for name, scene in sorted(self._scenes.items())}
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(definitions, file, indent=2)
+        os.replace(temporary, self.path)
+
+    def save_scene(self, name: str, targets: list) -> Scene:
+        scene = self._scenes[name] = Scene(name, targets)
+        self.invalidate(name)
+        self.save()
+        return scene
+
+    def capture(self, name: str, devices=None) -> Scene:
+        # a scene of the current state of `devices` (default: all devices)
+        if devices is None:
+            devices = self.mqtt_controller.device_manager.devices
+        return self.save_scene(
+            name, [{"device": device.device_id, "frame": device.frame.hex()} for device in devices]
+        )
+
+    def delete_scene(self, name: str) -> None:
+        if self._scenes.pop(name, None) is not None:
+            self.invalidate(name)
+            self.save()
+
+    def invalidate(self, name: str = None, device_id: str = None) -> None:
+        # drops the cached payloads of a scene, of a device, or all of them
+        if name is None and device_id is None:
+            self._cache.clear()
+            self._cached_scenes.clear()
+        elif device_id is not None:
+            for scene_name in self._cached_scenes.pop(device_id, ()):
+                self._cache.pop((scene_name, device_id), None)
+        else:
+            for key in [key for key in self._cache if key[0] == name]:
+                del self._cache[key]
+                self._cached_scenes[key[1]].discard(name)
+
+    def _compiled(self, scene: Scene, device, lights_pool: dict):
+        # (frame, payload) of `scene` for `device`, None if the scene does not set it
+        index = scene.target_index(device)
+        if index is None:
+            return None
+        key = (scene.name, device.device_id)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] == device.led_count and entry[1] == index:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return entry[2], entry[3]
+
+        self.cache_misses += 1
+        lights_key = (index, device.led_count)
+        compiled = lights_pool.get(lights_key)
+        if compiled is None:
+            frame = scene.frame(index, device.led_count)
+            compiled = lights_pool[lights_key] = (frame, encode_lights(frame))
+        frame, lights = compiled
+        payload = encode_command(device.device_id, lights).encode()
+        self._cache[key] = (device.led_count, index, frame, payload)
+        self._cached_scenes.setdefault(device.device_id, set()).add(scene.name)
+        while len(self._cache) > self.cache_size:
+            (evicted_scene, evicted_device), _ = self._cache.popitem(last=False)
+            self._cached_scenes[evicted_device].discard(evicted_scene)
+            self.cache_evictions += 1
+        return frame, payload
+
+    def apply(self, name: str, qos: int = None) -> int:
+        # sets and publishes the scene, returns the number of devices it set
+        scene = self._scenes.get(name)
+        if scene is None:
+            raise KeyError(f"Unknown scene {name}")
+        controller = self.mqtt_controller
+        lights_pool = {}  # devices with the same target and LED count share the encoded lights
+        applied = 0
+        for device in controller.device_manager.devices:
+            compiled = self._compiled(scene, device, lights_pool)
+            if compiled is None:
+                continue
+            frame, payload = compiled
+            controller.effect_engine.stop(device.device_id)
+            controller.publish_scheduler.drop(device.device_id)
+            if device.frame != frame:
+                device.set_frame(frame)
+            controller.publish_payload(device, payload, qos=qos)
+            applied += 1
+        controller.messages_published["scene"] += applied
+        self.scenes_applied += 1
+        return applied
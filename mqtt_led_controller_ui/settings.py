@@ -4,14 +4,141 @@ BROKER_ADRESS: str = "mqtt_broker"
 BROKER_PORT: int = 1883  # the port of the MQTT broker (default: 1883)
 BROKER_USERNAME: str = "ui"  # the username for the MQTT broker
 BROKER_PASSWORD: str = "password"  # the password for the MQTT broker
+UI_HOST: str = "0.0.0.0"  # the address the UI and the control API listen on
+UI_PORT: int = 80  # the port of the UI (the first worker's with UI_WORKERS > 1)
+UI_WORKERS: int = (
+    1  # processes serving the UI, more than one runs multi_worker.py (one ingest process + workers)
+)
+UI_RELOAD: bool = (
+    False  # if True, the UI restarts when a source file changes (development only)
+)
+LOG_LEVEL: str = "INFO"  # the level of the log messages that are printed
+MQTT_TRANSPORT: str = (
+    "asyncio"  # "asyncio" runs the MQTT client on the UI event loop, "thread" uses paho's own thread
+)
 
 ADD_DUMMY_TEST_DEVICES: bool = (
     True  # if True, the UI will add test devices to the list of devices
 )
+SIMULATED_DEVICES: int = (
+    0  # number of simulated devices that connect to the broker together with the UI (0: none)
+)
 ENABLE_PERFORMANCE_TEST_BUTTON: bool = (
     True  # if True, the UI will add a button to test the performance of the devices
 )
+ENABLE_METRICS_ENDPOINT: bool = (
+    True  # if True, telemetry is served in the Prometheus text format on /metrics
+)
+
+ENABLE_CONTROL_API: bool = (
+    False  # if True, devices can be set over HTTP and a WebSocket frame stream on /api
+)
+CONTROL_API_TOKEN: str = (
+    ""  # bearer token for the control API and /metrics ("": served on a loopback UI_HOST only)
+)
+
+ENABLE_DELTA_PUBLISHING: bool = (
+    True  # if True, only changed LEDs are sent to devices that advertise "delta" support
+)
+DELTA_KEYFRAME_INTERVAL: int = (
+    50  # a full frame is sent to delta capable devices after this many deltas
+)
+MAX_PUBLISH_RATE_HZ: float = (
+    30.0  # maximum number of commands per second and device, faster changes are coalesced
+)
+PUBLISH_QOS: int = (
+    0  # QoS of the commands to devices (1: acknowledged by the broker), Device.qos overrides it
+)
+PUBLISH_MAX_IN_FLIGHT: int = (
+    100  # QoS 1 messages not yet acknowledged, further ones wait and newer frames replace waiting ones
+)
+PUBLISH_ACK_TIMEOUT: float = (
+    10.0  # seconds until an unacknowledged QoS 1 message is published again
+)
+PUBLISH_MAX_RETRIES: int = (
+    3  # times an unacknowledged QoS 1 message is published again before it counts as failed
+)
+INGEST_QUEUE_SIZE: int = (
+    10000  # maximum number of received MQTT messages waiting to be applied
+)
+UI_RENDER_INTERVAL: float = (
+    0.05  # seconds between two batches of received messages being applied to the UI
+)
+EFFECT_ENGINE_FPS: float = (
+    30.0  # frame rate of the clock that drives LED effects and animations
+)
+EFFECT_CACHE_BUDGET: int = (
+    64 * 1024 * 1024  # bytes of rendered effect frames kept for playing an effect again
+)
+LAZY_DEVICE_PANELS: bool = (
+    True  # if True, the panel of a device is only built when its tab is opened
+)
+PANEL_IDLE_TIMEOUT: float = (
+    300.0  # seconds a hidden device panel is kept before it is released (0: keep forever)
+)
+LED_STRIP_COLUMNS: int = (
+    30  # LEDs per row when a strip without a layout in LED_LAYOUTS is drawn
+)
+# how the LEDs of a device are drawn, by device id, e.g.
+#   "esp32-00001": {"type": "matrix", "columns": 32, "rows": 32, "serpentine": True}
+#   "esp32-00002": {"type": "ring", "diameter": 400}
+#   "esp32-00003": {"positions": [[x, y], ...], "radius": 8, "background": "./media/shelf.png"}
+# devices without an entry are drawn as a strip, or as the photo of the ring if they have 12 LEDs
+LED_LAYOUTS: dict = {}
+DEVICE_STORE_PATH: str = (
+    "./device_state.sqlite3"  # SQLite file the known devices are saved to and restored from ("": off)
+)
+DEVICE_STORE_INTERVAL: float = (
+    10.0  # seconds between two saves of the changed devices
+)
+DEVICE_STORE_RECONCILE_TIMEOUT: float = (
+    10.0  # restored devices that send nothing this long after connecting are marked offline
+)
+DEVICE_TIMEOUT: float = (
+    0.0  # online devices that send no sts or heartbeat this long are marked offline (0: off)
+)
+DEVICE_TIMEOUT_PRECISION: float = (
+    1.0  # seconds a device may be marked offline later than DEVICE_TIMEOUT
+)
+HISTORY_MEMORY_BUDGET: int = (
+    64 * 1024 * 1024  # bytes of LED state history kept for queries and replays (0: off)
+)
+SCENES_PATH: str = (
+    "./scenes.json"  # JSON file the named scenes are saved to and loaded from ("": not saved)
+)
+SCENE_CACHE_SIZE: int = (
+    4096  # compiled scene commands (one per scene and device) kept for applying scenes again
+)
 
 led_ring_12_image_path: str = (
     "./media/led_ring.png"  # the path to the image of the 12-LED ring
 )
+
+
+# Every setting above can be overridden with an environment variable named
+# MQTT_LED_<SETTING>, e.g. MQTT_LED_BROKER_ADRESS=192.168.1.10 or
+# MQTT_LED_UI_PORT=8080. Booleans take 1/0, true/false or yes/no, dicts JSON.
+
+
+def _apply_environment(prefix: str = "MQTT_LED_") -> None:
+    import json
+    import os
+
+    for name, kind in __annotations__.items():
+        value = os.environ.get(prefix + name)
+        if value is None:
+            continue
+        try:
+            if kind is bool:
+                if value.lower() not in ("1", "0", "true", "false", "yes", "no"):
+                    raise ValueError("expected 1/0, true/false or yes/no")
+                globals()[name] = value.lower() in ("1", "true", "yes")
+            elif kind is dict:
+                globals()[name] = json.loads(value)
+            else:
+                globals()[name] = kind(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid {prefix}{name}={value!r}: {e}") from None
+
+
+_apply_environment()
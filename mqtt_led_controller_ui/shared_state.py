@@ -0,0 +1,378 @@
+import asyncio
+import json
+import logging
+import struct
+from multiprocessing import shared_memory
+
+# The device registry in shared memory, written by the process that owns the
+# MQTTController and read by any number of UI worker processes.
+#
+# Layout: a header, one sequence number per slot and one fixed size slot per
+# device (id, groups, LED count, online, retain, packed RGB frame). A slot is
+# written under a seqlock: its sequence number is odd while the slot is being
+# written and increases by 2 with every write, so readers copy a slot and
+# retry if the number was odd or changed meanwhile. The header generation
+# increases with every flush, so an idle reader only reads the header.
+# A removed device leaves a slot with an empty id, which the readers remove
+# and the writer gives to the next new device.
+
+_MAGIC = b"MLED"
+_HEADER = struct.Struct("<4sIIIQB")  # magic, capacity, max LEDs, devices, generation, connected
+_SEQ_OFFSET = 64
+_SLOT_HEADER = struct.Struct("<64s192sHBB")  # device id, groups (JSON), LED count, online, retain
+_ID_SIZE = 64
+_GROUPS_SIZE = 192
+
+
+def _slot_size(max_leds: int) -> int:
+    return _SLOT_HEADER.size + 3 * max_leds
+
+
+def _encode_id(device_id: str) -> bytes:
+    # at most _ID_SIZE bytes, cut at a character boundary
+    encoded = device_id.encode()
+    if len(encoded) <= _ID_SIZE:
+        return encoded
+    return encoded[:_ID_SIZE].decode(errors="ignore").encode()
+
+
+class _SharedTable:
+    def __init__(self, shm, capacity: int, max_leds: int):
+        self.shm = shm
+        self.capacity = capacity
+        self.max_leds = max_leds
+        self.slot_size = _slot_size(max_leds)
+        self.slots_offset = _SEQ_OFFSET + 8 * capacity
+        self.seqs = shm.buf[_SEQ_OFFSET : self.slots_offset].cast("Q")
+
+    def slot_offset(self, index: int) -> int:
+        return self.slots_offset + index * self.slot_size
+
+    def read_header(self) -> tuple:
+        return _HEADER.unpack_from(self.shm.buf, 0)
+
+    def close(self) -> None:
+        self.seqs.release()
+        self.shm.close()
+
+
+class SharedStateWriter:
+    # Mirrors the devices of a DeviceManager into shared memory. Changes are
+    # collected from the device events and written in one flush every
+    # `interval` seconds; a full comparison every `refresh_interval` seconds
+    # also catches changes that have no event. Devices beyond `capacity`
+    # and LEDs beyond `max_leds` are not shared, which is logged once per
+    # device.
+
+    def __init__(
+        self,
+        name: str = None,
+        capacity: int = 5000,
+        max_leds: int = 1024,
+        interval: float = 0.05,
+        refresh_interval: float = 2.0,
+    ):
+        size = _SEQ_OFFSET + 8 * capacity + capacity * _slot_size(max_leds)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._table = _SharedTable(shm, capacity, max_leds)
+        self.name = shm.name
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self._slots = {}  # device_id -> slot index
+        self._free = []  # indexes of the slots of removed devices
+        self._used_slots = 0  # slots ever used, the readers look at these
+        self._written = {}  # device_id -> slot contents as last written
+        self._dirty = {}  # device_id -> device
+        self._removed = set()  # device ids to clear from their slot
+        self._watches = {}  # device_id -> functions removing the subscriptions
+        self._warned = set()  # device ids whose limits were logged
+        self._device_manager = None
+        self._connected = False
+        self._generation = 0
+        self._task = None
+        self._unsubscribes = []
+        self.flushes = 0
+        self.slots_written = 0
+        self.devices_dropped = 0
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, capacity, max_leds, 0, 0, 0)
+
+    def attach(self, mqtt_controller) -> None:
+        device_manager = self._device_manager = mqtt_controller.device_manager
+        for device in device_manager.devices:
+            self._watch(device)
+        self._unsubscribes = [
+            device_manager.device_added.subscribe(self._watch),
+            device_manager.device_removed.subscribe(self._unwatch),
+            mqtt_controller.connection_changed.subscribe(self._on_connection_changed),
+        ]
+        self._connected = mqtt_controller.mqtt_connected
+
+    def _watch(self, device) -> None:
+        def mark_dirty(_value):
+            self._dirty[device.device_id] = device
+
+        self._watches[device.device_id] = [
+            device.subscribe(name, mark_dirty)
+            for name in ("lights", "online", "led_count", "groups", "retain")
+        ]
+        self._removed.discard(device.device_id)
+        self._dirty[device.device_id] = device
+
+    def _unwatch(self, device) -> None:
+        for unsubscribe in self._watches.pop(device.device_id, ()):
+            unsubscribe()
+        self._dirty.pop(device.device_id, None)
+        self._warned.discard(device.device_id)
+        self._removed.add(device.device_id)
+
+    def _on_connection_changed(self, connected: bool) -> None:
+        self._connected = connected
+        self._write_header()
+
+    def _write_header(self) -> None:
+        _HEADER.pack_into(
+            self._table.shm.buf,
+            0,
+            _MAGIC,
+            self._table.capacity,
+            self._table.max_leds,
+            self._used_slots,
+            self._generation,
+            int(self._connected),
+        )
+
+    def flush(self, devices=None) -> int:
+        # writes the dirty devices (or `devices`) whose slot changed,
+        # returns the number of slots written
+        if devices is None:
+            devices = self._dirty.values()
+        table = self._table
+        buf = table.shm.buf
+        written = self._clear_removed()
+        for device in devices:
+            contents = (
+                json.dumps(sorted(device.groups)).encode(),
+                min(device.led_count, table.max_leds),
+                int(device.online),
+                int(device.retain),
+                bytes(device.frame[: 3 * table.max_leds]),
+            )
+            if self._written.get(device.device_id) == contents:
+                continue
+            index = self._slots.get(device.device_id)
+            if index is None:
+                index = self._allocate_slot(device.device_id)
+                if index is None:
+                    continue
+            if device.led_count > table.max_leds:
+                self._warn(
+                    device.device_id,
+                    f"{device.device_id} has {device.led_count} LEDs, the UI workers only get"
+                    f" the first {table.max_leds} (--max-leds)",
+                )
+            groups, led_count, online, retain, frame = contents
+            if len(groups) > _GROUPS_SIZE:
+                groups = b"[]"
+                logging.info(f"Groups of {device.device_id} do not fit into shared memory")
+            offset = table.slot_offset(index)
+            table.seqs[index] += 1  # odd: being written
+            _SLOT_HEADER.pack_into(
+                buf, offset, _encode_id(device.device_id), groups, led_count, online, retain
+            )
+            start = offset + _SLOT_HEADER.size
+            buf[start : start + len(frame)] = frame
+            table.seqs[index] += 1
+            self._written[device.device_id] = contents
+            written += 1
+        self._dirty.clear()
+        if written:
+            self._generation += 1
+            self._write_header()
+            self.slots_written += written
+        self.flushes += 1
+        return written
+
+    def _allocate_slot(self, device_id: str):
+        if self._free:
+            index = self._free.pop()
+        elif self._used_slots < self._table.capacity:
+            index = self._used_slots
+            self._used_slots += 1
+        else:
+            self.devices_dropped += 1
+            self._warn(
+                device_id,
+                f"The shared memory holds {self._table.capacity} devices (--capacity),"
+                f" {device_id} is not shown by the UI workers",
+            )
+            return None
+        if len(device_id.encode()) > _ID_SIZE:
+            self._warn(
+                device_id,
+                f"The id of {device_id} is longer than {_ID_SIZE} bytes, the UI workers"
+                " see it shortened and cannot send commands to it",
+            )
+        self._slots[device_id] = index
+        return index
+
+    def _warn(self, device_id: str, message: str) -> None:
+        if device_id not in self._warned:
+            self._warned.add(device_id)
+            logging.warning(message)
+
+    def _clear_removed(self) -> int:
+        # empties the slots of the removed devices, returns their number
+        cleared = 0
+        for device_id in self._removed:
+            self._written.pop(device_id, None)
+            index = self._slots.pop(device_id, None)
+            if index is None:
+                continue
+            table = self._table
+            table.seqs[index] += 1
+            _SLOT_HEADER.pack_into(table.shm.buf, table.slot_offset(index), b"", b"", 0, 0, 0)
+            table.seqs[index] += 1
+            self._free.append(index)
+            cleared += 1
+        self._removed.clear()
+        return cleared
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_refresh = loop.time() + self.refresh_interval
+        while True:
+            await asyncio.sleep(self.interval)
+            if loop.time() >= next_refresh and self._device_manager is not None:
+                next_refresh = loop.time() + self.refresh_interval
+                self.flush(list(self._device_manager.devices))
+            elif self._dirty or self._removed:
+                self.flush()
+
+    def close(self) -> None:
+        self.stop()
+        for unsubscribe in self._unsubscribes:
+            unsubscribe()
+        self._unsubscribes = []
+        self._table.close()
+        self._table.shm.unlink()
+
+
+class SharedStateReader:
+    # Applies the shared device registry to a local DeviceManager, so the UI
+    # code works on Device objects as usual. poll() only touches the slots
+    # whose sequence number changed since the last poll.
+
+    def __init__(self, name: str, device_manager, interval: float = 0.05):
+        shm = shared_memory.SharedMemory(name=name)
+        magic, capacity, max_leds, _, _, _ = _HEADER.unpack_from(shm.buf, 0)
+        if magic != _MAGIC:
+            shm.close()
+            raise ValueError(f"{name} is not a device state table")
+        self._table = _SharedTable(shm, capacity, max_leds)
+        self.device_manager = device_manager
+        self.interval = interval
+        self.connected = False
+        self.connection_changed = None  # Event emitted with the connected flag
+        self._seqs = [0] * capacity
+        self._devices = [None] * capacity  # local Device per slot
+        self._indexes = {}  # device_id -> slot index of the local device
+        self._generation = None
+        self._task = None
+        self.polls = 0
+        self.slots_read = 0
+        self.retries = 0
+
+    def poll(self) -> int:
+        # returns the number of slots applied
+        table = self._table
+        _, _, _, device_count, generation, connected = table.read_header()
+        if bool(connected) != self.connected:
+            self.connected = bool(connected)
+            if self.connection_changed is not None:
+                self.connection_changed.emit(self.connected)
+        self.polls += 1
+        if generation == self._generation:
+            return 0
+        self._generation = generation
+
+        seqs = table.seqs
+        last_seqs = self._seqs
+        applied = 0
+        with self.device_manager.online_batch():
+            for index in range(device_count):
+                if seqs[index] != last_seqs[index] and self._read_slot(index):
+                    applied += 1
+        self.slots_read += applied
+        return applied
+
+    def _read_slot(self, index: int) -> bool:
+        table = self._table
+        buf = table.shm.buf
+        offset = table.slot_offset(index)
+        for _ in range(100):
+            seq = table.seqs[index]
+            if seq % 2:
+                self.retries += 1
+                continue
+            device_id, groups, led_count, online, retain = _SLOT_HEADER.unpack_from(buf, offset)
+            start = offset + _SLOT_HEADER.size
+            frame = bytes(buf[start : start + 3 * led_count])
+            if table.seqs[index] == seq:
+                break
+            self.retries += 1
+        else:
+            return False  # still being written, picked up by the next poll
+        self._seqs[index] = seq
+
+        device_id = device_id.rstrip(b"\0").decode(errors="replace")
+        device = self._devices[index]
+        if device is not None and device.device_id != device_id:
+            # the device was removed, the slot is empty or reused; a device
+            # added again may already have been read from another slot
+            if self._indexes.get(device.device_id) == index:
+                del self._indexes[device.device_id]
+                self.device_manager.remove_device(device.device_id)
+            device = self._devices[index] = None
+        if not device_id:
+            return True
+        if device is None:
+            device, _ = self.device_manager.get_or_add_device(device_id)
+            self._devices[index] = device
+            self._indexes[device_id] = index
+        changed_leds = device.update_frame(frame)
+        if changed_leds:
+            device.notify_lights_changed(changed_leds)
+        device.retain = bool(retain)
+        device.online = bool(online)
+        self.device_manager.set_groups(device.device_id, json.loads(groups.rstrip(b"\0")))
+        return True
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Reading the shared device state failed")
+            await asyncio.sleep(self.interval)
+
+    def close(self) -> None:
+        self.stop()
+        self._table.close()
@@ -0,0 +1,294 @@
+import asyncio
+import bisect
+import heapq
+import struct
+import time
+from collections import deque
+
+from led_codec import changed_leds
+
+# Per-device history of the LED state, to answer "what did the strips show at
+# T" and to replay a time range. Changes are appended to segments: a segment
+# is a bytearray that starts with a full frame and continues with records of
+# only the LEDs that changed. A new segment is started once the current one
+# holds `segment_size` bytes. All segments share one memory budget; when it
+# is exceeded the oldest segment of any device is evicted, so the memory use
+# does not depend on how many devices change how often, only the time span
+# that is kept does.
+#
+# Records are stamped with time.monotonic(), so the order of the records
+# and the bisect over the segments survive a step of the wall clock. The
+# queries take and return time.time() timestamps; they are converted with
+# the current difference between both clocks.
+
+_RECORD = struct.Struct("<dBH")  # timestamp, kind, LED count
+_FULL = 0  # followed by the packed RGB frame
+_DELTA = 1  # followed by (LED index, RGB) of every changed LED
+_DELTA_LED = struct.Struct("<H3s")
+_SEGMENT_OVERHEAD = 200  # bytes of Python objects per segment, counted towards the budget
+
+
+class _Segment:
+    __slots__ = ("device_id", "start", "data")
+
+    def __init__(self, device_id: str, start: float):
+        self.device_id = device_id
+        self.start = start
+        self.data = bytearray()
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + _SEGMENT_OVERHEAD
+
+
+class _DeviceHistory:
+    __slots__ = ("segments", "starts", "last_frame", "unsubscribe")
+
+    def __init__(self):
+        self.segments = []
+        self.starts = []  # start time of every segment, for bisect
+        self.last_frame = None
+        self.unsubscribe = None
+
+
+def _records(data):
+    # yields (timestamp, kind, LED count, offset of the payload) of every record
+    offset = 0
+    size = len(data)
+    while offset < size:
+        timestamp, kind, count = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        yield timestamp, kind, count, offset
+        offset += 3 * count if kind == _FULL else _DELTA_LED.size * count
+
+
+def _apply(frame, data, kind: int, count: int, offset: int) -> bytearray:
+    if kind == _FULL:
+        return bytearray(data[offset : offset + 3 * count])
+    for index, rgb in _DELTA_LED.iter_unpack(
+        memoryview(data)[offset : offset + _DELTA_LED.size * count]
+    ):
+        frame[3 * index : 3 * index + 3] = rgb
+    return frame
+
+
+class StateHistory:
+    def __init__(
+        self,
+        device_manager,
+        memory_budget: int = 64 * 1024 * 1024,
+        segment_size: int = 16 * 1024,
+        clock=time.monotonic,
+        wall_clock=time.time,
+    ):
+        self.device_manager = device_manager
+        self.memory_budget = memory_budget
+        self.segment_size = segment_size
+        self._clock = clock  # stamps the records
+        self._wall_clock = wall_clock  # queries are by time of day
+        self._histories = {}
+        self._segments = deque()  # all segments, oldest first
+        self._replaying = {}  # device id -> replays running on it, not recorded
+        self.memory_used = 0
+        self.records = 0
+        self.segments_evicted = 0
+
+        for device in device_manager.devices:
+            self.watch(device)
+        device_manager.device_added.subscribe(self.watch)
+        device_manager.device_removed.subscribe(self.unwatch)
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self._histories),
+            "segments": len(self._segments),
+            "records": self.records,
+            "memory_used": self.memory_used,
+            "segments_evicted": self.segments_evicted,
+            "oldest": self._to_wall(self._segments[0].start) if self._segments else None,
+        }
+
+    def _to_wall(self, timestamp: float) -> float:
+        return timestamp + self._wall_clock() - self._clock()
+
+    def _to_clock(self, timestamp: float) -> float:
+        return timestamp - self._wall_clock() + self._clock()
+
+    def watch(self, device) -> None:
+        history = self._histories.get(device.device_id)
+        if history is None:
+            history = self._histories[device.device_id] = _DeviceHistory()
+        if history.unsubscribe is None:
+            history.unsubscribe = device.subscribe(
+                "lights", lambda led_indices: self.record(device, led_indices)
+            )
+        self.record(device)
+
+    def unwatch(self, device) -> None:
+        # the recorded history is kept until it is evicted
+        history = self._histories.get(device.device_id)
+        if history is not None and history.unsubscribe is not None:
+            history.unsubscribe()
+            history.unsubscribe = None
+            if not history.segments:
+                del self._histories[device.device_id]
+
+    def record(self, device, led_indices=None, timestamp: float = None) -> None:
+        # led_indices as emitted by the "lights" event of the device; for
+        # None (a whole new frame, e.g. from an effect) the changed LEDs are
+        # looked up in the last frame recorded. `timestamp` is on the
+        # monotonic clock.
+        if device.device_id in self._replaying:
+            return
+        history = self._histories.get(device.device_id)
+        if history is None:
+            history = self._histories[device.device_id] = _DeviceHistory()
+        frame = device.frame
+        last_frame = history.last_frame
+        if last_frame is None or len(last_frame) != len(frame):
+            led_indices = None
+        elif led_indices is None:
+            led_indices = changed_leds(last_frame, frame)
+            if not led_indices:
+                return
+        elif not led_indices:
+            return
+        timestamp = self._clock() if timestamp is None else timestamp
+
+        segments = history.segments
+        if not segments or len(segments[-1].data) >= self.segment_size:
+            segment = _Segment(device.device_id, timestamp)
+            segments.append(segment)
+            history.starts.append(timestamp)
+            self._segments.append(segment)
+            self.memory_used += _SEGMENT_OVERHEAD
+            led_indices = None  # a segment starts with a full frame
+        else:
+            segment = segments[-1]
+
+        size = len(segment.data)
+        if led_indices is None or _DELTA_LED.size * len(led_indices) >= len(frame):
+            segment.data += _RECORD.pack(timestamp, _FULL, len(frame) // 3)
+            segment.data += frame
+        else:
+            segment.data += _RECORD.pack(timestamp, _DELTA, len(led_indices))
+            pack = _DELTA_LED.pack
+            segment.data += b"".join(
+                [pack(i, frame[3 * i : 3 * i + 3]) for i in led_indices]
+            )
+        # the copy of the last frame counts towards the budget too
+        self.memory_used += len(segment.data) - size + len(frame) - len(last_frame or b"")
+        history.last_frame = bytes(frame)
+        self.records += 1
+        if self.memory_used > self.memory_budget:
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.memory_used > self.memory_budget and len(self._segments) > 1:
+            segment = self._segments.popleft()
+            history = self._histories[segment.device_id]
+            # segments of a device are evicted in the order they were created
+            del history.segments[0]
+            del history.starts[0]
+            if not history.segments:
+                # the next change starts with a full frame
+                self.memory_used -= len(history.last_frame or b"")
+                history.last_frame = None
+                if history.unsubscribe is None:
+                    del self._histories[segment.device_id]
+            self.memory_used -= segment.size
+            self.segments_evicted += 1
+
+    def state_at(self, device_id: str, timestamp: float):
+        # packed RGB frame of the device at `timestamp` (time.time()), None
+        # if that is before the oldest state kept
+        return self._state_at(device_id, self._to_clock(timestamp))
+
+    def _state_at(self, device_id: str, timestamp: float):
+        history = self._histories.get(device_id)
+        if history is None:
+            return None
+        index = bisect.bisect_right(history.starts, timestamp) - 1
+        if index < 0:
+            return None
+        data = history.segments[index].data
+        frame = None
+        for record_time, kind, count, offset in _records(data):
+            if record_time > timestamp:
+                break
+            frame = _apply(frame, data, kind, count, offset)
+        return None if frame is None else bytes(frame)
+
+    def changes(self, device_id: str, start: float, end: float):
+        # yields (timestamp, frame) for the state at `start` (if it is known)
+        # and after every change up to and including `end`, all time.time()
+        offset = self._wall_clock() - self._clock()
+        for timestamp, frame in self._changes(device_id, start - offset, end - offset):
+            yield timestamp + offset, frame
+
+    def _changes(self, device_id: str, start: float, end: float):
+        history = self._histories.get(device_id)
+        if history is None:
+            return
+        initial = self._state_at(device_id, start)
+        if initial is not None:
+            yield start, initial
+        first = max(bisect.bisect_right(history.starts, start) - 1, 0)
+        frame = None
+        for segment in history.segments[first:]:
+            data = segment.data
+            for record_time, kind, count, offset in _records(data):
+                if record_time > end:
+                    return
+                frame = _apply(frame, data, kind, count, offset)
+                if record_time > start:
+                    yield record_time, bytes(frame)
+
+    def _timeline(self, device_id: str, start: float, end: float):
+        for timestamp, frame in self._changes(device_id, start, end):
+            yield timestamp, device_id, frame
+
+    async def replay(
+        self,
+        mqtt_controller,
+        start: float,
+        end: float = None,
+        speed: float = 1.0,
+        device_ids=None,
+    ) -> int:
+        # sets and publishes the recorded states between start and end
+        # (time.time()) again, `speed` times faster than they were recorded;
+        # returns the number of frames replayed. The replayed states are not
+        # recorded again, only the state a device is left in afterwards.
+        start = self._to_clock(start)
+        end = self._clock() if end is None else min(self._to_clock(end), self._clock())
+        if device_ids is None:
+            device_ids = list(self._histories)
+        timelines = [self._timeline(device_id, start, end) for device_id in device_ids]
+        for device_id in device_ids:
+            self._replaying[device_id] = self._replaying.get(device_id, 0) + 1
+        loop = asyncio.get_running_loop()
+        origin = loop.time()
+        replayed = 0
+        try:
+            for timestamp, device_id, frame in heapq.merge(*timelines):
+                delay = origin + (timestamp - start) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                device = self.device_manager.get_device(device_id)
+                if device is None:
+                    continue
+                mqtt_controller.effect_engine.stop(device_id)
+                device.set_frame(frame)
+                mqtt_controller.send_color(device)
+                replayed += 1
+        finally:
+            for device_id in device_ids:
+                count = self._replaying.pop(device_id) - 1
+                if count:
+                    self._replaying[device_id] = count
+                    continue
+                device = self.device_manager.get_device(device_id)
+                if device is not None:
+                    self.record(device)
+        return replayed
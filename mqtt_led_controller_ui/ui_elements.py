@@ -1,16 +1,18 @@
 import asyncio
 import functools
 import logging
+import time
 from dataclasses import dataclass
-from time import perf_counter
 
-from mqtt_controller import Device, MQTTController
-from nicegui import events, ui
+from led_renderer import LedCanvas, layout_for
+from mqtt_controller import Device, MQTTController, parse_color
+from nicegui import ui
 from settings import (
     BROKER_ADRESS,
     BROKER_PORT,
     ENABLE_PERFORMANCE_TEST_BUTTON,
-    led_ring_12_image_path,
+    LAZY_DEVICE_PANELS,
+    PANEL_IDLE_TIMEOUT,
 )
 
 
@@ -29,37 +31,30 @@ def ui_title() -> None:
         )
 
 
-def toggle_mqtt_connection(mqtt_controller: MQTTController) -> None:
+async def toggle_mqtt_connection(mqtt_controller: MQTTController) -> None:
 
     if not mqtt_controller.client.is_connected():
         ui.status_label.text = "Connecting to MQTT broker…"
-        _connection_state = mqtt_controller.connect_to_mqtt()
+        _connection_state = await mqtt_controller.connect_to_mqtt_async()
         ui.status_label.text = _connection_state
         if _connection_state.startswith("Connected"):
             ui.notify(
                 _connection_state, type="positive"
             )
-        ui.timer(1.0, lambda: ui_panels.refresh(), once=True)
 
     else:
         mqtt_controller.disconnect_from_mqtt()
-        ui.timer(1.0, lambda: ui_panels.refresh(), once=True)
 
 
 def ui_connection_control(mqtt_controller: MQTTController) -> None:
     with ui.column().classes("w-full items-center"):
-        with ui.card():
+        with ui.card() as connection_card:
             ui.status_label = ui.label(text="Connecting to MQTT broker…")
-            with ui.button(
+            ui.connect_button = ui.button(
                 text="Connect",
                 on_click=lambda: toggle_mqtt_connection(mqtt_controller),
                 color="positive",
-            ) as ui.connect_button:
-                ui.connect_button.bind_text_from(
-                    mqtt_controller,
-                    "mqtt_connected",
-                    lambda e: "Disconnect" if e else "Connect",
-                )
+            )
 
             with ui.row():
                 ui.broker_address_textbox = ui.input(
@@ -77,6 +72,26 @@ def ui_connection_control(mqtt_controller: MQTTController) -> None:
                     on_change=lambda: set_port_value(mqtt_controller),
                 )
 
+    def on_connection_changed(connected: bool):
+        if connected:
+            ui.status_label.text = (
+                "Connected to MQTT broker " + mqtt_controller.broker_address
+            )
+            ui.broker_address_textbox.enabled = False
+            ui.broker_port_textbox.enabled = False
+            ui.connect_button.text = "Disconnect"
+            ui.connect_button.props("color=negative")
+        else:
+            ui.status_label.text = "Disconnected from MQTT broker"
+            ui.broker_port_textbox.enabled = True
+            ui.broker_address_textbox.enabled = True
+            ui.connect_button.text = "Connect"
+            ui.connect_button.props("color=positive")
+            with connection_card:
+                ui.notify("Disconnected from MQTT broker", type="negative")
+
+    mqtt_controller.connection_changed.subscribe(on_connection_changed)
+
 def set_ip_value(mqtt_controller: MQTTController):
     mqtt_controller.broker_address = ui.broker_address_textbox.value
 
@@ -87,33 +102,22 @@ def set_port_value(mqtt_controller: MQTTController):
 @dataclass
 class Performance_test_variable:
     cycles = 100
+    in_flight = 1
+    results = {}  # last LatencyResult per device_id
 
 
 async def test_device_performance(
     mqtt_controller: MQTTController, device: Device, cycles: int = 100
 ):
-    import statistics
-    from itertools import cycle
-
     cycles = int(Performance_test_variable.cycles)
+    in_flight = int(Performance_test_variable.in_flight)
 
-    cycle_colors = cycle(
-        [
-            "#FF0000",
-            "#00FF00",
-            "#0000FF",
-            "#FFFF00",
-            "#800080",
-            "#00FFFF",
-            "#FF00FF",
-            "#FFFFFF",
-        ]
-    )
+    if not device.led_count:
+        ui.notify(f"{device.device_id} has no LEDs to test", type="warning")
+        return
 
     logging.info(f"Testing device performance for {device.device_id}")
 
-    ui.run_javascript('navigator.clipboard.writeText("EMPTY CLIPBOARD")')
-
     ui.notify(
         f"Performing performance test for {device.device_id} with {cycles} cycles",
         type="ongoing",
@@ -122,367 +126,439 @@ async def test_device_performance(
         timeout=5000,
     )
 
-    for led in range(device.led_count):
-        device.update_lights(led, "#000000")
-
-    mqtt_controller.send_color(device)
-    await asyncio.sleep(1)
-
-    results = []
-    # Performance_test_variable.results.clear()
-
-    for current_cycle in range(cycles):
-        current_color = next(cycle_colors)
-        current_light = current_cycle % device.led_count
-
-        device.update_lights(current_light, current_color)
-        perf_counter_start = perf_counter()
-        mqtt_controller.send_color(device)
-        device.update_lights(current_light, "#000000")
-        while device.lights[current_light].lower() != current_color.lower():
-            await asyncio.sleep(0.00001)
-        cylce_time = perf_counter() - perf_counter_start
-        results.append(cylce_time)
-
-    for led in range(device.led_count):
-        device.update_lights(led, "#000000")
-
-    mqtt_controller.send_color(device)
+    result = await mqtt_controller.test_performance(device, cycles, in_flight)
+    Performance_test_variable.results[device.device_id] = result
 
     ui.html("<style>.multi-line-notification { white-space: pre-line; }</style>")
 
     ui.notify(
-        (
-            f"Performance test successfully completed\n"
-            f"Tested {device.device_id} with {cycles} cycles and {device.led_count} lights\n"
-            f"Total time: {sum(results):.2f} seconds\n\n"
-            "The response time per color change is:\n"
-            f"Max:      {max(results):.4f} seconds\n"
-            f"Min:      {min(results):.4f} seconds\n"
-            f"Average:  {statistics.mean(results):.4f} seconds\n"
-            f"Median:   {statistics.median(results):.4f} seconds\n"
-        ),
-        type="positive",
-        timeout=99999999999999,
+        "Performance test successfully completed\n" + result.format_summary(),
+        type="positive" if not result.timeouts else "warning",
+        timeout=0,
         multi_line=True,
         position="center",
         classes="multi-line-notification",
         close_button="Close",
     )
 
-    result_clipboard_table = f"{cycles}	{device.led_count}	{sum(results):.4f}	{max(results):.4f}	{min(results):.4f}	{statistics.mean(results):.4f}	{statistics.median(results):.4f}"
-
-    # try multiple times to copy the result to the clipboard
-    ui.run_javascript(f'navigator.clipboard.writeText("{result_clipboard_table}")')
-    # wait until the window is active
-    while not await ui.run_javascript("document.hasFocus()"):
-        await asyncio.sleep(delay=1)
-    ui.run_javascript(
-        f'navigator.clipboard.writeText("{result_clipboard_table}")'
-    )  # Copy the result to the clipboard
-
-    await asyncio.sleep(delay=2)
-    while not await ui.run_javascript("document.hasFocus()"):
-        await asyncio.sleep(delay=1)
-    ui.run_javascript(
-        f'navigator.clipboard.writeText("{result_clipboard_table}")'
-    )  # Copy the result to the clipboard
-
-    # print(f"Performance test for {device.device_id} with {cycles} cycles completed")
-    # print("Printing out the whole result list: ")
-    # print("\n")
-    # print(results)
-    # print("\n\n")
-    # print("Performance test results copied to clipboard:")
-    # print(result_clipboard_table)
+
+def download_performance_result(device: Device, file_format: str):
+    result = Performance_test_variable.results.get(device.device_id)
+    if result is None:
+        ui.notify(f"No performance test of {device.device_id} yet", type="warning")
+        return
+    content = result.to_json() if file_format == "json" else result.to_csv()
+    ui.download(content.encode(), f"latency-{device.device_id}.{file_format}")
+
+
+def fill_device(mqtt_controller: MQTTController, device: Device, color: str) -> None:
+    # every LED of the device in one color, one frame update instead of one per LED
+    device.set_frame(bytes(parse_color(color)) * device.led_count)
+    mqtt_controller.send_color(device)
 
 
 async def rotating_led_animation(mqtt_controller: MQTTController, device: Device):
-    colors = ["#FF0000", "#00FF00", "#0000FF", "#FFFF00", "#800080", "#00FFFF"]
-    duration = 0.1  # Duration in seconds for each color
+    colors = ((255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (128, 0, 128), (0, 255, 255))
+    steps_per_second = 10  # each LED step is shown for 0.1 seconds
     rotations = 3  # Amount rotations
 
-    for _ in range(rotations):
-        for _currentLight in range(device.led_count):
-            for _ in range(device.led_count):
-                device.update_lights(_, "#000000")
-            _color = colors[_currentLight % len(colors)]
-            device.update_lights(_currentLight, _color)
-            mqtt_controller.send_color(device)
-            await asyncio.sleep(duration)
+    effect_engine = mqtt_controller.effect_engine
+    if not await effect_engine.play(
+        device, "chase", cycles=rotations, frame_rate=steps_per_second, colors=colors
+    ):
+        return  # replaced by another effect
+    if not await effect_engine.play(
+        device, "wipe", cycles=1, frame_rate=steps_per_second, colors=colors[:rotations]
+    ):
+        return
+    await effect_engine.play(device, "solid", cycles=1, color=(0, 0, 0))
 
-    for _cycles in range(rotations):
-        for _currentLight in range(device.led_count):
-            _color = colors[_cycles]
-            device.update_lights(_currentLight, _color)
-            mqtt_controller.send_color(device)
-            await asyncio.sleep(duration)
-        for _currentLight in range(device.led_count):
-            device.update_lights(_currentLight, "#000000")
+
+class StateLabel(ui.label):
+
+    def _handle_text_change(self, text: str) -> None:
+
+        if text == "online":
+            self.classes(replace="text-positive")
+        elif text == "offline":
+            self.classes(replace="text-negative")
+        super()._handle_text_change(text)
+
+
+def ui_led_color_picker(mqtt_controller: MQTTController, device: Device):
+    # one color picker shared by all LEDs of a device, returns a function that
+    # opens it for a given LED
+    selected_led = {"index": None}
+
+    def on_pick(e):
+        if selected_led["index"] is not None and device.online:
+            device.update_lights(selected_led["index"], e.color)
             mqtt_controller.send_color(device)
-            await asyncio.sleep(duration)
 
-    for _ in range(device.led_count):
-        device.update_lights(_, "#000000")
-        mqtt_controller.send_color(device)
+    color_picker = ui.color_picker(on_pick=on_pick).props("no-parent-event")
+
+    def open_color_picker(led_index: int):
+        selected_led["index"] = led_index
+        color_picker.set_color(device.color_hex(led_index))
+        color_picker.open()
+
+    return open_color_picker
+
+
+def ui_led_canvas(device: Device, open_color_picker) -> list:
+    # all LEDs on one canvas, laid out as configured in LED_LAYOUTS
+    def on_click(led_index):
+        if not device.online:
+            return
+        if led_index is None:
+            ui.notify("No LED was clicked", type="negative", color="orange")
+        else:
+            open_color_picker(led_index)
+
+    canvas = LedCanvas(layout_for(device), device.frame, on_click).classes("w-full")
+    canvas.set_disabled(not device.online)
+
+    def on_lights_changed(led_indices):
+        if led_indices is None or 3 * len(led_indices) > device.led_count:
+            canvas.set_frame(device.frame)
+        else:
+            canvas.patch(device.frame, led_indices)
+
+    return [
+        device.subscribe("lights", on_lights_changed),
+        device.subscribe("online", lambda online: canvas.set_disabled(not online)),
+    ]
+
+
+def ui_device_panel(mqtt_controller: MQTTController, device: Device) -> list:
+    # builds the content of one device tab, returns the unsubscribe functions
+    # of the change events it listens to
+    functions_buttons = []
+
+    with ui.row():
+        with ui.switch(
+            text="Retain Light State",
+            value=device.retain,
+            on_change=lambda: (
+                setattr(device, "retain", retain_switch.value),
+                mqtt_controller.delete_retained_messages(device),
+            ),
+        ).style("right: 0px;top: 0px;position: relative; ") as retain_switch:
+            functions_buttons.append(retain_switch)
+
+        with ui.label(
+            text="Amount of Lights",
+        ).style(
+            "right: -210px; top: 10px;position: relative; font-size: 100%;"
+        ) as led_count_label:
+            led_count_label.text = f"{device.led_count} lights"
+            led_count_label.enabled = False
+
+        with StateLabel(" ").style(
+            "right: -150px;top: -15px;position: relative; font-size: 120%;"
+        ) as online_state_label:
+            online_state_label.visible = mqtt_controller.mqtt_connected
+
+    with ui.grid(columns=3):
+        with ui.button(
+            text="all Lights off",
+            icon="blur_off",
+            on_click=lambda: fill_device(mqtt_controller, device, "#000000"),
+        ).props("stack glossy") as button_all_off:
+            functions_buttons.append(button_all_off)
+
+        with ui.button(icon="palette").props("stack glossy") as button_all:
+            button_all.text = "All Lights"
+            ui.color_picker(
+                on_pick=lambda e: fill_device(mqtt_controller, device, e.color),
+            )
+            functions_buttons.append(button_all)
+
+        with ui.button(
+            text="Animation",
+            icon="animation",
+            on_click=functools.partial(rotating_led_animation, mqtt_controller, device),
+        ).props("stack glossy") as button_animation:
+            functions_buttons.append(button_animation)
+
+    # the LED views depend on led_count and are rebuilt in place when it changes
+    led_view = ui.element("div").classes("w-full")
+    led_view_subscriptions = []
+
+    def release_led_view():
+        for unsubscribe in led_view_subscriptions:
+            unsubscribe()
+        led_view_subscriptions.clear()
+
+    def build_led_view():
+        release_led_view()
+        led_view.clear()
+        with led_view:
+            open_color_picker = ui_led_color_picker(mqtt_controller, device)
+            led_view_subscriptions.extend(ui_led_canvas(device, open_color_picker))
+
+    build_led_view()
+
+    logging.debug(f"Device {device.device_id} online: {device.online}")
+    if ENABLE_PERFORMANCE_TEST_BUTTON:
+        with ui.row():
+            with ui.number(
+                label="Number of Cycles for to Test",
+                min=1,
+                max=10000,
+                step=1,
+                precision=0,
+                placeholder="100",
+                format="%.0f",
+                value=Performance_test_variable.cycles,
+                on_change=lambda e: setattr(Performance_test_variable, "cycles", e.value),
+            ).style("width: 200px;"):
+                pass
+            with ui.number(
+                label="Commands in Flight",
+                min=1,
+                max=max(device.led_count, 1),
+                step=1,
+                precision=0,
+                format="%.0f",
+                value=Performance_test_variable.in_flight,
+                on_change=lambda e: setattr(Performance_test_variable, "in_flight", e.value),
+            ).style("width: 150px;"):
+                pass
+            with ui.button(
+                text="Test Device Performance",
+                icon="speed",
+                on_click=functools.partial(
+                    test_device_performance,
+                    mqtt_controller,
+                    device,
+                ),
+            ).props("stack glossy") as button_test_performance:
+                functions_buttons.append(button_test_performance)
+            for file_format in ("json", "csv"):
+                ui.button(
+                    text=file_format.upper(),
+                    icon="download",
+                    on_click=functools.partial(
+                        download_performance_result, device, file_format
+                    ),
+                ).props("stack flat")
+
+    def on_online_changed(online: bool):
+        for element in functions_buttons:
+            element.set_enabled(online)
+        online_state_label.set_text(device.online_str)
+
+    def on_led_count_changed(led_count: int):
+        led_count_label.set_text(f"{led_count} lights")
+        build_led_view()
+
+    on_online_changed(device.online)
+    return [
+        device.subscribe("online", on_online_changed),
+        device.subscribe("led_count", on_led_count_changed),
+        mqtt_controller.connection_changed.subscribe(online_state_label.set_visibility),
+        release_led_view,
+    ]
+
+
+def ui_group_control(mqtt_controller: MQTTController) -> None:
+    # controls all devices at once, or the devices of one group; the commands
+    # go out on the broadcast/group topic when every member supports it
+    device_manager = mqtt_controller.device_manager
+    all_devices = "All devices"
+    selected = {"group": None}
+
+    def group_options(groups) -> list:
+        return [all_devices] + sorted(groups)
+
+    def on_group_selected(value):
+        selected["group"] = None if value in (None, all_devices) else value
+
+    def set_color(color):
+        messages = mqtt_controller.set_group_color(color, selected["group"])
+        logging.debug(f"Group command for {selected['group'] or 'all'} sent as {messages} messages")
+
+    async def play_animation():
+        devices = device_manager.get_group_devices(selected["group"])
+        await asyncio.gather(
+            *(
+                mqtt_controller.effect_engine.play(device, "rainbow", cycles=3)
+                for device in devices
+            )
+        )
+
+    scenes = mqtt_controller.scenes
+
+    def apply_scene():
+        if scene_select.value:
+            devices = scenes.apply(scene_select.value)
+            logging.debug(f"Scene {scene_select.value} applied to {devices} devices")
 
+    def save_scene():
+        # the current state of the selected devices becomes a scene
+        name = scene_name.value.strip()
+        if not name:
+            return
+        scenes.capture(name, device_manager.get_group_devices(selected["group"]))
+        scene_select.set_options(scenes.names, value=name)
+        scene_name.value = ""
 
-@ui.refreshable
-def ui_panels(mqtt_controller: MQTTController) -> None:
     with ui.column().classes("w-full items-center"):
-        with ui.tabs() as tabs:
-            for _current_device in mqtt_controller.device_manager.devices:
-                if _current_device.device_id.startswith("test"):
-                    ui.tab(_current_device.device_id, icon="science")
-                else:
-                    ui.tab(_current_device.device_id, icon="online_prediction")
-
-        with ui.tab_panels(
-            tabs,
-            value=mqtt_controller.device_manager.selected_device,
-            on_change=lambda e: (
-                setattr(mqtt_controller.device_manager, "selected_device", e.value),
-            ),
-        ):
-
-            for _current_tab, _current_device in enumerate(
-                mqtt_controller.device_manager.devices
-            ):
-                ui.functions_buttons = []
-
-                with ui.tab_panel(_current_device.device_id):
-
-                    with ui.row():
-                        with ui.switch(
-                            text="Retain Light State",
-                            value=_current_device.retain,
-                            on_change=lambda: (
-                                setattr(_current_device, "retain", retain_switch.value),
-                                mqtt_controller.delete_retained_messages(
-                                    _current_device
-                                ),
-                            ),
-                        ).style(
-                            "right: 0px;top: 0px;position: relative; "
-                        ) as retain_switch:
-                            retain_switch.enabled = False
-                            retain_switch.bind_enabled_from(_current_device, "online")
-                            ui.functions_buttons.append(retain_switch)
-
-                        with ui.label(
-                            text="Amount of Lights",
-                        ).style(
-                            "right: -210px; top: 10px;position: relative; font-size: 100%;"
-                        ) as led_count_label:
-                            led_count_label.bind_text_from(
-                                _current_device, "led_count", lambda e: f"{e} lights"
-                            )
-                            led_count_label.enabled = False
-
-                        class state_label(ui.label):
-
-                            def _handle_text_change(self, text: str) -> None:
-
-                                if text == "online":
-                                    self.classes(replace="text-positive")
-                                    # if mqtt_controller.mqtt_connected:
-                                    #    ui.notify(f'{_current_device.device_id} online', type="positive", color='teal')
-                                elif text == "offline":
-                                    self.classes(replace="text-negative")
-                                    # if mqtt_controller.mqtt_connected:
-                                    #    ui.notify(f'{_current_device.device_id} offline', type="negative", color="orange")
-                                super()._handle_text_change(text)
-
-                        with state_label(" ").style(
-                            "right: -150px;top: -15px;position: relative; font-size: 120%;"
-                        ) as ui.online_state_label:
-                            ui.online_state_label.bind_text_from(
-                                _current_device,
-                                "online",
-                                lambda e: "online" if e else "offline",
-                            )
-                            ui.online_state_label.bind_visibility_from(
-                                target_object=mqtt_controller,
-                                target_name="mqtt_connected",
-                                value=True,
-                            )
-
-                    with ui.grid(columns=3):
-                        with ui.button(
-                            text="all Lights off",
-                            icon="blur_off",
-                            on_click=lambda: (
-                                [
-                                    _current_device.update_lights(_, "#000000")
-                                    for _ in range(_current_device.led_count)
-                                ],
-                                mqtt_controller.send_color(_current_device),
-                            ),
-                        ).props("stack glossy") as button_all_off:
-                            ui.functions_buttons.append(button_all_off)
-                            button_all_off.enabled = False
-                            button_all_off.bind_enabled_from(_current_device, "online")
-
-                        with ui.button(icon="palette").props(
-                            "stack glossy"
-                        ) as button_all:
-                            button_all.enabled = False
-                            button_all.text = "All Lights"
-                            ui.color_picker(
-                                on_pick=lambda e: (
-                                    [
-                                        _current_device.update_lights(_, e.color)
-                                        for _ in range(_current_device.led_count)
-                                    ],
-                                    mqtt_controller.send_color(_current_device),
-                                ),
-                            )
-                            ui.functions_buttons.append(button_all)
-                            button_all.bind_enabled_from(_current_device, "online")
-
-                        with ui.button(
-                            text="Animation",
-                            icon="animation",
-                            on_click=functools.partial(
-                                rotating_led_animation, mqtt_controller, _current_device
-                            ),
-                        ).props("stack glossy") as button_animation:
-                            button_animation.bind_enabled_from(
-                                _current_device, "online"
-                            )
-                            ui.functions_buttons.append(button_animation)
-                            button_animation.enabled = False
-
-                    if _current_device.led_count == 12:
-
-                        led_positions = [
-                            [109.6, 318.8],
-                            [202.5, 176.0],
-                            [361.9, 99.6],
-                            [527.9, 109.6],
-                            [667.4, 199.2],
-                            [747.1, 348.6],
-                            [740.4, 524.6],
-                            [647.5, 670.7],
-                            [494.7, 750.4],
-                            [318.8, 740.4],
-                            [176.0, 650.8],
-                            [102.9, 491.4],
-                        ]
-
-                        def mouse_handler(e: events.MouseEventArguments):
-                            # ui.notify(f'{e.type} at ({e.image_x:.1f}, {e.image_y:.1f})')
-                            logging.debug(
-                                f"In {_current_device.device_id} an image mousclick was detect {e.image_x:.1f}, {e.image_y:.1f}"
-                            )
-                            _click_tolerance = 50
-                            if e.type == "mousedown" and _current_device.online:
-                                for i, _position in enumerate(led_positions):
-                                    if (e.image_x - _position[0]) ** 2 + (
-                                        e.image_y - _position[1]
-                                    ) ** 2 <= _click_tolerance**2:
-                                        with ui.color_picker(
-                                            on_pick=lambda e, _led_index=i: (
-                                                _current_device.update_lights(
-                                                    _led_index, e.color
-                                                ),
-                                                mqtt_controller.send_color(
-                                                    _current_device
-                                                ),
-                                                image_color_picker.delete(),
-                                            ),
-                                            value=_current_device.lights[i],
-                                        ).props(
-                                            "default-view palette"
-                                        ) as image_color_picker:
-                                            pass
-                                        break
-
-                                else:
-                                    ui.notify(
-                                        "No LED was clicked",
-                                        type="negative",
-                                        color="orange",
-                                    )
-                                    image_color_picker.delete()
-
-                        with ui.column():
-
-                            with ui.interactive_image(
-                                source=led_ring_12_image_path,
-                                on_mouse=mouse_handler,
-                                events=["mousedown"],
-                            ).classes("w-96 relativ bottom-0 left-4") as image:
-
-                                def update_image_content(lights, device_online):
-                                    if device_online:
-                                        _image_content = ""
-                                        for i, color in enumerate(lights):
-                                            _image_content += f"""
-                                                <circle cx="{led_positions[i][0]}" cy="{led_positions[i][1]}" r="40" fill="{color}" />
-                                            """
-                                        return _image_content
-
-                                image.bind_content_from(
-                                    _current_device,
-                                    "lights",
-                                    lambda e, i=_current_device.online: update_image_content(
-                                        e, i
-                                    ),
-                                )
-
-                    ui.led_buttons = {
-                        mqtt_controller.device_manager.devices[i]: []
-                        for i in range(len(mqtt_controller.device_manager.devices))
-                    }
-                    with ui.grid(columns=3).style("width: 100%;"):
-                        for i in range(_current_device.led_count):
-                            button_name = "button" + str(i)
-                            with ui.button(icon="lightbulb").style(
-                                f"color:{_current_device.lights[i]}!important"
-                            ) as button:
-                                button.enabled = False
-                                button.name = button_name
-                                button.text = "Light " + str(i)
-                                ui.color_picker(
-                                    on_pick=lambda e, led_index=i,: (
-                                        _current_device.update_lights(
-                                            led_index, e.color
-                                        ),
-                                        mqtt_controller.send_color(_current_device),
-                                    )
-                                )
-                                button.bind_enabled_from(_current_device, "online")
-                                ui.led_buttons[_current_device].append(button)
-
-                    logging.debug(
-                        f"Device {_current_device.device_id} online: {_current_device.online}"
-                    )
-                    if ENABLE_PERFORMANCE_TEST_BUTTON:
-                        with ui.row():
-                            with ui.number(
-                                label="Number of Cycles for to Test",
-                                min=1,
-                                max=10000,
-                                step=1,
-                                precision=0,
-                                placeholder="100",
-                                format="%.0f",
-                            ).style("width: 200px;") as input_performance_test_number:
-                                input_performance_test_number.bind_value(
-                                    Performance_test_variable, "cycles"
-                                )
-                            with ui.button(
-                                text="Test Device Performance",
-                                icon="speed",
-                                on_click=functools.partial(
-                                    test_device_performance,
-                                    mqtt_controller,
-                                    _current_device,
-                                ),
-                            ).props("stack glossy") as button_test_performance:
-                                ui.functions_buttons.append(button_test_performance)
-                                button_test_performance.bind_enabled_from(
-                                    _current_device,
-                                    "online",
-                                )
+        with ui.card():
+            with ui.row().classes("items-center"):
+                group_select = ui.select(
+                    group_options(device_manager.groups),
+                    value=all_devices,
+                    label="Devices",
+                    on_change=lambda e: on_group_selected(e.value),
+                ).style("width: 200px;")
+
+                ui.button(
+                    text="all Lights off",
+                    icon="blur_off",
+                    on_click=lambda: set_color((0, 0, 0)),
+                ).props("stack glossy")
+
+                with ui.button(text="All Lights", icon="palette").props("stack glossy"):
+                    ui.color_picker(on_pick=lambda e: set_color(e.color))
+
+                ui.button(
+                    text="Animation",
+                    icon="animation",
+                    on_click=play_animation,
+                ).props("stack glossy")
+
+            with ui.row().classes("items-center"):
+                scene_select = ui.select(scenes.names, label="Scene").style("width: 200px;")
+                ui.button(text="Apply", icon="wb_incandescent", on_click=apply_scene).props(
+                    "stack glossy"
+                )
+                scene_name = ui.input(label="New scene").style("width: 150px;")
+                ui.button(text="Save", icon="save", on_click=save_scene).props("stack glossy")
+
+    def on_groups_changed(groups):
+        removed = selected["group"] is not None and selected["group"] not in groups
+        group_select.set_options(group_options(groups), value=all_devices if removed else None)
+
+    device_manager.groups_changed.subscribe(on_groups_changed)
+
+
+class DevicePanels:
+    # One tab and one tab panel per device, kept in sync with the device
+    # registry: panels are added and removed one at a time, so the page is
+    # never torn down and the selected tab is kept.
+    # With `lazy` the content of a panel is only built when its tab is first
+    # opened, and released again after it was hidden for `idle_timeout` seconds.
+
+    def __init__(
+        self,
+        mqtt_controller: MQTTController,
+        lazy: bool = LAZY_DEVICE_PANELS,
+        idle_timeout: float = PANEL_IDLE_TIMEOUT,
+    ):
+        self.mqtt_controller = mqtt_controller
+        self.device_manager = mqtt_controller.device_manager
+        self.lazy = lazy
+        self.idle_timeout = idle_timeout
+        self._tabs = {}
+        self._panels = {}
+        self._built = {}
+        self._hidden_since = {}
+
+        with ui.column().classes("w-full items-center"):
+            self.tabs = ui.tabs()
+            self.tab_panels = ui.tab_panels(
+                self.tabs,
+                value=self.device_manager.selected_device,
+                on_change=lambda e: self._on_tab_change(e.value),
+            )
+
+        for device in self.device_manager.devices:
+            self.add_device(device)
+        self.device_manager.device_added.subscribe(self.add_device)
+        self.device_manager.device_removed.subscribe(self.remove_device)
+        self.device_manager.online_changed.subscribe(self.update_tab_icons)
+
+        if self.lazy and self.idle_timeout > 0:
+            ui.timer(max(self.idle_timeout / 4, 1.0), self.release_idle_panels)
+
+    @property
+    def built_panels(self) -> int:
+        return len(self._built)
+
+    def add_device(self, device: Device) -> None:
+        if device.device_id in self._panels:
+            self.remove_device(device)
+
+        with self.tabs:
+            tab = ui.tab(device.device_id, icon=self._tab_icon(device))
+        with self.tab_panels:
+            panel = ui.tab_panel(device.device_id)
+        self._tabs[device.device_id] = tab
+        self._panels[device.device_id] = panel
+
+        if self.tab_panels.value is None:
+            self.tab_panels.value = device.device_id
+        if not self.lazy or self.tab_panels.value == device.device_id:
+            self.build_panel(device.device_id)
+
+    @staticmethod
+    def _tab_icon(device: Device) -> str:
+        if device.device_id.startswith("test"):
+            return "science"
+        return "online_prediction" if device.online else "cloud_off"
+
+    def update_tab_icons(self, devices) -> None:
+        # called once per batch of online changes, e.g. all devices that
+        # timed out in one tick of the liveness monitor
+        for device in devices:
+            tab = self._tabs.get(device.device_id)
+            if tab is not None:
+                tab.props(f"icon={self._tab_icon(device)}")
+
+    def remove_device(self, device: Device) -> None:
+        self.release_panel(device.device_id)
+        tab = self._tabs.pop(device.device_id, None)
+        if tab is not None:
+            self.tabs.remove(tab)
+        panel = self._panels.pop(device.device_id, None)
+        if panel is not None:
+            self.tab_panels.remove(panel)
+        if self.tab_panels.value == device.device_id:
+            self.tab_panels.value = self.device_manager.selected_device
+
+    def build_panel(self, device_id: str) -> None:
+        device = self.device_manager.get_device(device_id)
+        if device is None or device_id in self._built:
+            return
+        with self._panels[device_id]:
+            self._built[device_id] = ui_device_panel(self.mqtt_controller, device)
+
+    def release_panel(self, device_id: str) -> None:
+        unsubscribe_functions = self._built.pop(device_id, None)
+        if unsubscribe_functions is None:
+            return
+        for unsubscribe in unsubscribe_functions:
+            unsubscribe()
+        self._hidden_since.pop(device_id, None)
+        self._panels[device_id].clear()
+
+    def release_idle_panels(self) -> None:
+        now = time.monotonic()
+        for device_id, hidden_since in list(self._hidden_since.items()):
+            if now - hidden_since >= self.idle_timeout:
+                logging.debug(f"Releasing idle panel of {device_id}")
+                self.release_panel(device_id)
+
+    def _on_tab_change(self, device_id: str) -> None:
+        previous_device_id = self.device_manager.selected_device
+        if previous_device_id in self._built and previous_device_id != device_id:
+            self._hidden_since[previous_device_id] = time.monotonic()
+        self._hidden_since.pop(device_id, None)
+        self.device_manager.selected_device = device_id
+        self.build_panel(device_id)
+
+
+def ui_panels(mqtt_controller: MQTTController) -> DevicePanels:
+    return DevicePanels(mqtt_controller)